@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""
+Routing and dispatch benchmarks
+
+Runs offline against the fake backends of django_email_multibackend.tests and a local fake SMTP
+server, writing one JSON object per result so runs of different commits can be compared:
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'django_email_multibackend.test_settings'
+
+from django.core.mail import EmailMessage
+from django_email_multibackend.backends import EmailMultiServerBackend, weighted_choice_by_val
+from django_email_multibackend.routing import RoutingTable, load_conditions
+from django_email_multibackend.tests import FakeSMTPServer
+
+FILTER = 'django_email_multibackend.conditions.FilterMailByHeader'
+EXCLUDE = 'django_email_multibackend.conditions.ExcludeMailByHeader'
+MATCH_ANY = 'django_email_multibackend.conditions.MatchAny'
+
+
+def nested_condition(depth):
+    """
+    A condition matching X-MAIL-TYPE=transactional behind :depth levels of MatchAny, every level
+    first trying a condition that does not match
+    """
+    condition = (FILTER, {'header': ('X-MAIL-TYPE', 'transactional')})
+    for level in range(depth):
+        condition = (MATCH_ANY, {'conditions': (
+            (FILTER, {'header': ('X-LEVEL', str(level))}),
+            condition,
+        )})
+    return condition
+
+
+def make_backends(count, backend='django_email_multibackend.tests.FakeSendingBackend'):
+    backends = dict(('backend%s' % i, {'backend': backend}) for i in range(count))
+    weights = tuple(('backend%s' % i, i + 1) for i in range(count))
+    return backends, weights
+
+
+def make_conditions(backends, depth):
+    """
+    backend0 accepts every message, odd backends take the transactional ones through :depth levels
+    of MatchAny and the other even backends exclude the non-transactional ones
+    """
+    conditions = {}
+    for index, backend_key in enumerate(sorted(backends)):
+        if not index:
+            continue
+        if index % 2:
+            conditions[backend_key] = [nested_condition(depth)]
+        else:
+            conditions[backend_key] = [(EXCLUDE, {'header': ('X-MAIL-TYPE', 'non-transactional')})]
+    return conditions
+
+
+def make_messages(count, distinct=100):
+    templates = []
+    for i in range(min(count, distinct)):
+        message = EmailMessage('subject %s' % i, 'body', 'from@example.com', ['to%s@example.com' % i])
+        message.extra_headers['X-MAIL-TYPE'] = 'transactional' if i % 3 else 'non-transactional'
+        message.extra_headers['X-CAMPAIGN-NAME'] = 'campaign-%s' % i
+        templates.append(message)
+    return [templates[i % len(templates)] for i in range(count)]
+
+
+REPEAT = 3
+
+
+def timed(function, iterations):
+    """
+    Runs :function REPEAT times and reports the fastest run
+    """
+    elapsed = None
+    for i in range(REPEAT):
+        started = time.time()
+        function()
+        run_time = max(time.time() - started, 1e-9)
+        elapsed = run_time if elapsed is None else min(elapsed, run_time)
+    return {
+        'iterations': iterations,
+        'seconds': elapsed,
+        'per_second': iterations / elapsed,
+        'us_per_iteration': elapsed * 1e6 / iterations,
+    }
+
+
+def bench_weighted_choice(options):
+    for backends_count in options.backends:
+        backends, weights = make_backends(backends_count)
+        choices = list(weights)
+        values = [i / float(options.iterations) for i in range(options.iterations)]
+
+        def run():
+            for value in values:
+                weighted_choice_by_val(choices, value)
+        yield dict(timed(run, options.iterations), benchmark='weighted_choice_by_val', backends=backends_count)
+
+
+def bench_conditions(options):
+    mail = make_messages(1)[0]
+    for depth in options.depths:
+        for name, conditions_conf in (
+            ('FilterMailByHeader', [(FILTER, {'header': ('X-MAIL-TYPE', 'transactional')})]),
+            ('ExcludeMailByHeader', [(EXCLUDE, {'header': ('X-MAIL-TYPE', 'non-transactional')})]),
+            ('MatchAny', [nested_condition(depth)]),
+        ):
+            if name != 'MatchAny' and depth != options.depths[0]:
+                continue
+            condition = load_conditions(conditions_conf)[0]
+
+            def run():
+                for i in range(options.iterations):
+                    condition(mail)
+            yield dict(timed(run, options.iterations), benchmark='condition', condition=name, depth=depth)
+
+
+def bench_routing(options):
+    messages = make_messages(options.iterations, distinct=options.iterations)
+    for backends_count in options.backends:
+        for depth in options.depths:
+            backends, weights = make_backends(backends_count)
+            table = RoutingTable(make_conditions(backends, depth))
+            instance = EmailMultiServerBackend(backends=backends, backend_weights=weights, routing_table=table)
+
+            def run():
+                for message in messages:
+                    instance.get_backends_for_email(message)
+            yield dict(
+                timed(run, len(messages)), benchmark='get_backends_for_email', backends=backends_count, depth=depth
+            )
+
+
+def bench_send_messages(options):
+    for backends_count in options.backends:
+        backends, weights = make_backends(backends_count)
+        table = RoutingTable(make_conditions(backends, options.depths[0]))
+        for batch_size in options.batch_sizes:
+            messages = make_messages(batch_size)
+            for chunk_size in (None, 1000):
+                instance = EmailMultiServerBackend(
+                    backends=backends, backend_weights=weights, routing_table=table, batch_size=chunk_size
+                )
+                result = {}
+
+                def run():
+                    result['sent'] = instance.send_messages(messages)
+                measured = timed(run, batch_size)
+                assert result['sent'] == batch_size
+                yield dict(
+                    measured, benchmark='send_messages', backends=backends_count,
+                    batch_size=batch_size, chunk_size=chunk_size
+                )
+
+
+def bench_send_messages_smtp(options):
+    with FakeSMTPServer() as server:
+        backends = {'smtp': server.backend_settings()}
+        for batch_size in options.batch_sizes:
+            if batch_size > options.smtp_max:
+                continue
+            messages = make_messages(batch_size)
+            for chunk_size in (None, 1000):
+                instance = EmailMultiServerBackend(
+                    backends=backends, backend_weights=(('smtp', 1), ), batch_size=chunk_size
+                )
+                yield dict(
+                    timed(lambda: instance.send_messages(messages), batch_size),
+                    benchmark='send_messages_smtp', batch_size=batch_size, chunk_size=chunk_size
+                )
+
+
+BENCHMARKS = {
+    'weighted_choice': bench_weighted_choice,
+    'conditions': bench_conditions,
+    'routing': bench_routing,
+    'send_messages': bench_send_messages,
+    'send_messages_smtp': bench_send_messages_smtp,
+}
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    return tuple(sorted(
+        (name, value) for name, value in result.items()
+        if name not in ('iterations', 'seconds', 'per_second', 'us_per_iteration', 'commit')
+    ))
+
+
+def compare(results, previous_path):
+    with open(previous_path) as previous_file:
+        previous = dict(
+            (result_key(result), result) for result in (json.loads(line) for line in previous_file if line.strip())
+        )
+    for result in results:
+        before = previous.get(result_key(result))
+        if before is None:
+            continue
+        change = result['per_second'] / before['per_second'] - 1
+        description = ' '.join('%s=%s' % item for item in result_key(result))
+        sys.stderr.write('%-90s %+7.1f%%\n' % (description, change * 100))
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def main(argv=None):
+    global REPEAT
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run: %s (default all)' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--backends', type=int_list, default=[1, 4, 16], help='numbers of backends')
+    parser.add_argument('--depths', type=int_list, default=[0, 1, 4], help='MatchAny nesting depths')
+    parser.add_argument('--batch-sizes', type=int_list, default=[10, 1000, 100000],
+                        help='messages per send_messages call, eg. 10,1000,1000000')
+    parser.add_argument('--iterations', type=int, default=10000, help='iterations of the micro benchmarks')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='runs of every benchmark, the fastest is reported')
+    parser.add_argument('--smtp-max', type=int, default=1000, help='largest batch sent to the fake SMTP server')
+    parser.add_argument('--output', help='file to write the results to (JSON lines), defaults to stdout')
+    parser.add_argument('--compare', help='results of a previous run to compare with')
+    options = parser.parse_args(argv)
+    for name in options.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %r' % name)
+    REPEAT = options.repeat
+
+    commit = get_commit()
+    output = open(options.output, 'w') if options.output else sys.stdout
+    results = []
+    try:
+        for name in options.benchmarks or sorted(BENCHMARKS):
+            for result in BENCHMARKS[name](options):
+                result['commit'] = commit
+                results.append(result)
+                output.write(json.dumps(result, sort_keys=True) + '\n')
+                output.flush()
+    finally:
+        if options.output:
+            output.close()
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import threading
+from django_email_multibackend import conf
+
+
+class BackendHealth(object):
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+
+
+class AdaptiveWeights(object):
+    """
+    Scales the configured weights by the recent latency and error rate of each backend
+
+    Latency per message and error rate are tracked as exponentially weighted moving averages (:alpha
+    is the weight of the last send), so that backends sent large chunks are not seen as slower.
+    A backend faster than the average of all backends gets its weight scaled up, a slower one down,
+    and the result is scaled by its success rate; the factor is kept between :min_factor and
+    :max_factor and rounded to 2 decimals.
+
+    >>> weights = AdaptiveWeights(alpha=1)
+    >>> weights.record('mailjet', 0.1, True); weights.record('mailchimp', 0.3, True)
+    >>> weights.adjust([('mailjet', 1), ('mailchimp', 1)])
+    [('mailjet', 2.0), ('mailchimp', 0.67)]
+    """
+
+    def __init__(self, alpha=0.2, min_factor=0.1, max_factor=2.0):
+        self.alpha = alpha
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        self.health = {}
+        self.factors = {}
+        self.lock = threading.Lock()
+
+    def record(self, backend_key, latency, success, count=1):
+        """
+        Records a send of :count messages to :backend_key that took :latency seconds
+        """
+        latency = float(latency) / max(count, 1)
+        with self.lock:
+            health = self.health.get(backend_key)
+            if health is None:
+                health = self.health[backend_key] = BackendHealth()
+            if health.latency is None:
+                health.latency = latency
+            else:
+                health.latency += self.alpha * (latency - health.latency)
+            health.error_rate += self.alpha * ((0.0 if success else 1.0) - health.error_rate)
+            self.factors = self.compute_factors()
+
+    def compute_factors(self):
+        latencies = [health.latency for health in self.health.values()]
+        average_latency = sum(latencies) / len(latencies)
+        factors = {}
+        for backend_key, health in self.health.items():
+            if health.latency > 0:
+                factor = average_latency / health.latency
+            else:
+                factor = self.max_factor
+            factor *= 1 - health.error_rate
+            factors[backend_key] = round(min(max(factor, self.min_factor), self.max_factor), 2)
+        return factors
+
+    def get_factor(self, backend_key):
+        return self.factors.get(backend_key, 1.0)
+
+    def adjust(self, backends_weights):
+        factors = self.factors
+        return [(backend, weight * factors.get(backend, 1.0)) for backend, weight in backends_weights]
+
+
+_adaptive_weights = None
+_adaptive_weights_lock = threading.Lock()
+
+def get_adaptive_weights():
+    """
+    Returns the process-wide adaptive weights configured with EMAIL_BACKENDS_ADAPTIVE_WEIGHTS,
+    None when adaptive weighting is disabled
+    """
+    global _adaptive_weights
+    if conf.EMAIL_BACKENDS_ADAPTIVE_WEIGHTS is None:
+        return None
+    with _adaptive_weights_lock:
+        if _adaptive_weights is None:
+            _adaptive_weights = AdaptiveWeights(**conf.EMAIL_BACKENDS_ADAPTIVE_WEIGHTS)
+    return _adaptive_weights
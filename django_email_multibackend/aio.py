@@ -0,0 +1,173 @@
+import asyncio
+import inspect
+from timeit import default_timer
+from django_email_multibackend.backends import EmailMultiServerBackend
+
+
+def is_async_backend(backend):
+    """
+    Returns True when :backend can send messages without blocking the event loop
+    """
+    return inspect.iscoroutinefunction(getattr(backend, 'asend_messages', None))
+
+
+class AsyncEmailMultiServerBackend(EmailMultiServerBackend):
+    """
+    asyncio counterpart of EmailMultiServerBackend
+
+    Messages are routed with the same weights and conditions; send_messages and dispatch
+    are coroutines sending all chunks concurrently, at most :max_concurrency at once
+    (and max_workers_per_backend on the same backend). Backends with an asend_messages
+    coroutine are awaited, the others (and pooled connections) are run in the default executor.
+    """
+
+    def __init__(self, max_concurrency=10, **kwargs):
+        super(AsyncEmailMultiServerBackend, self).__init__(**kwargs)
+        self.max_concurrency = max_concurrency
+
+    async def asend_chunk(self, backend_key, email_messages):
+        backend = self.servers[backend_key]
+        if self.connection_pool is None and is_async_backend(backend):
+            count = await backend.asend_messages(email_messages)
+        else:
+            loop = asyncio.get_running_loop()
+            count = await loop.run_in_executor(None, self.send_chunk, backend_key, email_messages)
+        return count or 0
+
+    async def adeliver(self, semaphore, backends_semaphores, backend_key, chunk, sending=None):
+        """
+        Coroutine version of EmailMultiServerBackend.deliver, adds the current task to :sending once it starts sending
+        """
+        delivered = []
+        pending = [(backend_key, chunk, (), None)]
+        rendered = {}
+        routing = self.routing
+        routing.acquire()
+        try:
+            while pending:
+                backend_key, chunk, tried, previous_error = pending.pop(0)
+                wait = self.reserve_tokens(backend_key, len(chunk))
+                if wait:
+                    await asyncio.sleep(wait)
+                async with semaphore:
+                    async with backends_semaphores[backend_key]:
+                        started = default_timer()
+                        try:
+                            messages = self.get_messages(backend_key, chunk, rendered)
+                            started = default_timer()
+                            if sending is not None:
+                                sending.add(asyncio.current_task())
+                            count = await self.asend_chunk(backend_key, messages)
+                            error = None
+                        except Exception as e:
+                            count, error = 0, e
+                        latency = default_timer() - started
+                attempt_delivered, attempt_pending = self.handle_attempt(
+                    backend_key, chunk, tried, count, error, previous_error, latency
+                )
+                delivered.extend(attempt_delivered)
+                pending.extend(attempt_pending)
+        finally:
+            for rendered_message in rendered.values():
+                rendered_message.close()
+            routing.release()
+        return delivered
+
+    async def send_chunks_concurrently(self, chunks, sent=None):
+        """
+        Sends :chunks concurrently, exceptions and timeouts are handled like in
+        EmailMultiServerBackend.send_chunks_concurrently
+
+        Chunks are pulled from :chunks as tasks complete, at most 2 * max_concurrency are pending.
+        The (backend_key, chunk, count) tuples of the sent chunks are passed to :sent, or
+        returned as a list when it is not given.
+        """
+        results = None
+        if sent is None:
+            results = []
+            sent = results.append
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        backends_semaphores = dict(
+            (backend_key, asyncio.Semaphore(self.max_workers_per_backend.get(backend_key, 1)))
+            for backend_key in self.backends_settings
+        )
+        loop = asyncio.get_running_loop()
+        deadline = None
+        if self.send_timeout is not None:
+            deadline = loop.time() + self.send_timeout
+        pending = {}
+        errors = []
+        # the tasks that started sending, cancelling them may not stop the send
+        sending = set()
+
+        async def wait_tasks(return_when):
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - loop.time(), 0)
+            done, not_done = await asyncio.wait(list(pending), timeout=timeout, return_when=return_when)
+            if deadline is not None and loop.time() >= deadline:
+                for task in not_done:
+                    task.cancel()
+                    index, backend_key, chunk = pending.pop(task)
+                    if task not in sending:
+                        errors.append((index, asyncio.TimeoutError('Sending to %s timed out' % backend_key)))
+                        sent((backend_key, chunk, 0))
+                        continue
+                    errors.append((index, asyncio.TimeoutError(
+                        'Sending to %s timed out, the messages may still be delivered' % backend_key
+                    )))
+                    sent((backend_key, chunk, None))
+            for task in done:
+                index, backend_key, chunk = pending.pop(task)
+                if task.exception() is not None:
+                    errors.append((index, task.exception()))
+                    sent((backend_key, chunk, 0))
+                    continue
+                for sent_chunk in task.result():
+                    sent(sent_chunk)
+
+        for index, (backend_key, chunk) in enumerate(chunks):
+            if len(pending) >= 2 * self.max_concurrency:
+                await wait_tasks(asyncio.FIRST_COMPLETED)
+            if deadline is not None and loop.time() >= deadline:
+                errors.append((index, asyncio.TimeoutError('Sending to %s timed out' % backend_key)))
+                sent((backend_key, chunk, 0))
+                continue
+            task = asyncio.ensure_future(self.adeliver(semaphore, backends_semaphores, backend_key, chunk, sending))
+            pending[task] = (index, backend_key, chunk)
+        while pending:
+            await wait_tasks(asyncio.ALL_COMPLETED)
+
+        if errors and not self.fail_silently:
+            raise min(errors, key=lambda error: error[0])[1]
+        return results
+
+    async def dispatch(self, email_messages):
+        if not hasattr(email_messages, '__iter__'):
+            email_messages = [email_messages]
+        pinned = self.pin()
+        pinned.routing.acquire()
+        try:
+            sent_chunks = await pinned.send_chunks_concurrently(pinned.get_chunks(email_messages))
+        finally:
+            pinned.routing.release()
+        return self.collect_results(sent_chunks)
+
+    async def send_messages(self, email_messages):
+        """
+        Sends :email_messages streaming them like EmailMultiServerBackend.send_messages
+        """
+        if not hasattr(email_messages, '__iter__'):
+            email_messages = [email_messages]
+        send_count = [0]
+
+        def sent(sent_chunk):
+            send_count[0] += sent_chunk[2] or 0
+
+        pinned = self.pin()
+        pinned.routing.acquire()
+        try:
+            await pinned.send_chunks_concurrently(pinned.get_chunks(email_messages), sent)
+        finally:
+            pinned.routing.release()
+        return send_count[0]
@@ -1,135 +1,794 @@
+import copy
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
 from random import random
+from timeit import default_timer
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.core.mail.backends.base import BaseEmailBackend
-from django.core.mail import get_connection
+from django.core.mail import EmailMessage, get_connection
 from django_email_multibackend import conf
+from django_email_multibackend.adaptive import get_adaptive_weights
+from django_email_multibackend.circuit import get_circuit_breakers
+from django_email_multibackend.domains import split_by_domain
+from django_email_multibackend.metrics import get_metrics
+from django_email_multibackend.pool import get_connection_pool
+from django_email_multibackend.ratelimit import rate_limiters, split_rate_limit
+from django_email_multibackend.rendering import RenderedMessage, accepts_rendered_messages
+from django_email_multibackend.routing import (
+    LRUCache, RoutingTable, get_backend_routing_conditions, load_class, routing_table
+)
+from django_email_multibackend.signals import post_send, pre_route
+from django_email_multibackend.watcher import ConfigWatcher
 
-try:
-    from django.utils.importlib import import_module
-except ImportError:
-    from importlib import import_module
 
+class WeightedChoices(object):
+    """
+    Cumulative weights of a list of (value, weight) choices, computed once
+
+    >>> WeightedChoices([('A', 5), ('B', 0), ('C', 5)]).choose(0.5)
+    'C'
+    """
+
+    def __init__(self, choices):
+        self.values, weights = zip(*choices)
+        self.cumulative_weights = []
+        total = 0
+        for weight in weights:
+            total += weight
+            self.cumulative_weights.append(total)
+        self.total = total
+
+    def choose(self, random_value):
+        index = bisect_right(self.cumulative_weights, random_value * self.total)
+        if index >= len(self.values):
+            return self.values[-1]
+        return self.values[index]
+
+
+weighted_choices_cache = LRUCache(256)
+
+def get_weighted_choices(choices):
+    choices = tuple(choices)
+    weighted_choices = weighted_choices_cache.get(choices)
+    if weighted_choices is None:
+        weighted_choices = WeightedChoices(choices)
+        weighted_choices_cache.set(choices, weighted_choices)
+    return weighted_choices
 
 def weighted_choice_by_val(choices, random_value):
-    values, weights = zip(*choices)
-    rnd = random_value * sum(weights)
-    for i, w in enumerate(weights):
-        rnd -= w
-        if rnd < 0:
-            return values[i]
-    return values[-1]
+    return get_weighted_choices(choices).choose(random_value)
 
 def weighted_choice(choices):
     random_value = random()
     return weighted_choice_by_val(choices, random_value)
 
-def get_backend_routing_conditions(backend):
+class LazyConnections(dict):
+    """
+    The child backends by key, each one created by :factory the first time it is looked up
+    """
+
+    def __init__(self, factory):
+        super(LazyConnections, self).__init__()
+        self.factory = factory
+        self.lock = threading.Lock()
+
+    def __missing__(self, backend_key):
+        with self.lock:
+            if not dict.__contains__(self, backend_key):
+                dict.__setitem__(self, backend_key, self.factory(backend_key))
+            return dict.__getitem__(self, backend_key)
+
+class RoutingSnapshot(object):
     """
-    Loads and initialise the list of conditions for :backend
+    The weights, routing table and child backends an EmailMultiServerBackend routes and sends with
 
+    Snapshots are never changed once in use: reconfiguring builds a new one and swaps it in, sends
+    in flight keep using theirs. Every send call holds its snapshot (acquire / release) from its first chunk
+    to its last; once replaced (retired) and no longer used, the child backends of a snapshot that its
+    successor does not reuse are closed, once.
+    """
 
-    eg.
+    def __init__(self, backends, backend_weights, weights, routing_table, servers):
+        self.backends = backends
+        self.backend_weights = backend_weights
+        self.weights = weights
+        self.routing_table = routing_table
+        self.servers = servers
+        self.backends_settings = {}
+        self.backends_semaphores = {}
+        self.rate_limits = {}
+        self.rendered_backends = set()
+        self.users = 0
+        self.successor = None
+        self.closed = False
+        self.lock = threading.Lock()
 
-    EMAIL_BACKENDS_CONDITIONS = {
-        'mailjet': [
-            ('django_email_multibackend.conditions.ExcludeMailByHeader', {'header': ('X-MAIL-TYPE', 'non-transactional')})
-        ]
-    }
+    def acquire(self):
+        with self.lock:
+            self.users += 1
 
-    >>> conditions = get_backend_routing_conditions('mailchimp')
-    >>> conditions[0].params
-    {}
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            unused = self.successor is not None and not self.users and not self.closed
+            if unused:
+                self.closed = True
+        if unused:
+            self.close_dropped()
 
-    >>> conditions = get_backend_routing_conditions('mailjet')
-    >>> conditions[0].params
-    {'header': ('X-MAIL-TYPE', 'non-transactional')}
+    def retire(self, successor):
+        with self.lock:
+            self.successor = successor
+            unused = not self.users and not self.closed
+            if unused:
+                self.closed = True
+        if unused:
+            self.close_dropped()
 
-    """
-    paths_kwargs = conf.EMAIL_BACKENDS_CONDITIONS.get(
-        backend, conf.DEFAULT_CONDITIONS
-    )
-    conditions = []
-    for kls_conf in paths_kwargs:
-        try:
-            kls_name, params = kls_conf
-        except ValueError:
-            kls_name, params = kls_conf[0], {}
-        conditions.append(load_class(kls_name)(**params))
-    return conditions
+    def close_dropped(self):
+        successor_servers = self.successor.servers
+        for backend_key, server in list(self.servers.items()):
+            if dict.get(successor_servers, backend_key) is server:
+                continue
+            try:
+                server.close()
+            except Exception:
+                pass
 
-def load_class(path):
-    """
-    Loads a class from its path
 
-    >>> load_class('django_email_multibackend.conditions.MatchAll')
-    <class 'django_email_multibackend.conditions.MatchAll'>
+class EmailMultiServerBackend(BaseEmailBackend):
     """
-    try:
-        mod_name, klass_name = path.rsplit('.', 1)
-        mod = import_module(mod_name)
-    except ImportError as e:
-        raise ImproperlyConfigured(('Error importing email backend module %s: "%s"'
-                                    % (mod_name, e)))
-    try:
-        klass = getattr(mod, klass_name)
-    except AttributeError:
-        raise ImproperlyConfigured(('Module "%s" does not define a '
-                                    '"%s" class' % (mod_name, klass_name)))
-    return klass
+    Routes every message to one of several backends
 
-class EmailMultiServerBackend(BaseEmailBackend):
+    Options left to None are read from the settings (see conf) when the backend is created.
+    """
 
     def __init__(self, host=None, port=None, username=None, password=None,
-                 use_tls=None, fail_silently=False, backends=conf.EMAIL_BACKENDS,
-                 backend_weights=conf.EMAIL_BACKENDS_WEIGHTS, **kwargs):
+                 use_tls=None, fail_silently=False, backends=None,
+                 backend_weights=None, routing_table=routing_table,
+                 batch_size=None, batch_window=None,
+                 connection_pool=None,
+                 max_workers=None,
+                 max_workers_per_backend=None,
+                 send_timeout=None, failover=None,
+                 circuit_breakers=None, adaptive_weights=None,
+                 rate_limiters=rate_limiters, rate_limit_spillover=None,
+                 metrics=None, split_by_recipient_domain=None,
+                 render_once=None, **kwargs):
 
-        self.servers = {}
-        self.weights = self.backends_weights(
-            backend_weights, backends
-        )
+        self.opened = False
+        self.pinned = False
+        self.reconfigure_lock = threading.Lock()
+        self.rate_limiters = rate_limiters
+        self.rate_limit_spillover = conf.get('EMAIL_BACKENDS_RATE_LIMIT_SPILLOVER', rate_limit_spillover)
+        self.fail_silently = fail_silently
+        self.batch_size = conf.get('EMAIL_BACKENDS_BATCH_SIZE', batch_size)
+        self.batch_window = conf.get('EMAIL_BACKENDS_BATCH_WINDOW', batch_window)
+        self.max_workers = conf.get('EMAIL_BACKENDS_MAX_WORKERS', max_workers)
+        self.max_workers_per_backend = conf.get('EMAIL_BACKENDS_MAX_WORKERS_PER_BACKEND', max_workers_per_backend) or {}
+        self.send_timeout = conf.get('EMAIL_BACKENDS_SEND_TIMEOUT', send_timeout)
+        self.connection_pool = connection_pool or get_connection_pool()
+        self.failover = conf.get('EMAIL_BACKENDS_FAILOVER', failover)
+        self.circuit_breakers = circuit_breakers or get_circuit_breakers()
+        self.adaptive_weights = adaptive_weights or get_adaptive_weights()
+        self.metrics = metrics or get_metrics()
+        self.split_by_recipient_domain = conf.get('EMAIL_BACKENDS_SPLIT_BY_RECIPIENT_DOMAIN', split_by_recipient_domain)
+        self.render_once = conf.get('EMAIL_BACKENDS_RENDER_ONCE', render_once)
+        backends = conf.get('EMAIL_BACKENDS', backends)
+        backend_weights = conf.get('EMAIL_BACKENDS_WEIGHTS', backend_weights)
 
         not_supported_params = (host, port, username, password, use_tls)
 
         if kwargs or any(not_supported_params):
             raise TypeError('You cant initialise this backend with %r' % not_supported_params)
 
+        self.routing = self.build_routing(backends, backend_weights, routing_table)
+
+    # the routing state is read from the current snapshot, see reconfigure
+    weights = property(lambda self: self.routing.weights)
+    routing_table = property(lambda self: self.routing.routing_table)
+    servers = property(lambda self: self.routing.servers)
+    backends_settings = property(lambda self: self.routing.backends_settings)
+    backends_semaphores = property(lambda self: self.routing.backends_semaphores)
+    rate_limits = property(lambda self: self.routing.rate_limits)
+    rendered_backends = property(lambda self: self.routing.rendered_backends)
+
+    def build_routing(self, backends, backend_weights, routing_table, previous=None):
+        """
+        Returns the validated RoutingSnapshot of :backends, :backend_weights and :routing_table; backends
+        whose settings are the same in the :previous snapshot keep their child backend and concurrency limit
+        """
+        weights = tuple(
+            (backend, weight) for backend, weight in self.backends_weights(backend_weights, backends)
+        )
+        routing = RoutingSnapshot(backends, backend_weights, weights, routing_table, None)
+        routing.servers = LazyConnections(lambda backend_key: self.create_server(backend_key, routing))
+
         for backend_key, backend_settings in backends.items():
-            backend_settings['fail_silently'] = fail_silently
-            self.servers[backend_key] = get_connection(**backend_settings)
+            backend_settings, rate_limit = split_rate_limit(backend_settings)
+            backend_settings['fail_silently'] = self.fail_silently
+            if rate_limit is not None:
+                routing.rate_limits[backend_key] = self.rate_limiters.get(backend_key, *rate_limit)
+            routing.backends_settings[backend_key] = backend_settings
+            if previous is not None and previous.backends_settings.get(backend_key) == backend_settings:
+                routing.backends_semaphores[backend_key] = previous.backends_semaphores[backend_key]
+                if dict.__contains__(previous.servers, backend_key):
+                    dict.__setitem__(routing.servers, backend_key, dict.__getitem__(previous.servers, backend_key))
+                continue
+            routing.backends_semaphores[backend_key] = threading.BoundedSemaphore(
+                self.max_workers_per_backend.get(backend_key, 1)
+            )
+
+        self.validate_settings(routing)
+        return routing
+
+    def create_server(self, backend_key, routing=None):
+        """
+        Creates the backend :backend_key, called the first time it is selected
+        """
+        routing = routing or self.routing
+        server = get_connection(**routing.backends_settings[backend_key])
+        if self.opened:
+            server.open()
+        return server
+
+    def reconfigure(self, weights=None, conditions=None, backends=None):
+        """
+        Atomically replaces the weights, routing conditions and/or backends (given like EMAIL_BACKENDS_WEIGHTS,
+        EMAIL_BACKENDS_CONDITIONS and EMAIL_BACKENDS), the ones not given are kept
+
+        The new configuration is validated and its routing compiled before it is swapped in; until then (and
+        if it is not valid) messages are routed as before. Sends already started finish with the configuration
+        they started with. Child backends whose settings did not change are reused with their open connection,
+        the others are closed once the sends using them are done.
+        """
+        with self.reconfigure_lock:
+            current = self.routing
+            if backends is None:
+                backends = current.backends
+            if weights is None:
+                weights = current.backend_weights
+            routing_table = current.routing_table
+            if conditions is not None:
+                routing_table = RoutingTable(
+                    conditions, cache_size=routing_table.cache_size, ordering=routing_table.ordering
+                )
+            routing = self.build_routing(backends, weights, routing_table, current)
+            if conditions is not None:
+                routing_table.reload()
+            # compiled before the swap, not by the first message routed
+            routing_table.get_router(routing.weights)
+            self.routing = routing
+        current.retire(routing)
+        return routing
+
+    def watch(self, path, interval=1.0):
+        """
+        Applies the configuration in the JSON or YAML file :path now and whenever it changes, checking
+        every :interval seconds; returns the started ConfigWatcher (see watcher.load_config for the format)
+        """
+        return ConfigWatcher(self, path, interval).start()
 
-        self.validate_settings()
+    def pin(self):
+        """
+        Returns a copy of the backend bound to the current routing snapshot, unaffected by reconfigure
+        """
+        if self.pinned:
+            return self
+        pinned = copy.copy(self)
+        pinned.pinned = True
+        return pinned
+
+    def open(self):
+        """
+        Opens the connections of the backends created so far, the others are opened when they are created;
+        with a connection pool the pooled connections are warmed up instead
+        """
+        if self.connection_pool is not None:
+            for backend_key, backend_settings in self.backends_settings.items():
+                self.connection_pool.warm(backend_key, backend_settings)
+            return False
+        self.opened = True
+        opened = False
+        for server in list(self.servers.values()):
+            if server.open():
+                opened = True
+        return opened
+
+    def close(self):
+        """
+        Closes the connections of the backends created so far, pooled connections are left open in the pool
+        """
+        if self.connection_pool is not None:
+            return
+        self.opened = False
+        for server in list(self.servers.values()):
+            server.close()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def backends_weights(self, weights, backends):
         return weights or [(k,1) for k in backends.keys()]
 
-    def validate_settings(self):
-        backends, weights = zip(*self.weights)
-        for backend in self.servers.keys():
+    def validate_settings(self, routing=None):
+        routing = routing or self.routing
+        backends, weights = zip(*routing.weights)
+        for backend, backend_settings in routing.backends_settings.items():
             if not backend in backends:
                 raise ImproperlyConfigured('Some of the backends in EMAIL_BACKENDS have not weights defined')
+            # imports the backend class (once per process) without creating the backend
+            backend_class = load_class(backend_settings.get('backend') or settings.EMAIL_BACKEND)
+            if self.render_once is not None and accepts_rendered_messages(backend_class):
+                routing.rendered_backends.add(backend)
 
     def get_backends_for_email(self, mail):
-        backends_weights = []
-        for backend, weight in self.weights:
-            conditions = get_backend_routing_conditions(backend)
-            if all(cond(mail) for cond in conditions):
-                backends_weights.append((backend, weight))
-        return backends_weights
+        routing = self.routing
+        return routing.routing_table.get_backends_for_email(routing.weights, mail, self.metrics)
 
-    def get_backend(self, email):
+    def get_available_backends(self, backends_weights, exclude=()):
+        """
+        Returns the (backend, weight) tuples of :backends_weights not in :exclude, whose circuit is not open
+        and (with rate_limit_spillover) whose rate limit is not exhausted
+        """
+        available = [(backend, weight) for backend, weight in backends_weights if backend not in exclude]
+        if self.circuit_breakers is not None:
+            closed = [
+                (backend, weight) for backend, weight in available
+                if self.circuit_breakers.is_available(backend)
+            ]
+            # when every circuit is open the messages are still sent rather than dropped
+            available = closed or available
+        if self.rate_limit_spillover and self.rate_limits:
+            unthrottled = [
+                (backend, weight) for backend, weight in available
+                if backend not in self.rate_limits or self.rate_limits[backend].has_tokens()
+            ]
+            # when every backend is throttled the send waits for tokens instead
+            available = unthrottled or available
+        return available
+
+    def get_backend_key(self, email, exclude=()):
+        """
+        Chooses the backend for :email, None when every eligible backend is in :exclude
+        """
+        if pre_route.receivers:
+            pre_route.send(sender=self.__class__, message=email)
+        metrics = self.metrics
+        if metrics is not None:
+            started = default_timer()
         backends_weights = self.get_backends_for_email(email)
+        if exclude or self.circuit_breakers is not None or self.rate_limit_spillover:
+            backends_weights = self.get_available_backends(backends_weights, exclude)
+            if exclude and not backends_weights:
+                return None
+        if self.adaptive_weights is not None:
+            backends_weights = self.adaptive_weights.adjust(backends_weights)
+        if metrics is None:
+            return self.choose_backend(backends_weights)
+
+        routed = default_timer()
+        backend_key = self.choose_backend(backends_weights)
+        metrics.record_routing(routed - started, default_timer() - routed)
+        return backend_key
+
+    def choose_backend(self, backends_weights):
+        """
+        Weighted choice among :backends_weights; with circuit breakers a half-open backend is only chosen
+        by the message taking its probe, the others are routed again among the remaining backends
+        """
         backend_key = weighted_choice(backends_weights)
-        return self.servers[backend_key]
+        if self.circuit_breakers is None:
+            return backend_key
+        while len(backends_weights) > 1 and not self.circuit_breakers.acquire(backend_key):
+            backends_weights = [(backend, weight) for backend, weight in backends_weights if backend != backend_key]
+            backend_key = weighted_choice(backends_weights)
+        return backend_key
 
-    def send_messages(self, email_messages):
+    def effective_weights(self):
+        """
+        Returns the weights currently used for the weighted choice, see EMAIL_BACKENDS_ADAPTIVE_WEIGHTS
+        """
+        if self.adaptive_weights is None:
+            return list(self.weights)
+        return self.adaptive_weights.adjust(self.weights)
+
+    def get_backend(self, email):
+        pinned = self.pin()
+        return pinned.servers[pinned.get_backend_key(email)]
+
+    def stats(self):
+        """
+        Returns a snapshot of the routing caches and, when enabled, of the metrics,
+        circuit breakers, adaptive weights and condition order
+        """
+        hits, misses, size = self.routing_table.cache_info()
+        stats = {
+            'routing_cache': {'hits': hits, 'misses': misses, 'size': size},
+            'weighted_choices_cache': {
+                'hits': weighted_choices_cache.hits,
+                'misses': weighted_choices_cache.misses,
+                'size': len(weighted_choices_cache.data),
+            },
+        }
+        if self.metrics is not None:
+            stats.update(self.metrics.snapshot())
+        if self.circuit_breakers is not None:
+            stats['circuits'] = self.circuit_breakers.states()
+        if self.adaptive_weights is not None:
+            stats['effective_weights'] = self.effective_weights()
+        condition_order = self.routing_table.condition_order(backend for backend, weight in self.weights)
+        if condition_order is not None:
+            stats['condition_order'] = condition_order
+        return stats
+
+    def get_chunks(self, email_messages):
+        """
+        Routes :email_messages and yields (backend_key, chunk) tuples where chunk is a list
+        of (position, email) tuples
+
+        Messages are pulled from :email_messages as chunks are consumed. Without a batch_size every
+        message is its own chunk; with a batch_size messages are buffered per backend and a buffer is
+        yielded once it holds batch_size messages or, with a batch_window, when a message comes
+        batch_window seconds after the first one of the buffer. At most batch_size messages per
+        backend are held at any time.
+
+        With split_by_recipient_domain messages are first split per group of recipient domains,
+        positions are then the ones of the parts.
+        """
+        if self.split_by_recipient_domain:
+            email_messages = self.split_messages(email_messages)
+
+        if not self.batch_size:
+            for position, email in enumerate(email_messages):
+                yield self.get_backend_key(email), [(position, email)]
+            return
+
+        # backend_key -> (time of the first message, chunk), oldest first
+        buffers = OrderedDict()
+        for position, email in enumerate(email_messages):
+            backend_key = self.get_backend_key(email)
+            if backend_key not in buffers:
+                buffers[backend_key] = (default_timer(), [])
+            chunk = buffers[backend_key][1]
+            chunk.append((position, email))
+            if len(chunk) >= self.batch_size:
+                del buffers[backend_key]
+                yield backend_key, chunk
+            if self.batch_window is not None:
+                now = default_timer()
+                for expired_key in list(buffers):
+                    if now - buffers[expired_key][0] < self.batch_window:
+                        break
+                    yield expired_key, buffers.pop(expired_key)[1]
+
+        for backend_key, (created_at, chunk) in buffers.items():
+            yield backend_key, chunk
+
+    def split_messages(self, email_messages):
+        """
+        Splits every message of :email_messages in one message per group of recipients matching the
+        same recipient domain conditions, see domains.split_by_domain
+        """
+        domain_sets = self.routing_table.get_domain_sets(tuple(self.weights))
+        for email in email_messages:
+            if not domain_sets or not isinstance(email, EmailMessage):
+                yield email
+                continue
+            for part in split_by_domain(email, domain_sets):
+                yield part
+
+    def send_chunk(self, backend_key, email_messages):
+        if self.connection_pool is not None:
+            return self.connection_pool.send_messages(
+                backend_key, self.backends_settings[backend_key], email_messages
+            ) or 0
+        return self.servers[backend_key].send_messages(email_messages) or 0
+
+    def reserve_tokens(self, backend_key, count):
+        """
+        Takes :count tokens from the rate limit of :backend_key, returns how many seconds to wait before sending
+        """
+        bucket = self.rate_limits.get(backend_key)
+        if bucket is None:
+            return 0
+        return bucket.reserve(count)
+
+    def send_chunk_limited(self, backend_key, email_messages):
+        with self.backends_semaphores[backend_key]:
+            return self.send_chunk(backend_key, email_messages)
+
+    def reroute(self, chunk, exclude):
+        """
+        Routes the messages of :chunk again leaving out the backends in :exclude
+
+        Returns the list of (backend_key, chunk) tuples and the chunk of messages left without a backend.
+        """
+        groups = {}
+        backend_keys = []
+        unrouted = []
+        for position, email in chunk:
+            backend_key = self.get_backend_key(email, exclude)
+            if backend_key is None:
+                unrouted.append((position, email))
+                continue
+            if backend_key not in groups:
+                groups[backend_key] = []
+                backend_keys.append(backend_key)
+            groups[backend_key].append((position, email))
+        return [(backend_key, groups[backend_key]) for backend_key in backend_keys], unrouted
+
+    def record_attempt(self, backend_key, chunk, count, error, latency):
+        success = error is None and count > 0
+        if self.circuit_breakers is not None:
+            self.circuit_breakers.record(backend_key, success)
+        if self.adaptive_weights is not None:
+            self.adaptive_weights.record(backend_key, latency, success, len(chunk))
+        if self.metrics is not None:
+            self.metrics.record_send(backend_key, len(chunk), count, latency, error)
+        if post_send.receivers:
+            post_send.send(
+                sender=self.__class__, backend_key=backend_key, messages=[email for position, email in chunk],
+                count=count, latency=latency, error=error
+            )
+
+    def handle_attempt(self, backend_key, chunk, tried, count, error, previous_error=None, latency=0):
+        """
+        Handles the outcome of sending :chunk to :backend_key, returns the list of delivered
+        (backend_key, chunk, count) tuples and the list of (backend_key, chunk, tried, error) attempts left to do
+
+        With failover a chunk that raised or was reported as not sent is routed again among the eligible
+        backends not tried yet; once none is left the last exception is raised unless fail_silently is set.
+        Without failover exceptions are raised straight away unless fail_silently is set.
+        """
+        self.record_attempt(backend_key, chunk, count, error, latency)
+        if error is not None and not self.failover and not self.fail_silently:
+            raise error
+        if count or not self.failover:
+            return [(backend_key, chunk, count)], []
+
+        error = error or previous_error
+        tried = tried + (backend_key, )
+        rerouted, unrouted = self.reroute(chunk, tried)
+        delivered = []
+        if unrouted:
+            if error is not None and not self.fail_silently:
+                raise error
+            delivered.append((backend_key, unrouted, 0))
+        return delivered, [(next_key, next_chunk, tried, error) for next_key, next_chunk in rerouted]
+
+    def get_messages(self, backend_key, chunk, rendered):
+        """
+        Returns the messages of :chunk to send to :backend_key
+
+        With render_once, backends accepting rendered messages get RenderedMessage proxies, kept in :rendered
+        by position so that every message is rendered once for all the attempts to send it.
+        """
+        if backend_key not in self.rendered_backends:
+            return [email for position, email in chunk]
+        messages = []
+        render_times = []
+        for position, email in chunk:
+            if not isinstance(email, EmailMessage):
+                messages.append(email)
+                continue
+            rendered_message = rendered.get(position)
+            if rendered_message is None:
+                rendered_message = rendered[position] = RenderedMessage(email, **self.render_once)
+                render_times.append(rendered_message.render())
+            messages.append(rendered_message)
+        if self.metrics is not None and render_times:
+            self.metrics.record_render(render_times)
+        return messages
+
+    def deliver(self, backend_key, chunk, send=None):
+        """
+        Sends :chunk to :backend_key (failing over to other backends if enabled) and
+        returns a list of (backend_key, chunk, count) tuples
+        """
+        if not self.pinned:
+            return self.pin().deliver(backend_key, chunk, send)
+        send = send or self.send_chunk
+        delivered = []
+        pending = [(backend_key, chunk, (), None)]
+        rendered = {}
+        routing = self.routing
+        routing.acquire()
+        try:
+            while pending:
+                backend_key, chunk, tried, previous_error = pending.pop(0)
+                wait = self.reserve_tokens(backend_key, len(chunk))
+                if wait:
+                    time.sleep(wait)
+                started = default_timer()
+                try:
+                    messages = self.get_messages(backend_key, chunk, rendered)
+                    # the latency of the backend does not include rendering
+                    started = default_timer()
+                    count, error = send(backend_key, messages), None
+                except Exception as e:
+                    count, error = 0, e
+                attempt_delivered, attempt_pending = self.handle_attempt(
+                    backend_key, chunk, tried, count, error, previous_error, default_timer() - started
+                )
+                delivered.extend(attempt_delivered)
+                pending.extend(attempt_pending)
+        finally:
+            for rendered_message in rendered.values():
+                rendered_message.close()
+            routing.release()
+        return delivered
+
+    def send_chunks(self, chunks):
+        for backend_key, chunk in chunks:
+            for delivered in self.deliver(backend_key, chunk):
+                yield delivered
+
+    def send_chunks_concurrently(self, chunks):
+        """
+        Sends :chunks on a pool of max_workers threads, running at most max_workers_per_backend
+        chunks on the same backend at once, and yields the (backend_key, chunk, count) tuples of the
+        sent chunks as they complete
+
+        Chunks are pulled from :chunks as workers free up, at most 2 * max_workers are pending. A chunk is
+        handed to the pool only once its backend runs less than max_workers_per_backend chunks, so workers
+        are never left waiting for a busy backend while chunks of other backends are pending.
+        Every chunk is attempted even when some raise; afterwards the first exception (in chunk order)
+        is raised again unless fail_silently is set. Chunks not sent within send_timeout seconds raise
+        concurrent.futures.TimeoutError: the ones not started yet are cancelled and count as not sent (0),
+        the ones being sent can not be stopped and may still be delivered, their count is None (unknown).
+        """
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        deadline = None
+        if self.send_timeout is not None:
+            deadline = default_timer() + self.send_timeout
+        pending = {}
+        # backend_key -> (index, chunk) tuples waiting for the backend to have a free slot
+        waiting = {}
+        errors = []
+        try:
+            for index, (backend_key, chunk) in enumerate(chunks):
+                while len(pending) + sum(len(queue) for queue in waiting.values()) >= 2 * self.max_workers:
+                    for sent_chunk in self.wait_chunks(pending, deadline, errors, FIRST_COMPLETED):
+                        yield sent_chunk
+                    for sent_chunk in self.submit_chunks(executor, pending, waiting, deadline, errors):
+                        yield sent_chunk
+                waiting.setdefault(backend_key, deque()).append((index, chunk))
+                for sent_chunk in self.submit_chunks(executor, pending, waiting, deadline, errors):
+                    yield sent_chunk
+            while pending:
+                for sent_chunk in self.wait_chunks(pending, deadline, errors, FIRST_COMPLETED):
+                    yield sent_chunk
+                for sent_chunk in self.submit_chunks(executor, pending, waiting, deadline, errors):
+                    yield sent_chunk
+        finally:
+            executor.shutdown(wait=False)
+
+        if errors and not self.fail_silently:
+            raise min(errors, key=lambda error: error[0])[1]
+
+    def submit_chunks(self, executor, pending, waiting, deadline, errors):
+        """
+        Submits the :waiting chunks of send_chunks_concurrently whose backend has a free slot, yields
+        the ones timed out once past :deadline
+        """
+        running = {}
+        for index, backend_key, chunk in pending.values():
+            running[backend_key] = running.get(backend_key, 0) + 1
+        timed_out = deadline is not None and default_timer() >= deadline
+        for backend_key, queue in waiting.items():
+            limit = max(self.max_workers_per_backend.get(backend_key, 1), 1)
+            while queue and (timed_out or running.get(backend_key, 0) < limit):
+                index, chunk = queue.popleft()
+                if timed_out:
+                    errors.append((index, TimeoutError('Sending to %s timed out' % backend_key)))
+                    yield backend_key, chunk, 0
+                    continue
+                future = executor.submit(self.deliver, backend_key, chunk, self.send_chunk_limited)
+                pending[future] = (index, backend_key, chunk)
+                running[backend_key] = running.get(backend_key, 0) + 1
+
+    def wait_chunks(self, pending, deadline, errors, return_when):
+        """
+        Waits for the :pending futures of send_chunks_concurrently, yields the chunks sent and
+        records the errors of the others (timing out all of them once past :deadline)
+        """
+        timeout = None
+        if deadline is not None:
+            timeout = max(deadline - default_timer(), 0)
+        done, not_done = wait(list(pending), timeout=timeout, return_when=return_when)
+        if deadline is not None and default_timer() >= deadline:
+            for future in not_done:
+                index, backend_key, chunk = pending.pop(future)
+                if future.cancel():
+                    errors.append((index, TimeoutError('Sending to %s timed out' % backend_key)))
+                    yield backend_key, chunk, 0
+                    continue
+                # already running, the send goes on in the background
+                errors.append((index, TimeoutError(
+                    'Sending to %s timed out, the messages may still be delivered' % backend_key
+                )))
+                yield backend_key, chunk, None
+        for future in done:
+            index, backend_key, chunk = pending.pop(future)
+            if future.exception() is not None:
+                errors.append((index, future.exception()))
+                yield backend_key, chunk, 0
+                continue
+            for sent_chunk in future.result():
+                yield sent_chunk
+
+    def collect_results(self, sent_chunks):
+        """
+        Returns the (send_count, results) tuple of :sent_chunks, see dispatch
+        """
         send_count = 0
+        results = []
+        for backend_key, chunk, count in sent_chunks:
+            if count is None:
+                # timed out while being sent
+                results.extend((position, backend_key, None) for position, email in chunk)
+                continue
+            send_count += count
+            if count >= len(chunk):
+                sent = True
+            elif not count:
+                sent = False
+            else:
+                sent = None
+            results.extend((position, backend_key, sent) for position, email in chunk)
+
+        results.sort(key=lambda result: result[0])
+        return send_count, [(backend_key, sent) for position, backend_key, sent in results]
+
+    def dispatch(self, email_messages):
+        """
+        Sends :email_messages and returns a (send_count, results) tuple
 
+        results has one (backend_key, sent) tuple per message in input order; sent is True
+        when the backend reported the message chunk as sent, False when it reported
+        nothing sent and None when only part of the chunk was sent (backends only return a count)
+        or when the chunk timed out while being sent and may still be delivered.
+        """
+        return self.collect_results(self.send_iter(email_messages))
+
+    def send_iter(self, email_messages):
+        """
+        Sends :email_messages, pulling them lazily, and yields the (backend_key, chunk, count)
+        tuple of every chunk sent; count is None for chunks timed out while being sent, see send_chunks_concurrently
+        """
         if not hasattr(email_messages, '__iter__'):
             email_messages = [email_messages]
 
-        for email in email_messages:
-            backend = self.get_backend(email)
-            count = backend.send_messages([email, ])
-            if count:
-                send_count += count
+        # the whole call is routed and sent with the configuration current when it starts
+        pinned = self.pin()
+        routing = pinned.routing
+        routing.acquire()
+        try:
+            chunks = pinned.get_chunks(email_messages)
+            if self.max_workers:
+                sent_chunks = pinned.send_chunks_concurrently(chunks)
+            else:
+                sent_chunks = pinned.send_chunks(chunks)
+            for sent_chunk in sent_chunks:
+                yield sent_chunk
+        finally:
+            routing.release()
+
+    def send_messages(self, email_messages):
+        """
+        Sends :email_messages and returns the number of messages the backends reported as sent;
+        messages are streamed, a generator is never turned into a list
+        """
+        send_count = 0
+        for backend_key, chunk, count in self.send_iter(email_messages):
+            send_count += count or 0
         return send_count
@@ -0,0 +1,262 @@
+"""
+Sends large campaigns on a pool of processes
+
+Messages are cut in shards of consecutive messages, every shard is sent by one of the worker processes,
+each with its own EmailMultiServerBackend kept open for the whole campaign. Workers report how many
+messages each backend sent and failed; the parent adds them up and, with a checkpoint file, records which
+shards are done so that an interrupted campaign can be resumed where it stopped.
+"""
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+from multiprocessing.util import Finalize
+from django_email_multibackend.backends import EmailMultiServerBackend
+from django_email_multibackend.routing import load_class
+from django_email_multibackend.signals import post_send
+
+# most error messages kept in the campaign stats
+MAX_ERRORS = 100
+
+worker_connection = None
+worker_build_message = None
+# errors of the attempts of the current shard, fail_silently keeps them from being raised
+worker_errors = []
+
+
+def init_worker(backend_kwargs, build_message):
+    """
+    Creates and opens the EmailMultiServerBackend of a worker process, closed when the process exits
+    """
+    global worker_connection, worker_build_message
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        # spawned workers start with an empty interpreter
+        django.setup()
+    worker_connection = EmailMultiServerBackend(fail_silently=True, **backend_kwargs)
+    worker_connection.open()
+    post_send.connect(record_error)
+    Finalize(worker_connection, worker_connection.close, exitpriority=10)
+    if isinstance(build_message, str):
+        build_message = load_class(build_message)
+    worker_build_message = build_message
+
+
+def describe_error(backend_key, error):
+    return '%s: %s: %s' % (backend_key, error.__class__.__name__, error)
+
+
+def record_error(sender, backend_key, error, **kwargs):
+    if error is not None:
+        worker_errors.append(describe_error(backend_key, error))
+
+
+def send_shard(items):
+    """
+    Sends the messages built from :items with the backend of the worker process, returns a
+    (backends, failed, errors) tuple where backends maps every backend used to its [sent, failed] counts
+    and failed is the number of messages that could not be built or routed
+    """
+    connection = worker_connection
+    backends = {}
+    errors = []
+    del worker_errors[:]
+    messages = []
+    failed = 0
+    for item in items:
+        if worker_build_message is None:
+            messages.append(item)
+            continue
+        try:
+            messages.append(worker_build_message(item))
+        except Exception as e:
+            failed += 1
+            errors.append(describe_error(None, e))
+
+    handled = 0
+    try:
+        for backend_key, chunk in connection.get_chunks(messages):
+            handled += len(chunk)
+            try:
+                delivered = connection.deliver(backend_key, chunk)
+            except Exception as e:
+                delivered = [(backend_key, chunk, 0)]
+                errors.append(describe_error(backend_key, e))
+            errors.extend(worker_errors)
+            del worker_errors[:]
+            for sent_key, sent_chunk, count in delivered:
+                counts = backends.setdefault(sent_key, [0, 0])
+                counts[0] += count
+                counts[1] += len(sent_chunk) - count
+    except Exception as e:
+        # routing failed, the messages left count as failed
+        failed += len(messages) - handled
+        errors.append(describe_error(None, e))
+    return backends, failed, errors[:MAX_ERRORS]
+
+
+class Campaign(object):
+    """
+    Progress of a campaign: the counts so far and the shards done, saved to :path (a JSON file) when set
+
+    Shards are cut every :shard_size messages. offset is the position of the first message of the first
+    shard not done, done maps the first position of the shards done after it to their length.
+    """
+
+    def __init__(self, path=None, shard_size=1000):
+        self.path = path
+        self.shard_size = shard_size
+        self.offset = 0
+        self.done = {}
+        self.sent = 0
+        self.failed = 0
+        self.backends = {}
+        self.errors = []
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path) as checkpoint_file:
+            state = json.load(checkpoint_file)
+        # shards must be cut as in the interrupted run
+        self.shard_size = state['shard_size']
+        self.offset = state['offset']
+        self.done = dict((start, length) for start, length in state['done'])
+        self.sent = state['sent']
+        self.failed = state['failed']
+        self.backends = state['backends']
+        self.errors = state['errors']
+
+    def save(self):
+        if self.path is None:
+            return
+        state = {
+            'shard_size': self.shard_size,
+            'offset': self.offset,
+            'done': sorted(self.done.items()),
+            'sent': self.sent,
+            'failed': self.failed,
+            'backends': self.backends,
+            'errors': self.errors,
+        }
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(tmp_path, self.path)
+
+    def get_shards(self, items):
+        """
+        Yields the (start, items) shards of :items not done yet
+        """
+        shard_start = None
+        shard = []
+        for position, item in enumerate(islice(items, self.offset, None), self.offset):
+            start = position - position % self.shard_size
+            if start in self.done:
+                continue
+            if shard and start != shard_start:
+                yield shard_start, shard
+                shard = []
+            shard_start = start
+            shard.append(item)
+        if shard:
+            yield shard_start, shard
+
+    def complete(self, start, length, backends, failed, errors):
+        for backend_key, (backend_sent, backend_failed) in backends.items():
+            counts = self.backends.setdefault(backend_key, {'sent': 0, 'failed': 0})
+            counts['sent'] += backend_sent
+            counts['failed'] += backend_failed
+            self.sent += backend_sent
+            self.failed += backend_failed
+        self.failed += failed
+        self.errors.extend(errors[:MAX_ERRORS - len(self.errors)])
+        self.done[start] = length
+        while self.offset in self.done:
+            self.offset += self.done.pop(self.offset)
+        self.save()
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'backends': dict((key, dict(counts)) for key, counts in self.backends.items()),
+            'errors': list(self.errors),
+        }
+
+
+def get_items(source):
+    """
+    Returns the iterable of :source, a callable returning the messages (or the items to build them from),
+    a queryset (iterated without caching its results) or any iterable
+    """
+    if callable(source):
+        source = source()
+    iterator = getattr(source, 'iterator', None)
+    if iterator is not None:
+        return iterator()
+    return iter(source)
+
+
+def send_campaign(source, processes=None, shard_size=1000, checkpoint=None, build_message=None,
+                  backend_kwargs=None, mp_context=None):
+    """
+    Sends the messages of :source (see get_items) on :processes worker processes (one per CPU by default)
+    and returns the campaign stats: sent and failed totals, per backend counts and the first errors
+
+    Every worker sends shards of :shard_size messages with its own EmailMultiServerBackend created with
+    :backend_kwargs and fail_silently (which :backend_kwargs can not set): failures are counted instead of raised.
+    :build_message (a function or its dotted path, called in the workers) turns every item of :source in an
+    EmailMessage, eg. a model instance.
+
+    With a :checkpoint path, progress is saved after every shard and a campaign started again with the same
+    checkpoint skips the shards already done; the stats then include the ones of the previous runs.
+    At most 2 * processes shards are pending, so :source is never materialized.
+    """
+    backend_kwargs = backend_kwargs or {}
+    if 'fail_silently' in backend_kwargs:
+        raise TypeError('Campaign backends always fail silently, remove fail_silently from %r' % backend_kwargs)
+    processes = processes or os.cpu_count() or 1
+    campaign = Campaign(checkpoint, shard_size)
+    executor = ProcessPoolExecutor(
+        max_workers=processes, mp_context=mp_context, initializer=init_worker,
+        initargs=(backend_kwargs, build_message)
+    )
+    pending = {}
+    try:
+        for start, shard in campaign.get_shards(get_items(source)):
+            if len(pending) >= 2 * processes:
+                wait_shards(campaign, pending, FIRST_COMPLETED)
+            pending[executor.submit(send_shard, shard)] = (start, len(shard))
+        while pending:
+            wait_shards(campaign, pending, FIRST_COMPLETED)
+    finally:
+        # on interruption the shards already started are still recorded
+        for future in pending:
+            future.cancel()
+        while pending:
+            wait_shards(campaign, pending, FIRST_COMPLETED, raise_errors=False)
+        executor.shutdown()
+    return campaign.stats()
+
+
+def wait_shards(campaign, pending, return_when, raise_errors=True):
+    """
+    Waits for the :pending futures of send_campaign and records the shards sent
+    """
+    done, not_done = wait(list(pending), return_when=return_when)
+    errors = []
+    for future in done:
+        start, length = pending.pop(future)
+        if future.cancelled():
+            continue
+        if future.exception() is not None:
+            # the worker process died, the shard is sent again on resume
+            errors.append(future.exception())
+            continue
+        campaign.complete(start, length, *future.result())
+    if errors and raise_errors:
+        raise errors[0]
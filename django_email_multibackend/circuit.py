@@ -0,0 +1,139 @@
+import threading
+import time
+from django_email_multibackend import conf
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """
+    Keeps track of the failures of a backend
+
+    After :failure_threshold consecutive failures the circuit opens and the backend is
+    left out of the weighted choice; once :reset_timeout seconds have passed the circuit is
+    half-open and a single probe is let through (see acquire): a success closes the circuit,
+    a failure opens it again. A probe that reports nothing within :reset_timeout seconds is given up.
+
+    >>> clock = [0]
+    >>> breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: clock[0])
+    >>> breaker.record_failure(); breaker.record_failure(); breaker.state
+    'open'
+    >>> breaker.is_available()
+    False
+    >>> clock[0] = 10
+    >>> breaker.acquire(), breaker.acquire(), breaker.state
+    (True, False, 'half-open')
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.time):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        # when the probe in flight was let through, None without probe
+        self.probing = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return CLOSED
+        if self.probing is not None or self.clock() - self.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def can_probe(self, opened_at, probing, now):
+        if now - opened_at < self.reset_timeout:
+            return False
+        return probing is None or now - probing >= self.reset_timeout
+
+    def is_available(self):
+        """
+        Returns whether the backend can be chosen: the circuit is closed or half-open without a probe in flight
+        """
+        opened_at, probing = self.opened_at, self.probing
+        if opened_at is None:
+            return True
+        return self.can_probe(opened_at, probing, self.clock())
+
+    def acquire(self):
+        """
+        Returns whether a message can be sent to the backend, taking the probe when the circuit is half-open
+        """
+        if self.opened_at is None:
+            return True
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            now = self.clock()
+            if not self.can_probe(self.opened_at, self.probing, now):
+                return False
+            self.probing = now
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                # a failed probe re-opens the circuit for another reset_timeout
+                self.opened_at = self.clock()
+                self.probing = None
+
+
+class CircuitBreakers(object):
+    """
+    The circuit breakers of all backends, created on first use
+    """
+
+    def __init__(self, **options):
+        self.options = options
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, backend_key):
+        breaker = self.breakers.get(backend_key)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(backend_key, CircuitBreaker(**self.options))
+        return breaker
+
+    def is_available(self, backend_key):
+        return self.get(backend_key).is_available()
+
+    def acquire(self, backend_key):
+        return self.get(backend_key).acquire()
+
+    def record(self, backend_key, success):
+        if success:
+            self.get(backend_key).record_success()
+        else:
+            self.get(backend_key).record_failure()
+
+    def states(self):
+        return dict((backend_key, breaker.state) for backend_key, breaker in self.breakers.items())
+
+
+_circuit_breakers = None
+_circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breakers():
+    """
+    Returns the process-wide circuit breakers configured with EMAIL_BACKENDS_CIRCUIT_BREAKER,
+    None when circuit breaking is disabled
+    """
+    global _circuit_breakers
+    if conf.EMAIL_BACKENDS_CIRCUIT_BREAKER is None:
+        return None
+    with _circuit_breakers_lock:
+        if _circuit_breakers is None:
+            _circuit_breakers = CircuitBreakers(**conf.EMAIL_BACKENDS_CIRCUIT_BREAKER)
+    return _circuit_breakers
@@ -0,0 +1,320 @@
+"""
+Compiles the routing conditions of a set of backends into a single generated function
+
+Conditions describe themselves with get_clause, returning one of:
+
+    ('true', )                     always matches
+    ('false', )                    never matches
+    ('in', header, values)         the header is set to one of :values (a frozenset)
+    ('not in', header, values)     the header is not set to any of :values
+    ('any', clauses)               one of :clauses matches
+    ('all', clauses)               all :clauses match
+    ('call', condition)            evaluates :condition, the fallback for conditions without a clause
+
+A clause (and the headers of get_headers) is only used when defined along with the check of the condition
+or below it: a subclass overriding check alone is called, not described by the clause of its parent.
+
+Header names in clauses are lowercase, they are matched case insensitively.
+
+Clauses are simplified (eg. header checks on the same header are merged in a single set lookup) and
+turned into one Python expression per backend; backends with the same expression share its result.
+Backends only checking header values are looked up in a HeaderIndex instead.
+
+Routers tell how many checks (header lookups and condition calls) they make for a message in their
+checks attribute, and how many of those are condition calls in calls.
+"""
+from django_email_multibackend.index import HeaderIndex, get_header_checks, normalize_headers, unset
+# number of header only backends from which they are looked up in a HeaderIndex
+INDEX_THRESHOLD = 32
+
+TRUE = ('true', )
+FALSE = ('false', )
+
+
+def describes_check(condition, name):
+    """
+    Returns whether the :name method of :condition (get_clause or get_headers) describes its check, ie. the
+    closest class defining one of them is not a subclass overriding check alone
+
+    >>> from django_email_multibackend.conditions import FilterMailByHeader
+    >>> class PrefixCondition(FilterMailByHeader):
+    ...     def check(self, message):
+    ...         return message.extra_headers.get('X-MAIL-TYPE', '').startswith('trans')
+    >>> describes_check(FilterMailByHeader(header=('X-MAIL-TYPE', 'a')), 'get_clause')
+    True
+    >>> describes_check(PrefixCondition(header=('X-MAIL-TYPE', 'a')), 'get_clause')
+    False
+    """
+    for cls in type(condition).__mro__:
+        if name in vars(cls) or 'check' in vars(cls):
+            return name in vars(cls)
+    return True
+
+
+def get_clause(condition):
+    """
+    Returns the clause of :condition, a call of the condition when it does not provide one
+    """
+    get_condition_clause = getattr(condition, 'get_clause', None)
+    if not describes_check(condition, 'get_clause'):
+        get_condition_clause = None
+    clause = get_condition_clause() if get_condition_clause is not None else None
+    if clause is None:
+        return ('call', condition)
+    return clause
+
+
+def count_checks(clause, kinds=('in', 'not in', 'call')):
+    """
+    Returns the number of checks of the :kinds the expression of :clause is made of
+
+    >>> count_checks(('all', [('in', 'x-mail-type', frozenset(['a'])), ('call', None)]))
+    2
+    >>> count_checks(('any', [('in', 'x-mail-type', frozenset(['a'])), ('call', None)]), kinds=('call', ))
+    1
+    """
+    if clause[0] in ('any', 'all'):
+        return sum(count_checks(nested, kinds) for nested in clause[1])
+    return 1 if clause[0] in kinds else 0
+
+
+def header_values(value):
+    """
+    Returns the frozenset of the header value :value, None when it is not hashable
+
+    >>> header_values('weekly-mail')
+    frozenset({'weekly-mail'})
+    >>> header_values(['weekly-mail']) is None
+    True
+    """
+    try:
+        return frozenset([value])
+    except TypeError:
+        return None
+
+
+def merge(kind, clauses):
+    """
+    Flattens and simplifies the clauses of an 'all' or 'any' clause
+
+    >>> merge('any', [('in', 'X-MAIL-TYPE', frozenset(['a'])), ('in', 'X-MAIL-TYPE', frozenset(['b']))])[2] == frozenset(['a', 'b'])
+    True
+    >>> merge('all', [('in', 'X-MAIL-TYPE', frozenset(['a'])), ('in', 'X-MAIL-TYPE', frozenset(['b']))])
+    ('false',)
+    """
+    # the clause deciding the result on its own and the one that can be dropped
+    absorbing, neutral = (FALSE, TRUE) if kind == 'all' else (TRUE, FALSE)
+    merged = []
+    positions = {}
+    for clause in clauses:
+        clause = simplify(clause)
+        if clause == neutral:
+            continue
+        if clause == absorbing:
+            return absorbing
+        for nested in (clause[1] if clause[0] == kind else [clause]):
+            if nested[0] not in ('in', 'not in'):
+                merged.append(nested)
+                continue
+            key = nested[:2]
+            if key not in positions:
+                positions[key] = len(merged)
+                merged.append(nested)
+                continue
+            values = merged[positions[key]][2]
+            # all of 'in' and any of 'not in' hold for the common values, the others for either
+            if (kind == 'all') == (nested[0] == 'in'):
+                values = values & nested[2]
+            else:
+                values = values | nested[2]
+            merged[positions[key]] = key + (values, )
+
+    simplified = []
+    for clause in merged:
+        clause = simplify(clause)
+        if clause == neutral:
+            continue
+        if clause == absorbing:
+            return absorbing
+        simplified.append(clause)
+    if not simplified:
+        return neutral
+    if len(simplified) == 1:
+        return simplified[0]
+    return (kind, simplified)
+
+
+def simplify(clause):
+    if clause[0] in ('all', 'any'):
+        return merge(clause[0], clause[1])
+    if clause[0] == 'not in' and not clause[2]:
+        return TRUE
+    if clause[0] == 'in' and not clause[2]:
+        return FALSE
+    return clause
+
+
+class RouterBuilder(object):
+    """
+    Generates the source of a router function, keeping the constants it refers to in a namespace
+    """
+
+    def __init__(self):
+        self.namespace = {'unset': unset, 'normalize_headers': normalize_headers}
+        self.constants = {}
+        self.headers = []
+
+    def constant(self, prefix, value):
+        if prefix == 'c':
+            # conditions are never shared, equal or not
+            key = (prefix, id(value))
+        else:
+            key = (prefix, value)
+        name = self.constants.get(key)
+        if name is None:
+            name = self.constants[key] = '%s%d' % (prefix, len(self.constants))
+            self.namespace[name] = value
+        return name
+
+    def define(self, lines):
+        """
+        Compiles the function defined by the source :lines
+        """
+        source = '\n'.join(lines) + '\n'
+        exec(compile(source, '<email routing>', 'exec'), self.namespace)
+        function = self.namespace[lines[0].split()[1].split('(')[0]]
+        function.source = source
+        return function
+
+    def header(self, header):
+        header = header.lower()
+        if header not in self.headers:
+            self.headers.append(header)
+        return 'h%d' % self.headers.index(header)
+
+    def expression(self, clause):
+        kind = clause[0]
+        if kind == 'true':
+            return 'True'
+        if kind == 'false':
+            return 'False'
+        if kind in ('in', 'not in'):
+            return '%s %s %s' % (self.header(clause[1]), kind, self.constant('k', clause[2]))
+        if kind in ('any', 'all'):
+            operator = ' or ' if kind == 'any' else ' and '
+            return '(%s)' % operator.join(self.expression(nested) for nested in clause[1])
+        return '%s(message)' % self.constant('c', get_callable(clause[1]))
+
+
+def get_callable(condition):
+    """
+    Returns the function evaluating :condition on a message already known to be an EmailMessage
+    """
+    from django_email_multibackend.conditions import BaseCondition
+    if isinstance(condition, BaseCondition) and type(condition).__call__ is BaseCondition.__call__:
+        # skips the type check of BaseCondition.__call__, done once by the caller
+        return condition.check
+    return condition
+
+
+def compile_router(backends_conditions, index_threshold=INDEX_THRESHOLD):
+    """
+    Compiles :backends_conditions, a list of ((backend, weight), conditions) tuples, into a function returning
+    the (backend, weight) tuples matching an EmailMessage, or None when a header value is not hashable
+
+    Backends only checking header values are indexed when there are at least :index_threshold of them.
+
+    >>> from django_email_multibackend.conditions import ExcludeMailByHeader, FilterMailByHeader, MatchAny
+    >>> from django.core.mail import EmailMessage
+    >>> router = compile_router([
+    ...     (('mailjet', 1), [ExcludeMailByHeader(header=('X-MAIL-TYPE', 'non-transactional'))]),
+    ...     (('mailchimp', 1), [MatchAny(conditions=[
+    ...         ('django_email_multibackend.conditions.FilterMailByHeader', {'header': ('X-MAIL-TYPE', 'daily')}),
+    ...         ('django_email_multibackend.conditions.FilterMailByHeader', {'header': ('X-MAIL-TYPE', 'weekly')}),
+    ...     ])]),
+    ... ])
+    >>> mail = EmailMessage()
+    >>> mail.extra_headers['X-MAIL-TYPE'] = 'weekly'
+    >>> router(mail)
+    [('mailjet', 1), ('mailchimp', 1)]
+    """
+    builder = RouterBuilder()
+    clauses = []
+    indexed = []
+    for backend_weight, conditions in backends_conditions:
+        clause = merge('all', [get_clause(condition) for condition in conditions])
+        clauses.append((backend_weight, clause))
+        if clause != TRUE and get_header_checks(clause) is not None:
+            indexed.append(backend_weight)
+
+    index = None
+    if indexed and len(indexed) >= index_threshold:
+        index = HeaderIndex([backend_weight for backend_weight, clause in clauses])
+    expressions = []
+    # the clause of every distinct expression, evaluated once
+    expression_clauses = {}
+    indexed_headers = set()
+    for backend_weight, clause in clauses:
+        if index is not None and backend_weight in indexed:
+            header_checks = get_header_checks(clause)
+            index.add(backend_weight[0], header_checks)
+            indexed_headers.update(header for kind, header, values in header_checks)
+            expression = '%s not in rejected' % builder.constant('r', backend_weight[0])
+        else:
+            expression = builder.expression(clause)
+            expression_clauses[expression] = clause
+        expressions.append((backend_weight, expression))
+
+    uses = {}
+    for backend_weight, expression in expressions:
+        uses[expression] = uses.get(expression, 0) + 1
+    # the index makes one lookup per indexed header
+    checks = len(indexed_headers) + sum(count_checks(clause) for clause in expression_clauses.values())
+    calls = sum(count_checks(clause, ('call', )) for clause in expression_clauses.values())
+
+    lines = ['def router(message):', '    headers = normalize_headers(message.extra_headers)']
+    if index is not None and all(
+            clause == TRUE or backend_weight in indexed for backend_weight, clause in clauses):
+        # only header checks, the index computes the whole result
+        lines.extend([
+            '    try:',
+            '        return %s(headers)' % builder.constant('i', index.select),
+            '    except TypeError:',
+            '        return None',
+        ])
+        return define_router(builder, lines, checks, calls)
+    for position, header in enumerate(builder.headers):
+        lines.append('    h%d = headers.get(%s, unset)' % (position, builder.constant('n', header)))
+    if builder.headers:
+        lines.extend([
+            '    try:',
+            '        hash((%s, ))' % ', '.join('h%d' % position for position in range(len(builder.headers))),
+            '    except TypeError:',
+            '        return None',
+        ])
+    if index is not None:
+        lines.extend([
+            '    try:',
+            '        rejected = %s(headers)' % builder.constant('i', index.get_rejected),
+            '    except TypeError:',
+            '        return None',
+        ])
+    lines.append('    matched = []')
+    shared = {}
+    for backend_weight, expression in expressions:
+        if uses[expression] > 1:
+            if expression not in shared:
+                shared[expression] = 'b%d' % len(shared)
+                lines.append('    %s = %s' % (shared[expression], expression))
+            expression = shared[expression]
+        lines.append('    if %s:' % expression)
+        lines.append('        matched.append(%s)' % builder.constant('w', backend_weight))
+    lines.append('    return matched')
+    return define_router(builder, lines, checks, calls)
+
+
+def define_router(builder, lines, checks, calls):
+    router = builder.define(lines)
+    router.checks = checks
+    router.calls = calls
+    return router
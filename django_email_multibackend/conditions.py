@@ -1,4 +1,8 @@
 from django.core.mail import EmailMessage
+from django_email_multibackend.compiler import TRUE, get_clause, header_values
+from django_email_multibackend.domains import RECIPIENT_FIELDS, DomainSet, get_domain, get_recipients
+from django_email_multibackend.index import normalize_headers
+from django_email_multibackend.routing import get_condition_headers, load_conditions
 
 
 class BaseCondition(object):
@@ -14,10 +18,33 @@ class BaseCondition(object):
     def check(self, message):
         raise NotImplementedError
 
+    def get_headers(self):
+        """
+        Returns the names of the headers the condition depends on
+
+        Returning None (the default) means the condition may depend on anything and
+        its result is never cached.
+        """
+        return None
+
+    def get_clause(self):
+        """
+        Returns the clause the condition compiles to (see django_email_multibackend.compiler)
+
+        Returning None (the default) means the condition is called as it is.
+        """
+        return None
+
 class MatchAll(BaseCondition):
     def check(self, message):
         return True
 
+    def get_headers(self):
+        return ()
+
+    def get_clause(self):
+        return TRUE
+
 class MatchAny(BaseCondition):
     """
     >>> mail = EmailMessage()
@@ -33,14 +60,7 @@ class MatchAny(BaseCondition):
     """
 
     def __init__(self, conditions):
-        from django_email_multibackend.backends import load_class
-        self.conditions = []
-        for condition in conditions:
-            try:
-                kls_name, params = condition
-            except ValueError:
-                kls_name, params = condition[0], {}
-            self.conditions.append(load_class(kls_name)(**params))
+        self.conditions = load_conditions(conditions)
 
     def check(self, message):
         for condition in self.conditions:
@@ -48,6 +68,18 @@ class MatchAny(BaseCondition):
                 return True
         return False
 
+    def get_headers(self):
+        headers = set()
+        for condition in self.conditions:
+            condition_headers = get_condition_headers(condition)
+            if condition_headers is None:
+                return None
+            headers.update(condition_headers)
+        return tuple(headers)
+
+    def get_clause(self):
+        return ('any', [get_clause(condition) for condition in self.conditions])
+
 class FilterMailByHeader(BaseCondition):
     """
     Filter emails by headers
@@ -62,14 +94,29 @@ class FilterMailByHeader(BaseCondition):
     False
     >>> FilterMailByHeader(header=('X-TRANSACTION-ID', '999'))(mail)
     False
+    >>> FilterMailByHeader(header=('x-campaign-name', 'weekly-mail'))(mail)
+    True
     """
 
     def check(self, message):
         unset = dict()
         header_name, header_value = self.params['header']
         mail_header_value = message.extra_headers.get(header_name, unset)
+        if mail_header_value is unset:
+            # header names are case insensitive
+            mail_header_value = normalize_headers(message.extra_headers).get(header_name.lower(), unset)
         return (not mail_header_value is unset) and (mail_header_value == header_value)
 
+    def get_headers(self):
+        return (self.params['header'][0], )
+
+    def get_clause(self):
+        header_name, header_value = self.params['header']
+        values = header_values(header_value)
+        if values is None:
+            return None
+        return ('in', header_name.lower(), values)
+
 class ExcludeMailByHeader(FilterMailByHeader):
     """
     Exclude emails by headers
@@ -89,3 +136,58 @@ class ExcludeMailByHeader(FilterMailByHeader):
     def check(self, message):
         return not super(ExcludeMailByHeader, self).check(message)
 
+    def get_headers(self):
+        return super(ExcludeMailByHeader, self).get_headers()
+
+    def get_clause(self):
+        clause = super(ExcludeMailByHeader, self).get_clause()
+        if clause is None:
+            return None
+        return ('not in', ) + clause[1:]
+
+
+class FilterMailByRecipientDomain(BaseCondition):
+    """
+    Filter emails by the domain of their recipients: matches when one of the recipients in
+    :fields (to, cc and bcc by default) has one of :domains, or of the domains listed in :domains_file
+
+    Domains are matched exactly, '*.example.com' matches the subdomains of example.com and
+    '.example.com' example.com and its subdomains (see django_email_multibackend.domains.DomainSet).
+
+    >>> mail = EmailMessage(to=['someone@example.com'], bcc=['someone@mail.yahoo.com'])
+
+    >>> FilterMailByRecipientDomain(domains=['gmail.com', '*.yahoo.com'])(mail)
+    True
+    >>> FilterMailByRecipientDomain(domains=['gmail.com', '*.yahoo.com'], fields=('to', 'cc'))(mail)
+    False
+    """
+
+    def __init__(self, domains=(), domains_file=None, fields=RECIPIENT_FIELDS):
+        super(FilterMailByRecipientDomain, self).__init__(domains=domains, domains_file=domains_file, fields=fields)
+        self.domains = DomainSet(domains)
+        if domains_file is not None:
+            self.domains.load(domains_file)
+        self.fields = tuple(fields)
+
+    def check(self, message):
+        domains = self.domains
+        for recipient in get_recipients(message, self.fields):
+            domain = get_domain(recipient)
+            if domain is not None and domain in domains:
+                return True
+        return False
+
+class ExcludeMailByRecipientDomain(FilterMailByRecipientDomain):
+    """
+    Exclude emails sent to one of :domains, see FilterMailByRecipientDomain
+
+    >>> mail = EmailMessage(to=['someone@example.com', 'someone@gmail.com'])
+
+    >>> ExcludeMailByRecipientDomain(domains=['gmail.com'])(mail)
+    False
+    >>> ExcludeMailByRecipientDomain(domains=['hotmail.com'])(mail)
+    True
+    """
+
+    def check(self, message):
+        return not super(ExcludeMailByRecipientDomain, self).check(message)
@@ -1,9 +1,78 @@
 from django.conf import settings
 
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
 DEFAULT_CONDITIONS = [
     ('django_email_multibackend.conditions.MatchAll', {})
 ]
 
 EMAIL_BACKENDS_CONDITIONS = getattr(settings, 'EMAIL_BACKENDS_CONDITIONS', {})
 EMAIL_BACKENDS_WEIGHTS = getattr(settings, 'EMAIL_BACKENDS_WEIGHTS', tuple())
-EMAIL_BACKENDS = getattr(settings, 'EMAIL_BACKENDS', {})
\ No newline at end of file
+EMAIL_BACKENDS = getattr(settings, 'EMAIL_BACKENDS', {})
+EMAIL_BACKENDS_BATCH_SIZE = getattr(settings, 'EMAIL_BACKENDS_BATCH_SIZE', None)
+EMAIL_BACKENDS_BATCH_WINDOW = getattr(settings, 'EMAIL_BACKENDS_BATCH_WINDOW', None)
+EMAIL_BACKENDS_POOL = getattr(settings, 'EMAIL_BACKENDS_POOL', None)
+EMAIL_BACKENDS_ROUTING_CACHE_SIZE = getattr(settings, 'EMAIL_BACKENDS_ROUTING_CACHE_SIZE', 1024)
+EMAIL_BACKENDS_MAX_WORKERS = getattr(settings, 'EMAIL_BACKENDS_MAX_WORKERS', None)
+EMAIL_BACKENDS_MAX_WORKERS_PER_BACKEND = getattr(settings, 'EMAIL_BACKENDS_MAX_WORKERS_PER_BACKEND', {})
+EMAIL_BACKENDS_SEND_TIMEOUT = getattr(settings, 'EMAIL_BACKENDS_SEND_TIMEOUT', None)
+EMAIL_BACKENDS_FAILOVER = getattr(settings, 'EMAIL_BACKENDS_FAILOVER', False)
+EMAIL_BACKENDS_CIRCUIT_BREAKER = getattr(settings, 'EMAIL_BACKENDS_CIRCUIT_BREAKER', None)
+EMAIL_BACKENDS_ADAPTIVE_WEIGHTS = getattr(settings, 'EMAIL_BACKENDS_ADAPTIVE_WEIGHTS', None)
+EMAIL_BACKENDS_RATE_LIMIT_SPILLOVER = getattr(settings, 'EMAIL_BACKENDS_RATE_LIMIT_SPILLOVER', False)
+EMAIL_BACKENDS_QUEUE = getattr(settings, 'EMAIL_BACKENDS_QUEUE', None)
+EMAIL_BACKENDS_SPOOL = getattr(settings, 'EMAIL_BACKENDS_SPOOL', None)
+EMAIL_BACKENDS_METRICS = getattr(settings, 'EMAIL_BACKENDS_METRICS', False)
+EMAIL_BACKENDS_CONDITION_ORDERING = getattr(settings, 'EMAIL_BACKENDS_CONDITION_ORDERING', None)
+EMAIL_BACKENDS_SPLIT_BY_RECIPIENT_DOMAIN = getattr(settings, 'EMAIL_BACKENDS_SPLIT_BY_RECIPIENT_DOMAIN', False)
+EMAIL_BACKENDS_RENDER_ONCE = getattr(settings, 'EMAIL_BACKENDS_RENDER_ONCE', None)
+
+SETTINGS_DEFAULTS = {
+    'EMAIL_BACKENDS_CONDITIONS': {},
+    'EMAIL_BACKENDS_WEIGHTS': tuple(),
+    'EMAIL_BACKENDS': {},
+    'EMAIL_BACKENDS_BATCH_SIZE': None,
+    'EMAIL_BACKENDS_BATCH_WINDOW': None,
+    'EMAIL_BACKENDS_POOL': None,
+    'EMAIL_BACKENDS_ROUTING_CACHE_SIZE': 1024,
+    'EMAIL_BACKENDS_MAX_WORKERS': None,
+    'EMAIL_BACKENDS_MAX_WORKERS_PER_BACKEND': {},
+    'EMAIL_BACKENDS_SEND_TIMEOUT': None,
+    'EMAIL_BACKENDS_FAILOVER': False,
+    'EMAIL_BACKENDS_CIRCUIT_BREAKER': None,
+    'EMAIL_BACKENDS_ADAPTIVE_WEIGHTS': None,
+    'EMAIL_BACKENDS_RATE_LIMIT_SPILLOVER': False,
+    'EMAIL_BACKENDS_QUEUE': None,
+    'EMAIL_BACKENDS_SPOOL': None,
+    'EMAIL_BACKENDS_METRICS': False,
+    'EMAIL_BACKENDS_CONDITION_ORDERING': None,
+    'EMAIL_BACKENDS_SPLIT_BY_RECIPIENT_DOMAIN': False,
+    'EMAIL_BACKENDS_RENDER_ONCE': None,
+}
+
+
+def update_conf(sender, setting, value, **kwargs):
+    """
+    Keeps this module in sync with settings changed at runtime (eg. override_settings)
+    """
+    if setting in SETTINGS_DEFAULTS:
+        if value is None:
+            value = SETTINGS_DEFAULTS[setting]
+        globals()[setting] = value
+
+setting_changed.connect(update_conf)
+
+
+def get(setting, value=None):
+    """
+    Returns :value, or the current value of :setting when it is None
+
+    >>> get('EMAIL_BACKENDS_FAILOVER'), get('EMAIL_BACKENDS_FAILOVER', True)
+    (False, True)
+    """
+    if value is None:
+        return globals()[setting]
+    return value
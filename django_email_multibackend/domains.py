@@ -0,0 +1,127 @@
+import copy
+from email.utils import parseaddr
+
+RECIPIENT_FIELDS = ('to', 'cc', 'bcc')
+
+
+def get_domain(address):
+    """
+    Returns the lowercase domain of the email :address, None when it has none
+
+    >>> get_domain('Thierry <Tbarbugli@GMail.com>')
+    'gmail.com'
+    >>> get_domain('postmaster') is None
+    True
+    """
+    name, email = parseaddr(address)
+    if '@' not in email:
+        return None
+    return email.rsplit('@', 1)[1].strip().rstrip('.').lower() or None
+
+
+class DomainSet(object):
+    """
+    A set of domains looked up in constant time per domain label
+
+    'example.com' matches example.com only, '*.example.com' matches its subdomains (not example.com)
+    and '.example.com' both.
+
+    >>> domains = DomainSet(['gmail.com', '*.yahoo.com', '.hotmail.com'])
+    >>> [domain in domains for domain in ('gmail.com', 'mail.gmail.com', 'yahoo.com', 'mail.yahoo.com')]
+    [True, False, False, True]
+    >>> [domain in domains for domain in ('hotmail.com', 'eu.mail.hotmail.com', 'nothotmail.com')]
+    [True, True, False]
+    """
+
+    def __init__(self, domains=()):
+        self.domains = set()
+        self.parents = set()
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain):
+        domain = domain.strip().rstrip('.').lower()
+        if not domain or domain.startswith('#'):
+            return
+        if domain.startswith('*.'):
+            self.parents.add(domain[2:])
+        elif domain.startswith('.'):
+            self.parents.add(domain[1:])
+            self.domains.add(domain[1:])
+        else:
+            self.domains.add(domain)
+
+    def __contains__(self, domain):
+        if domain in self.domains:
+            return True
+        if not self.parents:
+            return False
+        position = domain.find('.')
+        while position != -1:
+            if domain[position + 1:] in self.parents:
+                return True
+            position = domain.find('.', position + 1)
+        return False
+
+    def __len__(self):
+        return len(self.domains) + len(self.parents)
+
+    def load(self, path):
+        """
+        Adds the domains listed one per line in :path, lines starting with # are ignored
+        """
+        with open(path) as domains_file:
+            for line in domains_file:
+                self.add(line)
+
+
+def get_recipients(message, fields=RECIPIENT_FIELDS):
+    recipients = []
+    for field in fields:
+        recipients.extend(getattr(message, field, None) or ())
+    return recipients
+
+
+def get_domain_sets(conditions):
+    """
+    Returns the DomainSet of every recipient domain condition in :conditions, MatchAny included
+    """
+    domain_sets = []
+    for condition in conditions:
+        domains = getattr(condition, 'domains', None)
+        if isinstance(domains, DomainSet):
+            domain_sets.append(domains)
+        domain_sets.extend(get_domain_sets(getattr(condition, 'conditions', ())))
+    return domain_sets
+
+
+def split_by_domain(message, domain_sets):
+    """
+    Splits :message in one message per group of recipients whose domains belong to the same :domain_sets,
+    returns [message] when all recipients are in the same group
+
+    >>> from django.core.mail import EmailMessage
+    >>> message = EmailMessage(to=['a@gmail.com', 'b@example.com'], cc=['c@gmail.com'])
+    >>> [(part.to, part.cc) for part in split_by_domain(message, [DomainSet(['gmail.com'])])]
+    [(['a@gmail.com'], ['c@gmail.com']), (['b@example.com'], [])]
+    """
+    groups = []
+    recipients_groups = {}
+    for field in RECIPIENT_FIELDS:
+        for recipient in getattr(message, field, None) or ():
+            domain = get_domain(recipient)
+            group = tuple(domain is not None and domain in domain_set for domain_set in domain_sets)
+            if group not in recipients_groups:
+                recipients_groups[group] = dict((name, []) for name in RECIPIENT_FIELDS)
+                groups.append(group)
+            recipients_groups[group][field].append(recipient)
+    if len(groups) < 2:
+        return [message]
+
+    parts = []
+    for group in groups:
+        part = copy.copy(message)
+        for field in RECIPIENT_FIELDS:
+            setattr(part, field, recipients_groups[group][field])
+        parts.append(part)
+    return parts
@@ -0,0 +1,137 @@
+"""
+Inverted index of the header checks of the routing conditions
+
+Backends whose conditions only check header values (FilterMailByHeader, ExcludeMailByHeader and
+MatchAny of FilterMailByHeader on one header) are indexed by (header name, header value): a message
+is routed with one lookup per indexed header, however many rules and backends there are.
+"""
+
+EMPTY = frozenset()
+
+# value of the headers a message does not have
+unset = object()
+
+
+def normalize_headers(extra_headers):
+    """
+    Returns :extra_headers with lowercase names, header names are case insensitive
+
+    >>> normalize_headers({'X-Mail-Type': 'transactional'})
+    {'x-mail-type': 'transactional'}
+    """
+    return dict((name.lower(), value) for name, value in extra_headers.items())
+
+
+def get_header_checks(clause):
+    """
+    Returns the ('in' / 'not in', header, values) checks :clause is made of, None when it is not
+    only made of header checks
+
+    >>> get_header_checks(('not in', 'x-mail-type', frozenset(['non-transactional'])))
+    [('not in', 'x-mail-type', frozenset({'non-transactional'}))]
+    >>> get_header_checks(('call', None)) is None
+    True
+    """
+    kind = clause[0]
+    if kind == 'true':
+        return []
+    if kind in ('in', 'not in'):
+        return [clause]
+    if kind == 'all':
+        checks = []
+        for nested in clause[1]:
+            if nested[0] not in ('in', 'not in'):
+                return None
+            checks.append(nested)
+        return checks
+    return None
+
+
+class HeaderIndex(object):
+    """
+    Maps the value of every indexed header to the backends a message with that value is not eligible for
+
+    :backends_weights are the (backend, weight) tuples select chooses from, in order.
+
+    >>> index = HeaderIndex([('mailjet', 1), ('mailchimp', 1)])
+    >>> index.add('mailjet', [('not in', 'x-mail-type', frozenset(['non-transactional']))])
+    >>> index.add('mailchimp', [('in', 'x-mail-type', frozenset(['non-transactional']))])
+    >>> index.select({'x-mail-type': 'non-transactional'})
+    [('mailchimp', 1)]
+    >>> sorted(index.get_rejected({}))
+    ['mailchimp']
+    """
+
+    # most distinct combinations of rejected sets whose eligible backends are kept by select
+    max_selections = 1024
+
+    def __init__(self, backends_weights=()):
+        self.backends_weights = tuple(backends_weights)
+        self.excluded = {}
+        self.allowed = {}
+        self.required = {}
+        self.lookups = None
+        self.selections = {}
+
+    def add(self, backend, checks):
+        for kind, header, values in checks:
+            if kind == 'not in':
+                target = self.excluded.setdefault(header, {})
+            else:
+                target = self.allowed.setdefault(header, {})
+                self.required[header] = self.required.get(header, EMPTY) | frozenset([backend])
+            for value in values:
+                target[value] = target.get(value, EMPTY) | frozenset([backend])
+        self.lookups = None
+        self.selections = {}
+
+    def build(self):
+        """
+        Computes the rejected backends of every indexed (header, value) once
+        """
+        lookups = []
+        for header in sorted(set(self.excluded) | set(self.allowed)):
+            excluded = self.excluded.get(header, {})
+            allowed = self.allowed.get(header, {})
+            required = self.required.get(header, EMPTY)
+            rejected = dict(
+                (value, excluded.get(value, EMPTY) | (required - allowed.get(value, EMPTY)))
+                for value in set(excluded) | set(allowed)
+            )
+            lookups.append((header, rejected, required))
+        self.lookups = lookups
+        return lookups
+
+    def get_rejected_sets(self, headers):
+        """
+        Returns the backends rejected by each indexed header of the (normalized) :headers,
+        raises TypeError when a header value is not hashable
+        """
+        lookups = self.lookups
+        if lookups is None:
+            lookups = self.build()
+        return tuple(
+            rejected_by_value.get(headers.get(header, unset), default)
+            for header, rejected_by_value, default in lookups
+        )
+
+    def get_rejected(self, headers):
+        return EMPTY.union(*self.get_rejected_sets(headers))
+
+    def select(self, headers):
+        """
+        Returns the (backend, weight) tuples not rejected for :headers
+
+        The rejected sets are computed once per header value, so the selection is kept
+        for every combination of them.
+        """
+        rejected_sets = self.get_rejected_sets(headers)
+        selected = self.selections.get(rejected_sets)
+        if selected is None:
+            if len(self.selections) >= self.max_selections:
+                self.selections = {}
+            rejected = EMPTY.union(*rejected_sets)
+            selected = self.selections[rejected_sets] = tuple(
+                (backend, weight) for backend, weight in self.backends_weights if backend not in rejected
+            )
+        return list(selected)
@@ -0,0 +1,36 @@
+import json
+from django.core.management.base import BaseCommand
+from django_email_multibackend.campaign import send_campaign
+from django_email_multibackend.routing import load_class
+
+
+class Command(BaseCommand):
+    help = (
+        'Sends the messages returned by SOURCE (the dotted path of a callable, queryset or iterable) '
+        'on a pool of processes, resuming from --checkpoint when it exists'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('source')
+        parser.add_argument('--processes', type=int, default=None, help='worker processes, one per CPU by default')
+        parser.add_argument('--shard-size', type=int, default=1000, help='messages sent by a worker at a time')
+        parser.add_argument('--checkpoint', default=None, help='JSON file where progress is saved')
+        parser.add_argument(
+            '--build-message', default=None,
+            help='dotted path of the function turning every item of SOURCE in an EmailMessage'
+        )
+        parser.add_argument('--json', action='store_true', help='prints the stats as JSON')
+
+    def handle(self, *args, **options):
+        stats = send_campaign(
+            load_class(options['source']), processes=options['processes'], shard_size=options['shard_size'],
+            checkpoint=options['checkpoint'], build_message=options['build_message']
+        )
+        if options['json']:
+            self.stdout.write(json.dumps(stats, sort_keys=True))
+            return
+        for backend_key, counts in sorted(stats['backends'].items()):
+            self.stdout.write('%s: %d sent, %d failed' % (backend_key, counts['sent'], counts['failed']))
+        self.stdout.write('total: %d sent, %d failed' % (stats['sent'], stats['failed']))
+        for error in stats['errors']:
+            self.stderr.write(error)
@@ -0,0 +1,38 @@
+import json
+from django.core.management.base import BaseCommand
+from django_email_multibackend.simulation import load_profiles, simulate
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulates how the messages described by PROFILES (a JSON list of message fields with a frequency) '
+        'are distributed among the backends with the current settings'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('profiles')
+        parser.add_argument(
+            '--messages', type=int, default=None,
+            help='messages per run, the frequencies are then relative instead of numbers of messages'
+        )
+        parser.add_argument('--runs', type=int, default=1000, help='simulated runs')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--json', action='store_true', help='prints the results as JSON')
+
+    def handle(self, *args, **options):
+        results = simulate(
+            load_profiles(options['profiles']), messages=options['messages'], runs=options['runs'],
+            seed=options['seed']
+        )
+        if options['json']:
+            self.stdout.write(json.dumps(results, sort_keys=True))
+            return
+        self.stdout.write('%d messages, %d runs' % (results['messages'], results['runs']))
+        rows = sorted(results['backends'].items()) + [('(unroutable)', results['unroutable'])]
+        for backend_key, result in rows:
+            line = '%s: expected %.1f (%.1f%%), std %.1f' % (
+                backend_key, result['expected'], result['share'] * 100, result['variance'] ** 0.5
+            )
+            if results['runs']:
+                line += ', simulated %.1f [%d - %d]' % (result['mean'], result['min'], result['max'])
+            self.stdout.write(line)
@@ -0,0 +1,124 @@
+import threading
+from django_email_multibackend import conf
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+
+class Histogram(object):
+    """
+    Counts observed values in fixed buckets, each bucket counts the values lower or equal to its bound
+
+    >>> histogram = Histogram((1, 10))
+    >>> histogram.observe(0.5); histogram.observe(5); histogram.observe(50)
+    >>> histogram.snapshot()
+    {'buckets': [(1, 1), (10, 2), ('+Inf', 3)], 'count': 3, 'sum': 55.5}
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.bounds):
+            if value <= bound:
+                break
+        else:
+            index = len(self.bounds)
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(list(self.bounds) + ['+Inf'], self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {'buckets': buckets, 'count': self.count, 'sum': self.sum}
+
+
+class BackendMetrics(object):
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+
+class Metrics(object):
+    """
+    Thread-safe counters and latency histograms of the routing and of every backend
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.backends = {}
+        self.routing = Histogram()
+        self.weighted_choice = Histogram()
+        self.routed = 0
+        self.condition_evaluations = 0
+        self.render = Histogram()
+
+    def record_routing(self, routing_time, choice_time):
+        with self.lock:
+            self.routed += 1
+            self.routing.observe(routing_time)
+            self.weighted_choice.observe(choice_time)
+
+    def record_evaluations(self, evaluations):
+        with self.lock:
+            self.condition_evaluations += evaluations
+
+    def record_render(self, render_times):
+        with self.lock:
+            for render_time in render_times:
+                self.render.observe(render_time)
+
+    def record_send(self, backend_key, messages, count, latency, error):
+        with self.lock:
+            backend_metrics = self.backends.get(backend_key)
+            if backend_metrics is None:
+                backend_metrics = self.backends[backend_key] = BackendMetrics()
+            backend_metrics.sent += count
+            backend_metrics.failed += messages - count
+            if error is not None:
+                backend_metrics.errors += 1
+            backend_metrics.latency.observe(latency)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'routed': self.routed,
+                'condition_evaluations': self.condition_evaluations,
+                'get_backends_for_email': self.routing.snapshot(),
+                'weighted_choice': self.weighted_choice.snapshot(),
+                'render': self.render.snapshot(),
+                'backends': dict(
+                    (backend_key, {
+                        'sent': backend_metrics.sent,
+                        'failed': backend_metrics.failed,
+                        'errors': backend_metrics.errors,
+                        'latency': backend_metrics.latency.snapshot(),
+                    })
+                    for backend_key, backend_metrics in self.backends.items()
+                ),
+            }
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+def get_metrics():
+    """
+    Returns the process-wide metrics, None unless EMAIL_BACKENDS_METRICS is set
+    """
+    global _metrics
+    if not conf.EMAIL_BACKENDS_METRICS:
+        return None
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+    return _metrics
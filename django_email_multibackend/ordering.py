@@ -0,0 +1,111 @@
+import threading
+from timeit import default_timer
+
+
+class ConditionStats(object):
+
+    def __init__(self):
+        self.evaluations = 0
+        self.rejections = 0
+        self.time = 0.0
+
+    def get_rank(self):
+        """
+        Expected cost of the condition for every message it rejects, conditions that never reject rank last
+        """
+        if not self.rejections:
+            return float('inf')
+        return self.time / self.rejections
+
+
+def describe(condition):
+    """
+    >>> from django_email_multibackend.conditions import FilterMailByHeader
+    >>> describe(FilterMailByHeader(header=('X-MAIL-TYPE', 'transactional')))
+    "FilterMailByHeader(header=('X-MAIL-TYPE', 'transactional'))"
+    """
+    params = getattr(condition, 'params', None) or {}
+    return '%s(%s)' % (
+        condition.__class__.__name__, ', '.join('%s=%r' % item for item in sorted(params.items()))
+    )
+
+
+class ConditionOrdering(object):
+    """
+    Reorders the conditions of every backend so that the ones rejecting most messages for
+    the least time run first
+
+    One in :sample_every routed messages is sampled: all conditions of every backend are timed
+    and their rejections counted. Every :reorder_every samples the conditions are sorted by
+    time spent per rejected message; the result of the conditions does not change, only how
+    soon a rejected message stops being evaluated.
+
+    >>> ordering = ConditionOrdering(clock=iter(range(100)).__next__)
+    >>> accept, reject = lambda message: True, lambda message: False
+    >>> ordering.evaluate([accept, reject], None)
+    False
+    >>> ordering.order([accept, reject]) == [reject, accept]
+    True
+    """
+
+    def __init__(self, sample_every=100, reorder_every=100, clock=default_timer):
+        self.sample_every = sample_every
+        self.reorder_every = reorder_every
+        self.clock = clock
+        self.stats = {}
+        self.routed = 0
+        self.samples = 0
+        self.lock = threading.Lock()
+
+    def should_sample(self):
+        with self.lock:
+            self.routed += 1
+            return not self.routed % self.sample_every
+
+    def should_reorder(self):
+        with self.lock:
+            self.samples += 1
+            return not self.samples % self.reorder_every
+
+    def record(self, condition, time, rejected):
+        with self.lock:
+            stats = self.stats.get(condition)
+            if stats is None:
+                stats = self.stats[condition] = ConditionStats()
+            stats.evaluations += 1
+            stats.time += time
+            if rejected:
+                stats.rejections += 1
+
+    def evaluate(self, conditions, mail):
+        """
+        Evaluates and times all :conditions on :mail, returns whether they all match
+
+        Conditions after the first one not matching are evaluated only to be measured,
+        their errors are ignored.
+        """
+        matched = True
+        for condition in conditions:
+            started = self.clock()
+            try:
+                result = condition(mail)
+            except Exception:
+                if matched:
+                    raise
+                continue
+            self.record(condition, self.clock() - started, not result)
+            matched = matched and bool(result)
+        return matched
+
+    def get_rank(self, condition):
+        stats = self.stats.get(condition)
+        if stats is None:
+            return float('inf')
+        return stats.get_rank()
+
+    def order(self, conditions):
+        """
+        Returns :conditions sorted by expected cost, ties keep their order
+        """
+        with self.lock:
+            return sorted(conditions, key=self.get_rank)
@@ -0,0 +1,146 @@
+import atexit
+import socket
+import threading
+import time
+from smtplib import SMTPServerDisconnected
+from django.core.mail import get_connection
+from django_email_multibackend import conf
+
+BROKEN_CONNECTION_ERRORS = (SMTPServerDisconnected, socket.error)
+
+
+class PooledConnection(object):
+
+    def __init__(self, connection, created_at):
+        self.connection = connection
+        self.created_at = created_at
+        self.released_at = created_at
+
+
+class ConnectionPool(object):
+    """
+    Process-wide pool of open backend connections
+
+    Connections are kept open between send_messages calls and reused by every
+    EmailMultiServerBackend sharing the pool; connections idle for more than
+    :idle_timeout seconds or opened more than :max_age seconds ago are closed
+    instead of being reused. At most :max_idle connections are kept per backend.
+
+    Pooled connections are created with fail_silently=False so that broken ones are always
+    found and replaced; the fail_silently of the backend settings applies after the retry.
+    """
+
+    def __init__(self, idle_timeout=60, max_age=None, max_idle=4, clock=time.time):
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.max_idle = max_idle
+        self.clock = clock
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, backend_key, backend_settings):
+        return backend_key, repr(sorted(
+            (name, value) for name, value in backend_settings.items() if name != 'fail_silently'
+        ))
+
+    def is_expired(self, pooled, now):
+        if self.idle_timeout is not None and now - pooled.released_at > self.idle_timeout:
+            return True
+        if self.max_age is not None and now - pooled.created_at > self.max_age:
+            return True
+        return False
+
+    def create(self, backend_settings):
+        connection = get_connection(**dict(backend_settings, fail_silently=False))
+        connection.open()
+        return PooledConnection(connection, self.clock())
+
+    def acquire(self, backend_key, backend_settings):
+        key = self.get_key(backend_key, backend_settings)
+        expired = []
+        pooled = None
+        with self.lock:
+            idle = self.idle.get(key, [])
+            now = self.clock()
+            while idle:
+                candidate = idle.pop()
+                if self.is_expired(candidate, now):
+                    expired.append(candidate)
+                else:
+                    pooled = candidate
+                    break
+        for candidate in expired:
+            self.discard(candidate)
+        return pooled or self.create(backend_settings)
+
+    def release(self, backend_key, backend_settings, pooled):
+        key = self.get_key(backend_key, backend_settings)
+        pooled.released_at = self.clock()
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(pooled)
+                return
+        self.discard(pooled)
+
+    def discard(self, pooled):
+        try:
+            pooled.connection.close()
+        except Exception:
+            pass
+
+    def send_messages(self, backend_key, backend_settings, email_messages):
+        """
+        Sends :email_messages with a pooled connection to :backend_key
+
+        A connection found broken is closed and the messages are sent again once with a new connection.
+        Errors are raised unless fail_silently is set in :backend_settings, then 0 is returned.
+        """
+        pooled = None
+        try:
+            pooled = self.acquire(backend_key, backend_settings)
+            try:
+                count = pooled.connection.send_messages(email_messages)
+            except BROKEN_CONNECTION_ERRORS:
+                self.discard(pooled)
+                pooled = None
+                pooled = self.create(backend_settings)
+                count = pooled.connection.send_messages(email_messages)
+        except Exception:
+            if pooled is not None:
+                self.discard(pooled)
+            if backend_settings.get('fail_silently'):
+                return 0
+            raise
+        self.release(backend_key, backend_settings, pooled)
+        return count
+
+    def warm(self, backend_key, backend_settings):
+        self.release(backend_key, backend_settings, self.acquire(backend_key, backend_settings))
+
+    def clear(self):
+        """
+        Closes all the idle connections
+        """
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for pooled in connections:
+                self.discard(pooled)
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+def get_connection_pool():
+    """
+    Returns the process-wide pool configured with EMAIL_BACKENDS_POOL, None when pooling is disabled
+    """
+    global _connection_pool
+    if conf.EMAIL_BACKENDS_POOL is None:
+        return None
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = ConnectionPool(**conf.EMAIL_BACKENDS_POOL)
+            atexit.register(_connection_pool.clear)
+    return _connection_pool
@@ -0,0 +1,192 @@
+import atexit
+import logging
+import threading
+import time
+from django_email_multibackend import conf
+from django_email_multibackend.backends import EmailMultiServerBackend
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
+logger = logging.getLogger(__name__)
+
+BLOCK = 'block'
+DROP = 'drop'
+RAISE = 'raise'
+
+# queued to stop a worker
+STOP = None
+
+
+class QueueFull(Exception):
+    pass
+
+
+class SendQueue(object):
+    """
+    Bounded in-memory queue of routed chunks, sent by a pool of :workers background threads
+
+    When the queue already holds :maxsize chunks, :backpressure decides what happens to new ones:
+    'block' waits for room (at most :put_timeout seconds, then raises QueueFull), 'drop' discards
+    them and 'raise' raises QueueFull straight away.
+    """
+
+    def __init__(self, maxsize=10000, workers=4, backpressure=BLOCK, put_timeout=None, shutdown_timeout=10):
+        if backpressure not in (BLOCK, DROP, RAISE):
+            raise ValueError('Unknown backpressure %r' % backpressure)
+        self.queue = Queue(maxsize)
+        self.workers = workers
+        self.backpressure = backpressure
+        self.put_timeout = put_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.threads = []
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.done = threading.Condition(self.lock)
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.work, name='email-send-queue-%s' % i)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """
+        Stops the workers once the chunks already queued are sent, waiting at most :timeout seconds for each
+        """
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for thread in threads:
+            self.queue.put(STOP)
+        for thread in threads:
+            thread.join(timeout)
+
+    def put(self, connection, backend_key, chunk):
+        """
+        Queues :chunk to be delivered by :connection to :backend_key, returns False when it was dropped
+        """
+        self.start()
+        item = (connection, backend_key, chunk)
+        with self.lock:
+            self.pending += 1
+        try:
+            if self.backpressure == BLOCK:
+                self.queue.put(item, timeout=self.put_timeout)
+            else:
+                self.queue.put_nowait(item)
+        except Full:
+            self.task_done()
+            if self.backpressure == DROP:
+                with self.lock:
+                    self.dropped += len(chunk)
+                return False
+            raise QueueFull('The email send queue is full')
+        return True
+
+    def task_done(self, sent=0, failed=0):
+        with self.lock:
+            self.pending -= 1
+            self.sent += sent
+            self.failed += failed
+            if not self.pending:
+                self.done.notify_all()
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is STOP:
+                return
+            connection, backend_key, chunk = item
+            sent = 0
+            try:
+                for delivered_key, delivered_chunk, count in connection.deliver(backend_key, chunk):
+                    sent += count
+            except Exception:
+                logger.exception('Error sending %d emails with %s', len(chunk), backend_key)
+            # held since the chunk was queued, see QueuedEmailMultiServerBackend.send_messages
+            connection.routing.release()
+            self.task_done(sent, len(chunk) - sent)
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued message is sent, returns False if :timeout seconds passed first
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while self.pending:
+                if deadline is None:
+                    self.done.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.done.wait(remaining)
+        return True
+
+    def shutdown(self):
+        if not self.flush(self.shutdown_timeout):
+            logger.warning('%d email chunks left unsent in the send queue', self.pending)
+
+
+_send_queue = None
+_send_queue_lock = threading.Lock()
+
+def get_send_queue():
+    """
+    Returns the process-wide send queue configured with EMAIL_BACKENDS_QUEUE, flushed at exit
+    """
+    global _send_queue
+    with _send_queue_lock:
+        if _send_queue is None:
+            _send_queue = SendQueue(**(conf.EMAIL_BACKENDS_QUEUE or {}))
+            atexit.register(_send_queue.shutdown)
+    return _send_queue
+
+
+class QueuedEmailMultiServerBackend(EmailMultiServerBackend):
+    """
+    Routes messages like EmailMultiServerBackend but hands them over to background worker
+    threads instead of sending them, send_messages returns the number of queued messages
+    """
+
+    def __init__(self, send_queue=None, **kwargs):
+        super(QueuedEmailMultiServerBackend, self).__init__(**kwargs)
+        self.send_queue = send_queue or get_send_queue()
+
+    def send_messages(self, email_messages):
+        queued = 0
+
+        if not hasattr(email_messages, '__iter__'):
+            email_messages = [email_messages]
+
+        pinned = self.pin()
+        routing = pinned.routing
+        routing.acquire()
+        try:
+            for backend_key, chunk in pinned.get_chunks(email_messages):
+                # every queued chunk holds the routing snapshot until a worker sent it
+                routing.acquire()
+                try:
+                    put = self.send_queue.put(pinned, backend_key, chunk)
+                except Exception:
+                    routing.release()
+                    raise
+                if put:
+                    queued += len(chunk)
+                else:
+                    routing.release()
+        finally:
+            routing.release()
+        return queued
+
+    def flush(self, timeout=None):
+        return self.send_queue.flush(timeout)
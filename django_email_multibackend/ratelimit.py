@@ -0,0 +1,94 @@
+import threading
+import time
+
+RATE_LIMIT_SETTINGS = ('rate_limit', 'rate_limit_burst')
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket refilled with :rate tokens per second, holding at most :burst tokens
+
+    Taking more tokens than available leaves the bucket in debt: the caller is told how long
+    to wait so that sends are spread evenly instead of bursting when tokens come back.
+
+    >>> bucket = TokenBucket(rate=10, burst=2, clock=lambda: 0)
+    >>> bucket.reserve(2), bucket.has_tokens()
+    (0, False)
+    >>> bucket.reserve(1)
+    0.1
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time):
+        self.rate = float(rate)
+        self.burst = max(burst or rate, 1)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def has_tokens(self, tokens=1):
+        with self.lock:
+            self.refill()
+            return self.tokens >= tokens
+
+    def reserve(self, tokens=1):
+        """
+        Takes :tokens from the bucket and returns how many seconds to wait before using them
+        """
+        with self.lock:
+            self.refill()
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def consume(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait:
+            time.sleep(wait)
+
+
+class RateLimiters(object):
+    """
+    The token buckets of all rate limited backends, shared by every EmailMultiServerBackend of the process
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get(self, backend_key, rate, burst=None):
+        key = (backend_key, rate, burst)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            with self.lock:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = TokenBucket(rate, burst, self.clock)
+        return bucket
+
+
+rate_limiters = RateLimiters()
+
+def split_rate_limit(backend_settings):
+    """
+    Splits the rate limit options out of the settings of a backend
+
+    >>> split_rate_limit({'backend': 'smtp', 'rate_limit': 10})
+    ({'backend': 'smtp'}, (10, None))
+    >>> split_rate_limit({'backend': 'smtp'})
+    ({'backend': 'smtp'}, None)
+    """
+    connection_settings = dict(
+        (name, value) for name, value in backend_settings.items() if name not in RATE_LIMIT_SETTINGS
+    )
+    rate = backend_settings.get('rate_limit')
+    if not rate:
+        return connection_settings, None
+    return connection_settings, (rate, backend_settings.get('rate_limit_burst'))
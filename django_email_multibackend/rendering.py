@@ -0,0 +1,113 @@
+"""
+Renders every message once for all the attempts to send it
+
+EmailMessage.message() builds and encodes the whole MIME message (attachments included) every time a
+backend sends it, so with failover or retries a message is rendered once per attempt. RenderedMessage
+stands for an EmailMessage whose message().as_bytes() returns the bytes rendered the first time;
+rendered messages larger than :max_memory bytes are written to a temporary file as they are rendered
+instead of being kept in memory.
+
+Memory is only bounded between attempts: smtplib sends bytes, so every attempt reads the whole message
+back and holds it while it is sent.
+"""
+import tempfile
+from email import generator
+from timeit import default_timer
+from django.core.mail.backends.smtp import EmailBackend as SMTPEmailBackend
+
+# the line separator of the bytes sent over SMTP
+SMTP_LINESEP = '\r\n'
+
+
+def accepts_rendered_messages(backend_class):
+    """
+    Returns whether :backend_class only uses message().as_bytes() of the messages it sends, like the SMTP backend;
+    other backends can declare it with an accepts_rendered_messages attribute
+
+    >>> from django.core.mail.backends.locmem import EmailBackend
+    >>> accepts_rendered_messages(SMTPEmailBackend), accepts_rendered_messages(EmailBackend)
+    (True, False)
+    """
+    return getattr(backend_class, 'accepts_rendered_messages', issubclass(backend_class, SMTPEmailBackend))
+
+
+class RenderedMIME(object):
+    """
+    What RenderedMessage.message() returns: as_bytes uses the rendered bytes, anything else
+    is looked up on a MIME message built again
+    """
+
+    def __init__(self, rendered_message):
+        self.rendered_message = rendered_message
+
+    def as_bytes(self, unixfrom=False, linesep='\n'):
+        if unixfrom:
+            return self.rendered_message.email.message().as_bytes(unixfrom, linesep)
+        return self.rendered_message.get_bytes(linesep)
+
+    def __getattr__(self, name):
+        return getattr(self.rendered_message.email.message(), name)
+
+
+class RenderedMessage(object):
+    """
+    Proxy of the EmailMessage :email caching the bytes of its MIME message, per line separator
+
+    >>> from django.core.mail import EmailMessage
+    >>> rendered = RenderedMessage(EmailMessage('subject', 'body', 'from@example.com', ['to@example.com']))
+    >>> rendered.message().as_bytes() == rendered.message().as_bytes()
+    True
+    >>> rendered.recipients()
+    ['to@example.com']
+    """
+
+    def __init__(self, email, max_memory=1024 * 1024):
+        self.email = email
+        self.max_memory = max_memory
+        self.rendered = {}
+        self.render_time = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.email, name)
+
+    def message(self):
+        return RenderedMIME(self)
+
+    def render(self, linesep=SMTP_LINESEP):
+        """
+        Renders the message with :linesep unless it already is, returns the time it took
+        """
+        if linesep in self.rendered:
+            return 0.0
+        started = default_timer()
+        if self.max_memory is None:
+            data = self.email.message().as_bytes(linesep=linesep)
+        else:
+            # written as it is generated, moved to a temporary file past max_memory bytes
+            data = tempfile.SpooledTemporaryFile(self.max_memory)
+            # like as_bytes, without mangling the lines starting with 'From '
+            generator.BytesGenerator(data, mangle_from_=False).flatten(self.email.message(), linesep=linesep)
+            if data.tell() <= self.max_memory:
+                data.seek(0)
+                data = data.read()
+        self.rendered[linesep] = data
+        render_time = default_timer() - started
+        self.render_time += render_time
+        return render_time
+
+    def get_bytes(self, linesep='\n'):
+        self.render(linesep)
+        data = self.rendered[linesep]
+        if isinstance(data, bytes):
+            return data
+        data.seek(0)
+        return data.read()
+
+    def close(self):
+        """
+        Removes the temporary files of the message
+        """
+        for data in self.rendered.values():
+            if not isinstance(data, bytes):
+                data.close()
+        self.rendered = {}
@@ -0,0 +1,393 @@
+import threading
+from collections import OrderedDict
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import EmailMessage
+from django_email_multibackend import conf
+from django_email_multibackend.compiler import compile_router, describes_check
+from django_email_multibackend.domains import get_domain_sets
+from django_email_multibackend.index import normalize_headers
+from django_email_multibackend.ordering import ConditionOrdering, describe
+
+try:
+    from django.utils.importlib import import_module
+except ImportError:
+    from importlib import import_module
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
+unset = object()
+
+
+def load_class(path):
+    """
+    Loads a class from its path
+
+    >>> load_class('django_email_multibackend.conditions.MatchAll')
+    <class 'django_email_multibackend.conditions.MatchAll'>
+    """
+    try:
+        mod_name, klass_name = path.rsplit('.', 1)
+        mod = import_module(mod_name)
+    except ImportError as e:
+        raise ImproperlyConfigured(('Error importing email backend module %s: "%s"'
+                                    % (mod_name, e)))
+    try:
+        klass = getattr(mod, klass_name)
+    except AttributeError:
+        raise ImproperlyConfigured(('Module "%s" does not define a '
+                                    '"%s" class' % (mod_name, klass_name)))
+    return klass
+
+def load_conditions(conditions_conf):
+    """
+    Loads and initialise a list of conditions from their (path, params) configuration
+
+    >>> conditions = load_conditions([('django_email_multibackend.conditions.MatchAll', )])
+    >>> conditions[0].params
+    {}
+    """
+    conditions = []
+    for kls_conf in conditions_conf:
+        try:
+            kls_name, params = kls_conf
+        except ValueError:
+            kls_name, params = kls_conf[0], {}
+        conditions.append(load_class(kls_name)(**params))
+    return conditions
+
+def get_condition_headers(condition):
+    """
+    Returns the names of the headers :condition depends on, None when unknown
+    """
+    get_headers = getattr(condition, 'get_headers', None)
+    if get_headers is None or not describes_check(condition, 'get_headers'):
+        return None
+    return get_headers()
+
+def get_backend_routing_conditions(backend):
+    """
+    Loads and initialise the list of conditions for :backend
+
+
+    eg.
+
+    EMAIL_BACKENDS_CONDITIONS = {
+        'mailjet': [
+            ('django_email_multibackend.conditions.ExcludeMailByHeader', {'header': ('X-MAIL-TYPE', 'non-transactional')})
+        ]
+    }
+
+    >>> conditions = get_backend_routing_conditions('mailchimp')
+    >>> conditions[0].params
+    {}
+
+    >>> conditions = get_backend_routing_conditions('mailjet')
+    >>> conditions[0].params
+    {'header': ('X-MAIL-TYPE', 'non-transactional')}
+
+    """
+    paths_kwargs = conf.EMAIL_BACKENDS_CONDITIONS.get(
+        backend, conf.DEFAULT_CONDITIONS
+    )
+    return load_conditions(paths_kwargs)
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe mapping dropping the least recently used entries first
+
+    >>> cache = LRUCache(2)
+    >>> cache.set('a', 1); cache.set('b', 2); cache.get('a'); cache.set('c', 3)
+    1
+    >>> cache.get('b', 'missing'), cache.hits, cache.misses
+    ('missing', 1, 1)
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+
+class CompiledRoutes(object):
+    """
+    The conditions of every backend together with the caches derived from them
+    """
+
+    def __init__(self, default_conditions, conditions, cache_size, ordering=None):
+        self.default_conditions = default_conditions
+        self.conditions = conditions
+        self.ordering = ordering
+        self.signatures = {}
+        self.routers = {}
+        self.domain_sets = {}
+        self.cache = LRUCache(cache_size) if cache_size else None
+
+
+class RoutingTable(object):
+    """
+    Holds the routing conditions of every backend, loaded and initialised once
+
+    Conditions are compiled on first use from :backends_conditions (defaults to
+    EMAIL_BACKENDS_CONDITIONS) and kept until reload is called.
+
+    When every condition declares the headers it depends on (see BaseCondition.get_headers)
+    the eligible backends are cached by the values of those headers, up to :cache_size entries.
+    Backends routed by a compiled router not calling any condition are not cached: a cache lookup
+    costs more than the router.
+
+    :ordering holds the ConditionOrdering options used to reorder the conditions of every backend
+    (defaults to EMAIL_BACKENDS_CONDITION_ORDERING, False disables it).
+
+    >>> table = RoutingTable({'mailjet': [('django_email_multibackend.conditions.MatchAll', {})]})
+    >>> table.get_conditions('mailjet') is table.get_conditions('mailjet')
+    True
+    >>> table.get_conditions('mailchimp') is table.get_conditions('mailjet')
+    False
+    """
+
+    def __init__(self, backends_conditions=None, cache_size=None, ordering=None):
+        self.backends_conditions = backends_conditions
+        self.cache_size = cache_size
+        self.ordering = ordering
+        self._compiled = None
+
+    def compile(self):
+        backends_conditions = self.backends_conditions
+        if backends_conditions is None:
+            backends_conditions = conf.EMAIL_BACKENDS_CONDITIONS
+        cache_size = self.cache_size
+        if cache_size is None:
+            cache_size = conf.EMAIL_BACKENDS_ROUTING_CACHE_SIZE
+        default_conditions = load_conditions(conf.DEFAULT_CONDITIONS)
+        conditions = dict(
+            (backend, load_conditions(conditions_conf))
+            for backend, conditions_conf in backends_conditions.items()
+        )
+        ordering = self.ordering
+        if ordering is None:
+            ordering = conf.EMAIL_BACKENDS_CONDITION_ORDERING
+        if ordering is None or ordering is False:
+            ordering = None
+        else:
+            ordering = ConditionOrdering(**ordering)
+        return CompiledRoutes(default_conditions, conditions, cache_size, ordering)
+
+    def reload(self):
+        """
+        Loads the conditions again from the settings and empties the routing cache
+        """
+        # the compiled table is swapped in one go so concurrent readers never see a partial table
+        self._compiled = self.compile()
+        return self._compiled
+
+    def get_compiled(self):
+        compiled = self._compiled
+        if compiled is None:
+            compiled = self.reload()
+        return compiled
+
+    def get_conditions(self, backend):
+        compiled = self.get_compiled()
+        return compiled.conditions.get(backend, compiled.default_conditions)
+
+    def get_headers(self, backend):
+        """
+        Returns the names of the headers the conditions of :backend depend on, None when unknown
+        """
+        headers = set()
+        for condition in self.get_conditions(backend):
+            condition_headers = get_condition_headers(condition)
+            if condition_headers is None:
+                return None
+            headers.update(condition_headers)
+        return headers
+
+    def get_signature_headers(self, weights):
+        """
+        Returns the names of the headers the routing of :weights is cached by, None when it is not cached
+        """
+        compiled = self.get_compiled()
+        try:
+            return compiled.signatures[weights]
+        except KeyError:
+            pass
+        headers = set()
+        for backend, weight in weights:
+            backend_headers = self.get_headers(backend)
+            if backend_headers is None:
+                headers = None
+                break
+            headers.update(backend_headers)
+        if headers is not None and not self.get_router(weights).calls:
+            # header checks only, the compiled router is faster than a cache lookup
+            headers = None
+        if headers is not None:
+            headers = tuple(sorted(set(header.lower() for header in headers)))
+        compiled.signatures[weights] = headers
+        return headers
+
+    def get_domain_sets(self, weights):
+        """
+        Returns the domain sets of the recipient domain conditions of the backends in :weights
+        """
+        compiled = self.get_compiled()
+        domain_sets = compiled.domain_sets.get(weights)
+        if domain_sets is None:
+            domain_sets = []
+            for backend, weight in weights:
+                for domain_set in get_domain_sets(self.get_conditions(backend)):
+                    if domain_set not in domain_sets:
+                        domain_sets.append(domain_set)
+            compiled.domain_sets[weights] = domain_sets
+        return domain_sets
+
+    def get_router(self, weights):
+        """
+        Returns the conditions of all backends in :weights compiled in a single function
+        """
+        compiled = self.get_compiled()
+        router = compiled.routers.get(weights)
+        if router is None:
+            router = compiled.routers[weights] = compile_router([
+                ((backend, weight), self.get_conditions(backend)) for backend, weight in weights
+            ])
+        return router
+
+    def match(self, backend, mail):
+        return all(cond(mail) for cond in self.get_conditions(backend))
+
+    def reorder(self, compiled):
+        """
+        Sorts the conditions of every backend by their measured cost, see ConditionOrdering
+        """
+        ordering = compiled.ordering
+        compiled.conditions = dict(
+            (backend, ordering.order(conditions)) for backend, conditions in compiled.conditions.items()
+        )
+        compiled.default_conditions = ordering.order(compiled.default_conditions)
+        # the routers are compiled again with the new order, cached routing results stay valid
+        compiled.routers = {}
+
+    def sample_backends(self, compiled, weights, mail, metrics=None):
+        ordering = compiled.ordering
+        backends_weights = []
+        evaluations = 0
+        for backend, weight in weights:
+            conditions = self.get_conditions(backend)
+            evaluations += len(conditions)
+            if ordering.evaluate(conditions, mail):
+                backends_weights.append((backend, weight))
+        if metrics is not None:
+            metrics.record_evaluations(evaluations)
+        if ordering.should_reorder():
+            self.reorder(compiled)
+        return backends_weights
+
+    def condition_order(self, backends):
+        """
+        Returns the descriptions of the conditions of :backends in the order they are evaluated,
+        None when conditions are not reordered
+        """
+        if self.get_compiled().ordering is None:
+            return None
+        return dict(
+            (backend, [describe(condition) for condition in self.get_conditions(backend)])
+            for backend in backends
+        )
+
+    def match_backends(self, weights, mail, metrics=None):
+        compiled = self.get_compiled()
+        if compiled.ordering is not None and compiled.ordering.should_sample():
+            return self.sample_backends(compiled, weights, mail, metrics)
+
+        if isinstance(mail, EmailMessage):
+            router = self.get_router(tuple(weights))
+            backends_weights = router(mail)
+            if backends_weights is not None:
+                if metrics is not None:
+                    metrics.record_evaluations(router.checks)
+                return backends_weights
+        if metrics is None:
+            return [(backend, weight) for backend, weight in weights if self.match(backend, mail)]
+
+        # conditions are evaluated one by one to count them
+        evaluations = 0
+        backends_weights = []
+        for backend, weight in weights:
+            for cond in self.get_conditions(backend):
+                evaluations += 1
+                if not cond(mail):
+                    break
+            else:
+                backends_weights.append((backend, weight))
+        metrics.record_evaluations(evaluations)
+        return backends_weights
+
+    def get_backends_for_email(self, weights, mail, metrics=None):
+        """
+        Returns the (backend, weight) tuples of :weights whose conditions match :mail,
+        counting the conditions evaluated in :metrics if given
+        """
+        weights = tuple(weights)
+        cache = self.get_compiled().cache
+        headers = self.get_signature_headers(weights)
+        if cache is None or headers is None or not isinstance(mail, EmailMessage):
+            return self.match_backends(weights, mail, metrics)
+
+        extra_headers = normalize_headers(mail.extra_headers)
+        key = (weights, tuple(extra_headers.get(header, unset) for header in headers))
+        try:
+            backends_weights = cache.get(key)
+        except TypeError:
+            # unhashable header values can not be cached
+            return self.match_backends(weights, mail, metrics)
+        if backends_weights is None:
+            backends_weights = tuple(self.match_backends(weights, mail, metrics))
+            cache.set(key, backends_weights)
+        return list(backends_weights)
+
+    def cache_info(self):
+        """
+        Returns the (hits, misses, size) of the routing cache
+        """
+        cache = self.get_compiled().cache
+        if cache is None:
+            return 0, 0, 0
+        return cache.hits, cache.misses, len(cache.data)
+
+
+routing_table = RoutingTable()
+
+def reload_routing_table():
+    routing_table.reload()
+
+def settings_changed(sender, setting, **kwargs):
+    if setting in ('EMAIL_BACKENDS_CONDITIONS', 'EMAIL_BACKENDS_ROUTING_CACHE_SIZE',
+                   'EMAIL_BACKENDS_CONDITION_ORDERING'):
+        reload_routing_table()
+
+setting_changed.connect(settings_changed)
@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+# sent before a message is routed, with the message as message
+pre_route = Signal()
+
+# sent after every attempt to send a chunk of messages to a backend, with backend_key,
+# messages, count (as returned by the backend), latency (in seconds) and error (or None)
+post_send = Signal()
@@ -0,0 +1,123 @@
+"""
+Simulates how messages are distributed among the backends, for capacity planning
+
+The traffic is described by profiles: the headers (and recipients, subject...) of a kind of message and
+its frequency. The eligible backends of every profile are computed once, with the routing table and
+weights of an EmailMultiServerBackend, then the backends of millions of messages are drawn at once with
+NumPy (an optional dependency, only needed here).
+"""
+import json
+from django.core.mail import EmailMessage
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PROFILE_FIELDS = ('subject', 'body', 'from_email', 'to', 'cc', 'bcc', 'headers')
+
+
+def get_profile_message(profile):
+    """
+    Returns the EmailMessage of :profile, a dict with the EmailMessage arguments in PROFILE_FIELDS
+
+    >>> message = get_profile_message({'headers': {'X-MAIL-TYPE': 'non-transactional'}, 'to': ['a@gmail.com']})
+    >>> message.extra_headers, message.to
+    ({'X-MAIL-TYPE': 'non-transactional'}, ['a@gmail.com'])
+    """
+    return EmailMessage(**dict((field, profile[field]) for field in PROFILE_FIELDS if field in profile))
+
+
+def load_profiles(path):
+    """
+    Loads the (message, frequency) profiles of the JSON file :path, a list of objects with
+    a frequency and the fields of get_profile_message
+    """
+    with open(path) as profiles_file:
+        profiles = json.load(profiles_file)
+    return [(get_profile_message(profile), profile['frequency']) for profile in profiles]
+
+
+def get_probabilities(connection, profiles):
+    """
+    Returns the backend keys and the matrix of the probability of every profile to go to every backend;
+    the last column is the probability of having no eligible backend
+
+    Like the weighted choice, a profile whose eligible backends all have a weight of 0 goes to the last of them.
+    """
+    backend_keys = [backend for backend, weight in connection.weights]
+    columns = dict((backend, column) for column, backend in enumerate(backend_keys))
+    probabilities = numpy.zeros((len(profiles), len(backend_keys) + 1))
+    for row, (message, frequency) in enumerate(profiles):
+        backends_weights = connection.get_backends_for_email(message)
+        if not backends_weights:
+            probabilities[row, -1] = 1
+            continue
+        total = float(sum(weight for backend, weight in backends_weights))
+        if not total:
+            probabilities[row, columns[backends_weights[-1][0]]] = 1
+            continue
+        for backend, weight in backends_weights:
+            probabilities[row, columns[backend]] += weight / total
+    return backend_keys, probabilities
+
+
+def simulate(profiles, messages=None, runs=1000, connection=None, seed=None):
+    """
+    Simulates routing the traffic described by :profiles, (message, frequency) tuples, and returns
+    the expected volume, variance and share of every backend and the statistics of :runs simulated runs
+
+    Without :messages the frequencies are numbers of messages (eg. per hour); with :messages they are
+    relative and every run routes :messages messages of random profiles. Messages are routed like
+    :connection (an EmailMultiServerBackend with the settings by default) does with its configured weights;
+    circuit breakers, adaptive weights and rate limits are left out. Messages without an eligible backend
+    are counted as unroutable.
+    """
+    if numpy is None:
+        raise ImportError('simulating the routing requires numpy')
+    if connection is None:
+        from django_email_multibackend.backends import EmailMultiServerBackend
+        connection = EmailMultiServerBackend()
+    profiles = list(profiles)
+    backend_keys, probabilities = get_probabilities(connection, profiles)
+    frequencies = numpy.array([frequency for message, frequency in profiles], dtype=float)
+    random_state = numpy.random.default_rng(seed)
+
+    if messages is None:
+        counts = frequencies.astype(numpy.int64)
+        expected = counts.dot(probabilities)
+        variance = counts.dot(probabilities * (1 - probabilities))
+        drawn = numpy.zeros((runs, len(backend_keys) + 1), dtype=numpy.int64)
+        for count, row in zip(counts, probabilities):
+            if count:
+                drawn += random_state.multinomial(count, row, size=runs)
+        messages = int(counts.sum())
+    else:
+        # every message picks a profile then a backend: one multinomial of the combined probabilities
+        combined = (frequencies / frequencies.sum()).dot(probabilities)
+        combined /= combined.sum()
+        expected = messages * combined
+        variance = messages * combined * (1 - combined)
+        drawn = random_state.multinomial(messages, combined, size=runs)
+
+    def describe(column):
+        result = {
+            'expected': float(expected[column]),
+            'variance': float(variance[column]),
+            'share': float(expected[column] / messages) if messages else 0.0,
+        }
+        if runs:
+            result.update({
+                'mean': float(drawn[:, column].mean()),
+                'std': float(drawn[:, column].std()),
+                'min': int(drawn[:, column].min()),
+                'max': int(drawn[:, column].max()),
+            })
+        return result
+
+    return {
+        'messages': messages,
+        'runs': runs,
+        'backends': dict((backend, describe(column)) for column, backend in enumerate(backend_keys)),
+        'unroutable': describe(len(backend_keys)),
+    }
@@ -0,0 +1,379 @@
+import copy
+import json
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+from django_email_multibackend import conf
+from django_email_multibackend.backends import EmailMultiServerBackend
+
+logger = logging.getLogger(__name__)
+
+# payload length, backend key length
+RECORD_HEADER = struct.Struct('>IH')
+SEGMENT_SUFFIX = '.log'
+ACKS_FILE = 'acks.json'
+
+
+class Segment(object):
+
+    def __init__(self, path, base, size=0):
+        self.path = path
+        self.base = base
+        self.size = size
+        self.backends = set()
+
+    @property
+    def end(self):
+        return self.base + self.size
+
+
+def iter_records(data, offset=0):
+    """
+    Yields the (start, end, backend_key, payload) of the records in :data from :offset, stops at the first incomplete record
+    """
+    length = len(data)
+    while offset + RECORD_HEADER.size <= length:
+        payload_length, key_length = RECORD_HEADER.unpack_from(data, offset)
+        key_start = offset + RECORD_HEADER.size
+        payload_start = key_start + key_length
+        end = payload_start + payload_length
+        if end > length:
+            return
+        yield offset, end, data[key_start:payload_start].decode('utf-8'), data[payload_start:end]
+        offset = end
+
+
+class Spool(object):
+    """
+    Durable, segmented append-only log of routed messages
+
+    Messages are appended to segment files in :directory (a new segment is started once the current
+    one reaches :segment_size bytes) and fsynced in batches: once per send_messages call and every
+    :fsync_every messages. Only fsynced messages are delivered.
+
+    Every backend is drained by its own thread, reading segments with mmap, delivering batches of at
+    most :batch_size messages with the current routing snapshot of the connection given to start and
+    recording how far it got (its ack offset) in acks.json. Backends added by reconfiguring the connection
+    get their thread, the messages of removed ones are kept until they are configured again. The ack offset
+    only moves past delivered messages: when a batch raises or some of its messages are not sent the
+    thread waits :poll_interval seconds and retries from the first message not sent. On startup
+    messages past the ack offset of their backend are delivered again; segments fully acknowledged
+    by all their backends are deleted.
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, fsync_every=1000, batch_size=100,
+                 poll_interval=1.0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_every = fsync_every
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lock = threading.RLock()
+        self.appended = threading.Condition(self.lock)
+        self.acked = threading.Condition(self.lock)
+        self.segments = []
+        self.unsynced = 0
+        self.threads = {}
+        self.connection = None
+        self.routing = None
+        self.stopped = False
+        self.sent = 0
+        self.failed = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.acks = self.load_acks()
+        self.recover()
+        self.committed = self.segments[-1].end
+        self.file = open(self.segments[-1].path, 'ab')
+
+    def segment_path(self, base):
+        return os.path.join(self.directory, '%020d%s' % (base, SEGMENT_SUFFIX))
+
+    def load_acks(self):
+        try:
+            with open(os.path.join(self.directory, ACKS_FILE)) as acks_file:
+                return json.load(acks_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save_acks(self):
+        path = os.path.join(self.directory, ACKS_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as acks_file:
+            json.dump(self.acks, acks_file)
+            acks_file.flush()
+            os.fsync(acks_file.fileno())
+        os.rename(tmp_path, path)
+
+    def recover(self):
+        """
+        Loads the existing segments, dropping the incomplete record a crash may have left at the end of the log
+        """
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        for name in names:
+            segment = Segment(os.path.join(self.directory, name), int(name[:-len(SEGMENT_SUFFIX)]))
+            size = os.path.getsize(segment.path)
+            valid_size = 0
+            if size:
+                with open(segment.path, 'rb') as segment_file:
+                    data = mmap.mmap(segment_file.fileno(), size, access=mmap.ACCESS_READ)
+                    try:
+                        for start, end, backend_key, payload in iter_records(data):
+                            segment.backends.add(backend_key)
+                            valid_size = end
+                    finally:
+                        data.close()
+            if valid_size < size:
+                with open(segment.path, 'r+b') as segment_file:
+                    segment_file.truncate(valid_size)
+            segment.size = valid_size
+            self.segments.append(segment)
+
+        if not self.segments:
+            # offsets keep growing after compaction so that acknowledged offsets are never reused
+            base = max([0] + list(self.acks.values()))
+            self.segments.append(Segment(self.segment_path(base), base))
+            open(self.segments[-1].path, 'ab').close()
+
+    def roll(self):
+        self.sync()
+        self.file.close()
+        segment = Segment(self.segment_path(self.segments[-1].end), self.segments[-1].end)
+        self.segments.append(segment)
+        self.file = open(segment.path, 'ab')
+
+    def append(self, backend_key, message):
+        message = copy.copy(message)
+        message.connection = None
+        payload = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        key = backend_key.encode('utf-8')
+        record = RECORD_HEADER.pack(len(payload), len(key)) + key + payload
+        with self.lock:
+            if self.segments[-1].size >= self.segment_size:
+                self.roll()
+            segment = self.segments[-1]
+            self.file.write(record)
+            segment.size += len(record)
+            segment.backends.add(backend_key)
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_every:
+                self.sync()
+
+    def sync(self):
+        with self.lock:
+            if not self.unsynced:
+                return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+            self.committed = self.segments[-1].end
+            self.appended.notify_all()
+
+    def read(self, backend_key, position, limit):
+        """
+        Returns up to :limit (position, message) tuples of :backend_key found after :position and
+        the position where reading stopped
+        """
+        with self.lock:
+            segments = [segment for segment in self.segments if segment.end > position]
+            committed = self.committed
+        records = []
+        for segment in segments:
+            length = min(segment.size, committed - segment.base)
+            if length <= 0:
+                break
+            offset = max(position - segment.base, 0)
+            try:
+                segment_file = open(segment.path, 'rb')
+            except (IOError, OSError):
+                # compacted meanwhile: it had nothing left to deliver for this backend
+                position = max(position, segment.base + length)
+                continue
+            with segment_file:
+                data = mmap.mmap(segment_file.fileno(), length, access=mmap.ACCESS_READ)
+                try:
+                    for start, end, record_key, payload in iter_records(data, offset):
+                        position = segment.base + end
+                        if record_key == backend_key:
+                            records.append((segment.base + start, pickle.loads(payload)))
+                            if len(records) >= limit:
+                                return records, position
+                finally:
+                    data.close()
+            position = max(position, segment.base + length)
+        return records, position
+
+    def ack(self, backend_key, position):
+        with self.lock:
+            self.acks[backend_key] = position
+            self.save_acks()
+            self.compact()
+            self.acked.notify_all()
+
+    def compact(self):
+        for segment in list(self.segments[:-1]):
+            if all(self.acks.get(backend_key, 0) >= segment.end for backend_key in segment.backends):
+                os.remove(segment.path)
+                self.segments.remove(segment)
+
+    def start(self, connection):
+        """
+        Starts delivering spooled messages with :connection, one thread per backend of its current routing snapshot
+        """
+        with self.lock:
+            self.connection = connection
+            self.routing = connection.routing
+            for backend_key in self.routing.backends_settings:
+                if backend_key in self.threads:
+                    continue
+                thread = threading.Thread(target=self.drain, args=(backend_key, ), name='email-spool-%s' % backend_key)
+                thread.daemon = True
+                self.threads[backend_key] = thread
+                thread.start()
+
+    def get_ack(self, backend_key):
+        return self.acks.get(backend_key, self.segments[0].base)
+
+    def deliver(self, connection, backend_key, records):
+        """
+        Sends :records with :connection, returns the number of sent messages and the position of the
+        first message not sent (None when all were sent)
+        """
+        sent = 0
+        unsent = []
+        try:
+            for delivered_key, chunk, count in connection.deliver(backend_key, records):
+                sent += count
+                if not count:
+                    unsent.extend(position for position, email in chunk)
+        except Exception:
+            logger.exception('Error sending %d spooled emails with %s', len(records), backend_key)
+            return 0, records[0][0]
+        return sent, min(unsent) if unsent else None
+
+    def backoff(self):
+        deadline = time.time() + self.poll_interval
+        with self.lock:
+            while not self.stopped:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                self.appended.wait(remaining)
+
+    def drain(self, backend_key):
+        while not self.stopped:
+            # every batch is sent with the routing snapshot current when it starts
+            connection = self.connection.pin()
+            if connection.routing is not self.routing:
+                self.start(self.connection)
+            if backend_key not in connection.backends_settings:
+                self.backoff()
+                continue
+            with self.lock:
+                position = self.get_ack(backend_key)
+            records, next_position = self.read(backend_key, position, self.batch_size)
+            unsent = None
+            if records:
+                sent, unsent = self.deliver(connection, backend_key, records)
+                with self.lock:
+                    self.sent += sent
+                    self.failed += len(records) - sent
+            if unsent is not None:
+                # the messages from the first one not sent are read and sent again after a while
+                if unsent > position:
+                    self.ack(backend_key, unsent)
+                self.backoff()
+                continue
+            if next_position > position:
+                self.ack(backend_key, next_position)
+            if not records:
+                with self.lock:
+                    if not self.stopped and self.committed <= next_position:
+                        self.appended.wait(self.poll_interval)
+
+    def is_drained(self):
+        if self.routing is None:
+            return True
+        return all(
+            self.get_ack(backend_key) >= self.committed
+            for backend_key in self.threads if backend_key in self.routing.backends_settings
+        )
+
+    def flush(self, timeout=None):
+        """
+        Waits until every spooled message is delivered, returns False if :timeout seconds passed first
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        self.sync()
+        with self.lock:
+            while not self.is_drained():
+                if deadline is None:
+                    self.acked.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.acked.wait(remaining)
+        return True
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.sync()
+            self.appended.notify_all()
+        for thread in self.threads.values():
+            thread.join()
+        self.file.close()
+
+
+_spool = None
+_spool_lock = threading.Lock()
+
+def get_spool():
+    """
+    Returns the process-wide spool configured with EMAIL_BACKENDS_SPOOL
+    """
+    global _spool
+    with _spool_lock:
+        if _spool is None:
+            _spool = Spool(**conf.EMAIL_BACKENDS_SPOOL)
+    return _spool
+
+
+class SpooledEmailMultiServerBackend(EmailMultiServerBackend):
+    """
+    Routes messages like EmailMultiServerBackend and appends them to a durable spool, delivered in the background;
+    send_messages returns the number of spooled messages
+    """
+
+    def __init__(self, spool=None, **kwargs):
+        super(SpooledEmailMultiServerBackend, self).__init__(**kwargs)
+        self.spool = spool or get_spool()
+        self.spool.start(self)
+
+    def reconfigure(self, weights=None, conditions=None, backends=None):
+        routing = super(SpooledEmailMultiServerBackend, self).reconfigure(weights, conditions, backends)
+        # the backends added are drained right away
+        self.spool.start(self)
+        return routing
+
+    def send_messages(self, email_messages):
+        spooled = 0
+
+        if not hasattr(email_messages, '__iter__'):
+            email_messages = [email_messages]
+
+        for backend_key, chunk in self.get_chunks(email_messages):
+            for position, email in chunk:
+                self.spool.append(backend_key, email)
+                spooled += 1
+        self.spool.sync()
+        return spooled
+
+    def flush(self, timeout=None):
+        return self.spool.flush(timeout)
@@ -3,11 +3,43 @@ try:
 except ImportError:
     import unittest
 
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from concurrent.futures import TimeoutError
+from io import StringIO
+from django_email_multibackend.aio import AsyncEmailMultiServerBackend
+from django_email_multibackend.campaign import send_campaign
 from django_email_multibackend.backends import EmailMultiServerBackend, weighted_choice_by_val
 from django.core.mail import EmailMessage
 from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.backends.smtp import EmailBackend as SMTPEmailBackend
 from django.conf import settings
-from django_email_multibackend.conditions import MatchAll
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test.utils import override_settings
+from django_email_multibackend.conditions import BaseCondition, FilterMailByHeader, FilterMailByRecipientDomain, MatchAll
+from django_email_multibackend.adaptive import AdaptiveWeights
+from django_email_multibackend.circuit import CircuitBreakers
+from django_email_multibackend.management.commands.send_campaign import Command as SendCampaignCommand
+from django_email_multibackend.management.commands.simulate_routing import Command as SimulateRoutingCommand
+from django_email_multibackend.metrics import Metrics
+from django_email_multibackend.pool import ConnectionPool
+from django_email_multibackend.queued import QueuedEmailMultiServerBackend, QueueFull, SendQueue
+from django_email_multibackend.ratelimit import RateLimiters
+from django_email_multibackend.signals import post_send, pre_route
+from django_email_multibackend.simulation import get_profile_message, numpy, simulate
+from django_email_multibackend.spool import Spool, SpooledEmailMultiServerBackend
+from django_email_multibackend.watcher import ConfigWatcher, yaml
+from smtplib import SMTPServerDisconnected
+from django_email_multibackend.routing import RoutingTable
 
 
 class SendMailException(Exception):
@@ -51,11 +83,241 @@ class FakeSendingBackend(BackendAssertionsMixin, BaseEmailBackend):
             return len(email_messages)
 
 
+class RecordingBackend(FakeSendingBackend):
+    def __init__(self, *args, **kwargs):
+        super(RecordingBackend, self).__init__(*args, **kwargs)
+        self.calls = []
+
+    def send_messages(self, email_messages):
+        self.calls.append(list(email_messages))
+        return super(RecordingBackend, self).send_messages(email_messages)
+
+
+class ConnectionTrackingBackend(FakeSendingBackend):
+    opened = 0
+    closed = 0
+    disconnect = False
+
+    def open(self):
+        ConnectionTrackingBackend.opened += 1
+        return True
+
+    def close(self):
+        ConnectionTrackingBackend.closed += 1
+
+    def send_messages(self, email_messages):
+        if ConnectionTrackingBackend.disconnect:
+            ConnectionTrackingBackend.disconnect = False
+            raise SMTPServerDisconnected()
+        return super(ConnectionTrackingBackend, self).send_messages(email_messages)
+
+
+class SleepingBackend(FakeSendingBackend):
+    delay = 0.1
+    lock = threading.Lock()
+    running = 0
+    max_running = 0
+    started = []
+
+    def send_messages(self, email_messages):
+        with SleepingBackend.lock:
+            SleepingBackend.started.append(email_messages[0].extra_headers.get('X-BACKEND'))
+            SleepingBackend.running += 1
+            SleepingBackend.max_running = max(SleepingBackend.max_running, SleepingBackend.running)
+        time.sleep(self.delay)
+        with SleepingBackend.lock:
+            SleepingBackend.running -= 1
+        return super(SleepingBackend, self).send_messages(email_messages)
+
+
+class FakeAsyncBackend(FakeSendingBackend):
+    running = 0
+    max_running = 0
+
+    async def asend_messages(self, email_messages):
+        FakeAsyncBackend.running += 1
+        FakeAsyncBackend.max_running = max(FakeAsyncBackend.max_running, FakeAsyncBackend.running)
+        await asyncio.sleep(0.05)
+        FakeAsyncBackend.running -= 1
+        return len(email_messages)
+
+    def send_messages(self, email_messages):
+        raise AssertionError('asend_messages should be used')
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP to receive messages from smtplib
+    """
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 fake ESMTP')
+        for line in self.rfile:
+            command = line.strip().upper()
+            if command.startswith(b'DATA'):
+                self.reply('354 end data with <CR><LF>.<CR><LF>')
+                data = []
+                for data_line in self.rfile:
+                    if data_line in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(data_line)
+                self.server.received(b''.join(data))
+                self.reply('250 queued')
+            elif command.startswith(b'QUIT'):
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    In-process SMTP server stand-in listening on a random local port
+
+    >>> with FakeSMTPServer() as server:
+    ...     server.port > 0
+    True
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeSMTPHandler)
+        self.port = self.server_address[1]
+        self.messages = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.connections = []
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections.append(request)
+        socketserver.ThreadingTCPServer.process_request(self, request, client_address)
+
+    def drop_connections(self):
+        """
+        Closes the open client connections from the server side
+        """
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def received(self, data):
+        with self.lock:
+            self.messages.append(data)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+    def backend_settings(self):
+        return {
+            'backend': 'django.core.mail.backends.smtp.EmailBackend',
+            'host': '127.0.0.1',
+            'port': self.port,
+        }
+
+
+class SlowBackend(FakeSendingBackend):
+    delay = 0.02
+
+    def send_messages(self, email_messages):
+        time.sleep(self.delay)
+        return super(SlowBackend, self).send_messages(email_messages)
+
+
+class FastBackend(SlowBackend):
+    delay = 0.002
+
+
+class FlakyBackend(FakeSendingBackend):
+    fail = True
+    calls = 0
+
+    def send_messages(self, email_messages):
+        FlakyBackend.calls += 1
+        if FlakyBackend.fail:
+            raise SendMailException()
+        return super(FlakyBackend, self).send_messages(email_messages)
+
+
+class RecoveringBackend(RecordingBackend):
+    fail = True
+    failures = 0
+
+    def send_messages(self, email_messages):
+        if RecoveringBackend.fail:
+            RecoveringBackend.failures += 1
+            raise SendMailException()
+        return super(RecoveringBackend, self).send_messages(email_messages)
+
+
+class GatedBackend(RecordingBackend):
+    gate = threading.Event()
+
+    def send_messages(self, email_messages):
+        GatedBackend.gate.wait(5)
+        return super(GatedBackend, self).send_messages(email_messages)
+
+
+class BlockingBackend(FakeSendingBackend):
+    started = threading.Event()
+    release = threading.Event()
+
+    def send_messages(self, email_messages):
+        BlockingBackend.started.set()
+        BlockingBackend.release.wait(5)
+        return super(BlockingBackend, self).send_messages(email_messages)
+
+
 class NoConnectionBackend(BackendAssertionsMixin, BaseEmailBackend):
     def send_messages(self, email_messages):
         super(NoConnectionBackend, self).send_messages(email_messages)
         # Replicates django smtp.py behaviour
 
+class CountingCondition(MatchAll):
+    instances = 0
+
+    def __init__(self, **kwargs):
+        super(CountingCondition, self).__init__(**kwargs)
+        CountingCondition.instances += 1
+
+class MailTypeCondition(BaseCondition):
+    """
+    Excludes non-transactional messages, declaring its header but not its clause
+    """
+
+    def check(self, message):
+        return message.extra_headers.get('X-MAIL-TYPE') != 'non-transactional'
+
+    def get_headers(self):
+        return ('X-MAIL-TYPE', )
+
+class SubjectCondition(BaseCondition):
+    def check(self, message):
+        return message.subject != 'buy this'
+
+class HeaderPrefixCondition(FilterMailByHeader):
+    """
+    Matches header values starting with the configured value, overriding check only
+    """
+
+    def check(self, message):
+        header_name, prefix = self.params['header']
+        return message.extra_headers.get(header_name, '').startswith(prefix)
+
 transactional_email = EmailMessage('password reset', to=['tbarbugli@gmail.com'])
 transactional_email.extra_headers['X-MAIL-TYPE'] = 'transactional'
 
@@ -156,6 +418,931 @@ class TestMultiBackendEmail(unittest.TestCase):
         messages = [EmailMessage(), EmailMessage(), EmailMessage(), EmailMessage()]
         self.assertEquals(4, instance.send_messages(messages))
 
+    def test_backends_created_lazily(self):
+        test_backends = {
+            'mailjet': {'backend': 'django_email_multibackend.tests.FakeSendingBackend'},
+            'mailchimp': {'backend': 'django_email_multibackend.tests.FakeSendingBackend'},
+        }
+        instance = EmailMultiServerBackend(backends=test_backends, backend_weights=(('mailjet', 1), ('mailchimp', 0)))
+        self.assertEqual({}, dict(instance.servers))
+        self.assertEqual(2, instance.send_messages([EmailMessage(), EmailMessage()]))
+        self.assertEqual(['mailjet'], list(instance.servers))
+        self.assertTrue(instance.servers['mailjet'] is instance.get_backend(EmailMessage()))
+
+    def test_settings_not_mutated(self):
+        test_backends = {
+            'mailjet': {'backend': 'django_email_multibackend.tests.FakeSendingBackend', 'rate_limit': 10},
+        }
+        instance = EmailMultiServerBackend(backends=test_backends, fail_silently=True)
+        self.assertEqual(
+            {'mailjet': {'backend': 'django_email_multibackend.tests.FakeSendingBackend', 'rate_limit': 10}},
+            test_backends
+        )
+        self.assertTrue(instance.servers['mailjet'].fail_silently)
+
+    def test_bad_backend_path(self):
+        test_backends = {
+            'mailjet': {'backend': 'django_email_multibackend.tests.MissingBackend'},
+        }
+        self.assertRaises(ImproperlyConfigured, EmailMultiServerBackend, backends=test_backends)
+
+
+class TestBatchedDispatch(unittest.TestCase):
+    backends = {
+        'mailjet': {
+            'backend': 'django_email_multibackend.tests.RecordingBackend',
+        },
+        'mailchimp': {
+            'backend': 'django_email_multibackend.tests.RecordingBackend',
+        },
+    }
+
+    def test_one_call_per_chunk(self):
+        instance = EmailMultiServerBackend(backends=self.backends, batch_size=2)
+        messages = [transactional_email, campaign_email] * 3
+        self.assertEqual(6, instance.send_messages(messages))
+        for backend in instance.servers.values():
+            self.assertTrue(all(len(call) <= 2 for call in backend.calls))
+        mailchimp_messages = sum(instance.servers['mailchimp'].calls, [])
+        self.assertEqual(3, mailchimp_messages.count(campaign_email))
+
+    def test_default_sends_one_by_one(self):
+        instance = EmailMultiServerBackend(backends=self.backends)
+        self.assertEqual(3, instance.send_messages([campaign_email] * 3))
+        self.assertEqual([[campaign_email]] * 3, instance.servers['mailchimp'].calls)
+
+    def test_results_in_input_order(self):
+        instance = EmailMultiServerBackend(backends=self.backends, batch_size=10)
+        messages = [campaign_email, transactional_email, campaign_email]
+        send_count, results = instance.dispatch(messages)
+        self.assertEqual(3, send_count)
+        self.assertEqual(3, len(results))
+        self.assertEqual(('mailchimp', True), results[0])
+        self.assertEqual(('mailchimp', True), results[2])
+        self.assertEqual(True, results[1][1])
+
+    def test_results_not_sent(self):
+        test_backends = {
+            'mailjet': {
+                'backend': 'django_email_multibackend.tests.NoConnectionBackend',
+            },
+        }
+        instance = EmailMultiServerBackend(backends=test_backends, backend_weights=(('mailjet', 1), ), batch_size=10)
+        self.assertEqual((0, [('mailjet', False)] * 2), instance.dispatch([EmailMessage(), EmailMessage()]))
+
+
+class StreamRecordingBackend(FakeSendingBackend):
+    """
+    Records how many messages the stream produced when each call was made
+    """
+    stream = None
+    produced_at_send = []
+
+    def send_messages(self, email_messages):
+        StreamRecordingBackend.produced_at_send.append(StreamRecordingBackend.stream.produced)
+        return super(StreamRecordingBackend, self).send_messages(email_messages)
+
+
+class MessageStream(object):
+
+    def __init__(self, count, delay=0):
+        self.count = count
+        self.delay = delay
+        self.produced = 0
+
+    def __iter__(self):
+        for i in range(self.count):
+            if self.delay:
+                time.sleep(self.delay)
+            self.produced += 1
+            yield EmailMessage()
+
+
+class TestStreamingDispatch(unittest.TestCase):
+    backends = {
+        'mailjet': {
+            'backend': 'django_email_multibackend.tests.StreamRecordingBackend',
+        },
+    }
+    weights = (('mailjet', 1), )
+
+    def send(self, stream, **kwargs):
+        StreamRecordingBackend.stream = stream
+        StreamRecordingBackend.produced_at_send = []
+        instance = EmailMultiServerBackend(backends=self.backends, backend_weights=self.weights, **kwargs)
+        return instance.send_messages(iter(stream))
+
+    def test_batches_pulled_lazily(self):
+        self.assertEqual(1000, self.send(MessageStream(1000), batch_size=10))
+        self.assertEqual(list(range(10, 1001, 10)), StreamRecordingBackend.produced_at_send)
+
+    def test_batch_window(self):
+        self.assertEqual(6, self.send(MessageStream(6, delay=0.02), batch_size=100, batch_window=0.03))
+        # buffers are flushed every other message instead of waiting for 100 messages
+        self.assertTrue(len(StreamRecordingBackend.produced_at_send) >= 2)
+        self.assertTrue(StreamRecordingBackend.produced_at_send[0] < 6)
+
+    def test_concurrent_pending_chunks_bounded(self):
+        self.assertEqual(1000, self.send(MessageStream(1000), batch_size=10, max_workers=2))
+        # at most 2 * max_workers chunks are pending, plus the buffer being filled
+        self.assertTrue(StreamRecordingBackend.produced_at_send[0] <= 50)
+
+    def test_count_reported_by_children(self):
+        test_backends = {
+            'mailjet': {'backend': 'django_email_multibackend.tests.RecordingBackend'},
+            'mailchimp': {'backend': 'django_email_multibackend.tests.NoConnectionBackend'},
+        }
+        instance = EmailMultiServerBackend(
+            backends=test_backends, backend_weights=(('mailjet', 1), ('mailchimp', 1)), batch_size=7
+        )
+        send_count = instance.send_messages(EmailMessage() for i in range(100))
+        self.assertEqual(len(sum(instance.servers['mailjet'].calls, [])), send_count)
+
+
+class TestConcurrentDispatch(unittest.TestCase):
+    backends = {
+        'mailjet': {
+            'backend': 'django_email_multibackend.tests.SleepingBackend',
+        },
+        'mailchimp': {
+            'backend': 'django_email_multibackend.tests.SleepingBackend',
+        },
+    }
+    weights = (('mailjet', 1), ('mailchimp', 1))
+
+    def setUp(self):
+        SleepingBackend.delay = 0.1
+        SleepingBackend.running = 0
+        SleepingBackend.max_running = 0
+        SleepingBackend.started = []
+
+    def get_instance(self, **kwargs):
+        conditions = dict(
+            (backend_key, [('django_email_multibackend.conditions.FilterMailByHeader', {'header': ('X-BACKEND', backend_key)})])
+            for backend_key in ('mailjet', 'mailchimp')
+        )
+        return EmailMultiServerBackend(
+            backends=self.backends, backend_weights=self.weights, routing_table=RoutingTable(conditions), **kwargs
+        )
+
+    def get_mails(self, backend_keys):
+        mails = []
+        for backend_key in backend_keys:
+            mail = EmailMessage()
+            mail.extra_headers['X-BACKEND'] = backend_key
+            mails.append(mail)
+        return mails
+
+    def test_backends_sent_in_parallel(self):
+        instance = self.get_instance(batch_size=10, max_workers=4)
+        self.assertEqual(2, instance.send_messages(self.get_mails(['mailjet', 'mailchimp'])))
+        self.assertEqual(2, SleepingBackend.max_running)
+
+    def test_workers_not_blocked_by_busy_backend(self):
+        # with one chunk at a time per backend, the chunks of mailchimp run alongside the ones of mailjet
+        SleepingBackend.delay = 0.02
+        instance = self.get_instance(max_workers=2)
+        self.assertEqual(6, instance.send_messages(self.get_mails(['mailjet'] * 3 + ['mailchimp'] * 3)))
+        self.assertEqual(['mailchimp', 'mailjet'], sorted(SleepingBackend.started[:2]))
+
+    def test_max_workers_per_backend(self):
+        instance = EmailMultiServerBackend(
+            backends=self.backends, backend_weights=(('mailjet', 1), ('mailchimp', 0)),
+            max_workers=4, max_workers_per_backend={'mailjet': 2}
+        )
+        SleepingBackend.delay = 0.05
+        self.assertEqual(6, instance.send_messages([EmailMessage() for i in range(6)]))
+        self.assertEqual(2, SleepingBackend.max_running)
+
+    def test_exception_raised_after_all_chunks(self):
+        test_backends = {
+            'mailjet': {
+                'backend': 'django_email_multibackend.tests.FakeCampaignMailBackend',
+            },
+            'mailchimp': {
+                'backend': 'django_email_multibackend.tests.RecordingBackend',
+            },
+        }
+        mails = [EmailMessage() for i in range(10)]
+        instance = EmailMultiServerBackend(backends=test_backends, backend_weights=self.weights, batch_size=1, max_workers=2)
+        self.assertRaises(SentCampaignException, instance.send_messages, mails)
+        instance = EmailMultiServerBackend(
+            backends=test_backends, backend_weights=self.weights, batch_size=1, max_workers=2, fail_silently=True
+        )
+        send_count, results = instance.dispatch(mails)
+        self.assertEqual(len(instance.servers['mailchimp'].calls), send_count)
+        for backend_key, sent in results:
+            self.assertEqual(backend_key == 'mailchimp', sent)
+
+    def test_fail_silently_sequential_and_concurrent(self):
+        test_backends = {
+            'mailjet': {
+                'backend': 'django_email_multibackend.tests.FakeCampaignMailBackend',
+            },
+            'mailchimp': {
+                'backend': 'django_email_multibackend.tests.RecordingBackend',
+            },
+        }
+        conditions = dict(
+            (backend_key, [('django_email_multibackend.conditions.FilterMailByHeader', {'header': ('X-BACKEND', backend_key)})])
+            for backend_key in ('mailjet', 'mailchimp')
+        )
+        mails = self.get_mails(['mailjet', 'mailchimp', 'mailjet', 'mailchimp'])
+        dispatched = []
+        for max_workers in (0, 2):
+            instance = EmailMultiServerBackend(
+                backends=test_backends, backend_weights=self.weights, routing_table=RoutingTable(conditions),
+                batch_size=1, max_workers=max_workers, fail_silently=True
+            )
+            dispatched.append(instance.dispatch(mails))
+        self.assertEqual((2, [('mailjet', False), ('mailchimp', True)] * 2), dispatched[0])
+        self.assertEqual(dispatched[0], dispatched[1])
+
+    def test_timeout(self):
+        SleepingBackend.delay = 0.3
+        instance = EmailMultiServerBackend(
+            backends=self.backends, backend_weights=self.weights, max_workers=2, send_timeout=0.05
+        )
+        self.assertRaises(TimeoutError, instance.send_messages, [EmailMessage()])
+
+    def test_timeout_while_sending(self):
+        # the first chunk is being sent when it times out, the second one was never started
+        SleepingBackend.delay = 0.3
+        instance = EmailMultiServerBackend(
+            backends=self.backends, backend_weights=(('mailjet', 1), ('mailchimp', 0)), batch_size=1,
+            max_workers=1, send_timeout=0.05, fail_silently=True
+        )
+        send_count, results = instance.dispatch([EmailMessage(), EmailMessage()])
+        self.assertEqual(0, send_count)
+        self.assertEqual([('mailjet', None), ('mailjet', False)], results)
+
+
+class TestAsyncBackend(unittest.TestCase):
+
+    def setUp(self):
+        FakeAsyncBackend.running = 0
+        FakeAsyncBackend.max_running = 0
+
+    def test_async_children_awaited(self):
+        test_backends = {
+            'mailjet': {
+                'backend': 'django_email_multibackend.tests.FakeAsyncBackend',
+            },
+        }
+        instance = AsyncEmailMultiServerBackend(
+            backends=test_backends, backend_weights=(('mailjet', 1), ), max_workers_per_backend={'mailjet': 3}
+        )
+        mails = [EmailMessage() for i in range(5)]
+        self.assertEqual(5, asyncio.run(instance.send_messages(mails)))
+        self.assertEqual(3, FakeAsyncBackend.max_running)
+
+    def test_sync_children_run_in_executor(self):
+        with FakeSMTPServer() as server:
+            test_backends = {
+                'mailjet': server.backend_settings(),
+                'mailchimp': {
+                    'backend': 'django_email_multibackend.tests.FakeAsyncBackend',
+                },
+            }
+            instance = AsyncEmailMultiServerBackend(
+                backends=test_backends, backend_weights=(('mailjet', 1), ('mailchimp', 1)), batch_size=5
+            )
+            mails = [EmailMessage('hi', 'body', 'from@example.com', ['to@example.com']) for i in range(10)]
+            send_count, results = asyncio.run(instance.dispatch(mails))
+            self.assertEqual(10, send_count)
+            self.assertEqual([True] * 10, [sent for backend_key, sent in results])
+            smtp_count = len([backend_key for backend_key, sent in results if backend_key == 'mailjet'])
+            self.assertEqual(smtp_count, len(server.messages))
+
+    def test_exception(self):
+        test_backends = {
+            'mailjet': {
+                'backend': 'django_email_multibackend.tests.FakeCampaignMailBackend',
+            },
+        }
+        instance = AsyncEmailMultiServerBackend(backends=test_backends, backend_weights=(('mailjet', 1), ))
+        self.assertRaises(SentCampaignException, asyncio.run, instance.send_messages([EmailMessage()]))
+        self.assertEqual(0, asyncio.run(instance.send_messages([])))
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestConnections(unittest.TestCase):
+    backends = {
+        'mailjet': {
+            'backend': 'django_email_multibackend.tests.ConnectionTrackingBackend',
+        },
+    }
+    weights = (('mailjet', 1), )
+
+    def setUp(self):
+        ConnectionTrackingBackend.opened = 0
+        ConnectionTrackingBackend.closed = 0
+        ConnectionTrackingBackend.disconnect = False
+
+    def test_open_close_cascade(self):
+        with EmailMultiServerBackend(backends=self.backends, backend_weights=self.weights) as instance:
+            # backends are created, and opened, when first selected
+            self.assertEqual(0, ConnectionTrackingBackend.opened)
+            self.assertEqual(1, instance.send_messages([EmailMessage()]))
+            self.assertEqual(1, ConnectionTrackingBackend.opened)
+        self.assertEqual(1, ConnectionTrackingBackend.closed)
+
+    def test_pool_reused_across_instances(self):
+        pool = ConnectionPool()
+        for i in range(3):
+            instance = EmailMultiServerBackend(
+                backends=self.backends, backend_weights=self.weights, connection_pool=pool
+            )
+            self.assertEqual(1, instance.send_messages([EmailMessage()]))
+            instance.close()
+        self.assertEqual(1, ConnectionTrackingBackend.opened)
+        self.assertEqual(0, ConnectionTrackingBackend.closed)
+        pool.clear()
+        self.assertEqual(1, ConnectionTrackingBackend.closed)
+
+    def test_pool_idle_timeout(self):
+        clock = FakeClock()
+        pool = ConnectionPool(idle_timeout=10, clock=clock)
+        instance = EmailMultiServerBackend(backends=self.backends, backend_weights=self.weights, connection_pool=pool)
+        instance.send_messages([EmailMessage()])
+        clock.now = 5
+        instance.send_messages([EmailMessage()])
+        self.assertEqual(1, ConnectionTrackingBackend.opened)
+        clock.now = 16
+        instance.send_messages([EmailMessage()])
+        self.assertEqual(2, ConnectionTrackingBackend.opened)
+        self.assertEqual(1, ConnectionTrackingBackend.closed)
+
+    def test_pool_max_age(self):
+        clock = FakeClock()
+        pool = ConnectionPool(idle_timeout=None, max_age=10, clock=clock)
+        instance = EmailMultiServerBackend(backends=self.backends, backend_weights=self.weights, connection_pool=pool)
+        for now in (0, 5, 10, 15):
+            clock.now = now
+            instance.send_messages([EmailMessage()])
+        self.assertEqual(2, ConnectionTrackingBackend.opened)
+
+    def test_pool_reconnect(self):
+        pool = ConnectionPool()
+        instance = EmailMultiServerBackend(backends=self.backends, backend_weights=self.weights, connection_pool=pool)
+        instance.open()
+        ConnectionTrackingBackend.disconnect = True
+        self.assertEqual(1, instance.send_messages([EmailMessage()]))
+        self.assertEqual(2, ConnectionTrackingBackend.opened)
+        self.assertEqual(1, ConnectionTrackingBackend.closed)
+
+    def test_pool_reconnect_fail_silently(self):
+        pool = ConnectionPool()
+        with FakeSMTPServer() as server:
+            instance = EmailMultiServerBackend(
+                backends={'mailjet': server.backend_settings()}, backend_weights=(('mailjet', 1), ),
+                connection_pool=pool, fail_silently=True
+            )
+            sent = []
+            for i in range(3):
+                sent.append(instance.send_messages([EmailMessage('subject', 'body', 'from@example.com', ['to@example.com'])]))
+                server.drop_connections()
+            pool.clear()
+        self.assertEqual([1, 1, 1], sent)
+        self.assertEqual(3, len(server.messages))
+
+
+class TestFailover(unittest.TestCase):
+    backends = {
+        'mailjet': {
+            'backend': 'django_email_multibackend.tests.FlakyBackend',
+        },
+        'mailchimp': {
+            'backend': 'django_email_multibackend.tests.RecordingBackend',
+        },
+    }
+    weights = (('mailjet', 1000), ('mailchimp', 1))
+
+    def setUp(self):
+        FlakyBackend.fail = True
+        FlakyBackend.calls = 0
+
+    def test_no_failover(self):
+        instance = EmailMultiServerBackend(backends={'mailjet': self.backends['mailjet']}, backend_weights=(('mailjet', 1), ))
+        self.assertRaises(SendMailException, instance.send_messages, [EmailMessage()])
+
+    def test_failover_on_exception(self):
+        instance = EmailMultiServerBackend(backends=self.backends, backend_weights=self.weights, failover=True, batch_size=2)
+        mails = [EmailMessage() for i in range(5)]
+        send_count, results = instance.dispatch(mails)
+        self.assertEqual(5, send_count)
+        self.assertEqual([('mailchimp', True)] * 5, results)
+        self.assertEqual(5, len(sum(instance.servers['mailchimp'].calls, [])))
+
+    def test_failover_on_nothing_sent(self):
+        test_backends = dict(self.backends, mailjet={'backend': 'django_email_multibackend.tests.NoConnectionBackend'})
+        instance = EmailMultiServerBackend(backends=test_backends, backend_weights=self.weights, failover=True)
+        self.assertEqual(3, instance.send_messages([EmailMessage() for i in range(3)]))
+
+    def test_failover_exhausted(self):
+        instance = EmailMultiServerBackend(
+            backends=self.backends, backend_weights=self.weights, failover=True, routing_table=RoutingTable({
+                'mailchimp': [('django_email_multibackend.conditions.FilterMailByHeader', {'header': ('X-MAIL-TYPE', 'transactional')})],
+            })
+        )
+        self.assertRaises(SendMailException, instance.send_messages, [campaign_email])
+        instance.fail_silently = True
+        self.assertEqual((0, [('mailjet', False)]), instance.dispatch([campaign_email]))
+
+    def test_failover_concurrent(self):
+        instance = EmailMultiServerBackend(
+            backends=self.backends, backend_weights=self.weights, failover=True, max_workers=2
+        )
+        self.assertEqual(4, instance.send_messages([EmailMessage() for i in range(4)]))
+
+    def test_failover_async(self):
+        instance = AsyncEmailMultiServerBackend(backends=self.backends, backend_weights=self.weights, failover=True)
+        self.assertEqual(4, asyncio.run(instance.send_messages([EmailMessage() for i in range(4)])))
+
+    def test_circuit_breaker(self):
+        clock = FakeClock()
+        breakers = CircuitBreakers(failure_threshold=2, reset_timeout=10, clock=clock)
+        instance = EmailMultiServerBackend(
+            backends=self.backends, backend_weights=self.weights, failover=True, circuit_breakers=breakers
+        )
+        self.assertEqual(5, instance.send_messages([EmailMessage() for i in range(5)]))
+        self.assertEqual(2, FlakyBackend.calls)
+        self.assertEqual('open', breakers.states()['mailjet'])
+
+        clock.now = 10
+        self.assertEqual('half-open', breakers.states()['mailjet'])
+        self.assertEqual(1, instance.send_messages([EmailMessage()]))
+        self.assertEqual(3, FlakyBackend.calls)
+        self.assertEqual('open', breakers.states()['mailjet'])
+
+        clock.now = 20
+        FlakyBackend.fail = False
+        self.assertEqual(1, instance.send_messages([EmailMessage()]))
+        self.assertEqual('closed', breakers.states()['mailjet'])
+
+    def test_circuit_breaker_single_probe(self):
+        clock = FakeClock()
+        breakers = CircuitBreakers(failure_threshold=1, reset_timeout=10, clock=clock)
+        instance = EmailMultiServerBackend(
+            backends=self.backends, backend_weights=self.weights, circuit_breakers=breakers
+        )
+        breakers.record('mailjet', False)
+        clock.now = 10
+        barrier = threading.Barrier(8)
+        chosen = []
+
+        def route():
+            barrier.wait()
+            chosen.append(instance.get_backend_key(EmailMessage()))
+
+        threads = [threading.Thread(target=route) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, chosen.count('mailjet'))
+        self.assertEqual(7, chosen.count('mailchimp'))
+        self.assertEqual('half-open', breakers.states()['mailjet'])
+        self.assertFalse(breakers.acquire('mailjet'))
+
+        breakers.record('mailjet', True)
+        self.assertEqual('closed', breakers.states()['mailjet'])
+        self.assertTrue(breakers.acquire('mailjet'))
+
+    def test_all_circuits_open(self):
+        breakers = CircuitBreakers(failure_threshold=1, reset_timeout=10)
+        instance = EmailMultiServerBackend(
+            backends={'mailjet': self.backends['mailjet']}, backend_weights=(('mailjet', 1), ), circuit_breakers=breakers
+        )
+        self.assertRaises(SendMailException, instance.send_messages, [EmailMessage()])
+        self.assertRaises(SendMailException, instance.send_messages, [EmailMessage()])
+        self.assertEqual(2, FlakyBackend.calls)
+
+
+class RenderCountingMessage(EmailMessage):
+    renders = 0
+
+    def message(self, *args, **kwargs):
+        RenderCountingMessage.renders += 1
+        return super(RenderCountingMessage, self).message(*args, **kwargs)
+
+
+class DisconnectingSMTPBackend(SMTPEmailBackend):
+    """
+    Reads the rendered messages then loses the connection
+    """
+
+    def send_messages(self, email_messages):
+        for message in email_messages:
+            message.message().as_bytes(linesep='\r\n')
+        raise SMTPServerDisconnected()
+
+
+class TestRenderOnce(unittest.TestCase):
+
+    def setUp(self):
+        RenderCountingMessage.renders = 0
+
+    def messages(self, count, body='body'):
+        return [
+            RenderCountingMessage('hi %d' % i, body, 'from@example.com', ['to@example.com']) for i in range(count)
+        ]
+
+    def test_rendered_once_across_failover(self):
+        with FakeSMTPServer() as server:
+            disconnecting_settings = dict(
+                server.backend_settings(), backend='django_email_multibackend.tests.DisconnectingSMTPBackend'
+            )
+            instance = EmailMultiServerBackend(
+                backends={'mailjet': disconnecting_settings, 'mailchimp': server.backend_settings()},
+                backend_weights=(('mailjet', 1000), ('mailchimp', 1)), batch_size=5, failover=True,
+                render_once={}, metrics=Metrics()
+            )
+            self.assertEqual(set(['mailjet', 'mailchimp']), instance.rendered_backends)
+            self.assertEqual(5, instance.send_messages(self.messages(5)))
+            self.assertEqual(5, len(server.messages))
+        self.assertEqual(5, RenderCountingMessage.renders)
+        self.assertEqual(5, instance.stats()['render']['count'])
+
+    def test_rendered_again_without_render_once(self):
+        with FakeSMTPServer() as server:
+            disconnecting_settings = dict(
+                server.backend_settings(), backend='django_email_multibackend.tests.DisconnectingSMTPBackend'
+            )
+            instance = EmailMultiServerBackend(
+                backends={'mailjet': disconnecting_settings, 'mailchimp': server.backend_settings()},
+                backend_weights=(('mailjet', 1), ('mailchimp', 0)), batch_size=5, failover=True
+            )
+            self.assertEqual(5, instance.send_messages(self.messages(5)))
+        self.assertEqual(10, RenderCountingMessage.renders)
+
+    def test_large_messages_spilled(self):
+        with FakeSMTPServer() as server:
+            instance = EmailMultiServerBackend(
+                backends={'mailjet': server.backend_settings()}, backend_weights=(('mailjet', 1), ),
+                render_once={'max_memory': 1024}
+            )
+            rendered = {}
+            chunk = list(enumerate(self.messages(2, body=('x' * 70 + '\n') * 100)))
+            messages = instance.get_messages('mailjet', chunk, rendered)
+            self.assertFalse(isinstance(rendered[0].rendered['\r\n'], bytes))
+            self.assertEqual(2, instance.send_chunk('mailjet', messages))
+            self.assertEqual(100, server.messages[0].count(b'x' * 70))
+            rendered[0].close()
+
+    def test_other_backends_get_messages(self):
+        instance = EmailMultiServerBackend(
+            backends={'mailjet': {'backend': 'django_email_multibackend.tests.RecordingBackend'}},
+            backend_weights=(('mailjet', 1), ), render_once={}
+        )
+        messages = self.messages(2)
+        self.assertEqual(2, instance.send_messages(messages))
+        self.assertEqual([[messages[0]], [messages[1]]], instance.servers['mailjet'].calls)
+
+
+class TestAdaptiveWeights(unittest.TestCase):
+
+    def test_latency(self):
+        test_backends = {
+            'mailjet': {
+                'backend': 'django_email_multibackend.tests.SlowBackend',
+            },
+            'mailchimp': {
+                'backend': 'django_email_multibackend.tests.FastBackend',
+            },
+        }
+        adaptive_weights = AdaptiveWeights(alpha=0.5, min_factor=0.5, max_factor=1.5)
+        instance = EmailMultiServerBackend(
+            backends=test_backends, backend_weights=(('mailjet', 10), ('mailchimp', 10)),
+            adaptive_weights=adaptive_weights
+        )
+        self.assertEqual([('mailjet', 10), ('mailchimp', 10)], instance.effective_weights())
+        while len(adaptive_weights.health) < 2:
+            instance.send_messages([EmailMessage()])
+        (slow, slow_weight), (fast, fast_weight) = instance.effective_weights()
+        self.assertTrue(5 <= slow_weight < 10 < fast_weight <= 15)
+
+    def test_latency_per_message(self):
+        adaptive_weights = AdaptiveWeights(alpha=1)
+        adaptive_weights.record('mailjet', 1.0, True, 10)
+        adaptive_weights.record('mailchimp', 0.2, True, 1)
+        self.assertEqual(1.5, adaptive_weights.get_factor('mailjet'))
+        self.assertEqual(0.75, adaptive_weights.get_factor('mailchimp'))
+
+    def test_error_rate(self):
+        adaptive_weights = AdaptiveWeights(alpha=0.5)
+        for i in range(3):
+            adaptive_weights.record('mailjet', 0.1, False)
+            adaptive_weights.record('mailchimp', 0.1, True)
+        self.assertEqual(0.12, adaptive_weights.get_factor('mailjet'))
+        self.assertEqual(1.0, adaptive_weights.get_factor('mailchimp'))
+        self.assertEqual(1.0, adaptive_weights.get_factor('sendgrid'))
+
+    def test_disabled(self):
+        instance = EmailMultiServerBackend()
+        self.assertEqual(list(settings.EMAIL_BACKENDS_WEIGHTS), instance.effective_weights())
+
+
+class TestRateLimits(unittest.TestCase):
+
+    def get_backends(self, rate_limit):
+        return {
+            'mailjet': {
+                'backend': 'django_email_multibackend.tests.RecordingBackend',
+                'rate_limit': rate_limit,
+                'rate_limit_burst': 1,
+            },
+            'mailchimp': {
+                'backend': 'django_email_multibackend.tests.RecordingBackend',
+            },
+        }
+
+    def test_rate_limit_settings_not_passed_to_backend(self):
+        instance = EmailMultiServerBackend(backends=self.get_backends(10), rate_limiters=RateLimiters())
+        self.assertFalse('rate_limit' in instance.backends_settings['mailjet'])
+        self.assertEqual(10, instance.rate_limits['mailjet'].rate)
+
+    def test_pacing_shared_across_threads(self):
+        instance = EmailMultiServerBackend(
+            backends=self.get_backends(100), backend_weights=(('mailjet', 1), ('mailchimp', 0)),
+            rate_limiters=RateLimiters()
+        )
+        start = time.time()
+        threads = [
+            threading.Thread(target=instance.send_messages, args=([EmailMessage(), EmailMessage()], ))
+            for i in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(6, len(sum(instance.servers['mailjet'].calls, [])))
+        self.assertTrue(time.time() - start >= 0.045)
+
+    def test_spillover(self):
+        instance = EmailMultiServerBackend(
+            backends=self.get_backends(1), backend_weights=(('mailjet', 1000), ('mailchimp', 1)),
+            rate_limiters=RateLimiters(), rate_limit_spillover=True
+        )
+        start = time.time()
+        self.assertEqual(5, instance.send_messages([EmailMessage() for i in range(5)]))
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(1, len(instance.servers['mailjet'].calls))
+        self.assertEqual(4, len(instance.servers['mailchimp'].calls))
+
+
+class TestQueuedBackend(unittest.TestCase):
+    backends = {
+        'mailjet': {
+            'backend': 'django_email_multibackend.tests.BlockingBackend',
+        },
+    }
+    weights = (('mailjet', 1), )
+
+    def setUp(self):
+        # new events for every test, workers of other tests never see them
+        BlockingBackend.started = threading.Event()
+        BlockingBackend.release = threading.Event()
+        self.send_queues = []
+
+    def tearDown(self):
+        BlockingBackend.release.set()
+        for send_queue in self.send_queues:
+            send_queue.stop()
+
+    def get_send_queue(self, **kwargs):
+        send_queue = SendQueue(**kwargs)
+        self.send_queues.append(send_queue)
+        return send_queue
+
+    def test_send_returns_before_delivery(self):
+        send_queue = self.get_send_queue(workers=2)
+        instance = QueuedEmailMultiServerBackend(
+            backends=self.backends, backend_weights=self.weights, send_queue=send_queue
+        )
+        self.assertEqual(3, instance.send_messages([EmailMessage() for i in range(3)]))
+        self.assertEqual(0, send_queue.sent)
+        self.assertFalse(instance.flush(0.01))
+        BlockingBackend.release.set()
+        self.assertTrue(instance.flush(5))
+        self.assertEqual((3, 0), (send_queue.sent, send_queue.failed))
+
+    def fill_queue(self, backpressure):
+        send_queue = self.get_send_queue(maxsize=1, workers=1, backpressure=backpressure, put_timeout=0.01)
+        instance = QueuedEmailMultiServerBackend(
+            backends=self.backends, backend_weights=self.weights, send_queue=send_queue
+        )
+        self.assertEqual(1, instance.send_messages([EmailMessage()]))
+        BlockingBackend.started.wait(5)
+        self.assertEqual(1, instance.send_messages([EmailMessage()]))
+        return send_queue, instance
+
+    def test_backpressure_drop(self):
+        send_queue, instance = self.fill_queue('drop')
+        self.assertEqual(0, instance.send_messages([EmailMessage()]))
+        self.assertEqual(1, send_queue.dropped)
+        BlockingBackend.release.set()
+        self.assertTrue(instance.flush(5))
+        self.assertEqual(2, send_queue.sent)
+
+    def test_backpressure_raise(self):
+        send_queue, instance = self.fill_queue('raise')
+        self.assertRaises(QueueFull, instance.send_messages, [EmailMessage()])
+
+    def test_backpressure_block_timeout(self):
+        send_queue, instance = self.fill_queue('block')
+        self.assertRaises(QueueFull, instance.send_messages, [EmailMessage()])
+
+    def test_failures_counted(self):
+        send_queue = self.get_send_queue(workers=1)
+        instance = QueuedEmailMultiServerBackend(
+            backends={'mailjet': {'backend': 'django_email_multibackend.tests.FakeCampaignMailBackend'}},
+            backend_weights=self.weights, send_queue=send_queue
+        )
+        self.assertEqual(2, instance.send_messages([EmailMessage(), EmailMessage()]))
+        self.assertTrue(instance.flush(5))
+        self.assertEqual((0, 2), (send_queue.sent, send_queue.failed))
+
+    def test_stop(self):
+        send_queue = self.get_send_queue(workers=2)
+        instance = QueuedEmailMultiServerBackend(
+            backends=self.backends, backend_weights=self.weights, send_queue=send_queue
+        )
+        instance.send_messages([EmailMessage() for i in range(3)])
+        BlockingBackend.release.set()
+        send_queue.stop()
+        self.assertEqual([], send_queue.threads)
+        # queued chunks are sent before the workers stop
+        self.assertEqual(3, send_queue.sent)
+
+
+class TestSpool(unittest.TestCase):
+    backends = {
+        'mailjet': {
+            'backend': 'django_email_multibackend.tests.RecordingBackend',
+        },
+        'mailchimp': {
+            'backend': 'django_email_multibackend.tests.RecordingBackend',
+        },
+    }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spools = []
+
+    def tearDown(self):
+        for spool in self.spools:
+            spool.stop()
+        shutil.rmtree(self.directory)
+
+    def get_spool(self, **kwargs):
+        spool = Spool(self.directory, poll_interval=0.05, **kwargs)
+        self.spools.append(spool)
+        return spool
+
+    def get_sent(self, instance):
+        sent = []
+        for backend in instance.servers.values():
+            sent.extend(sum(backend.calls, []))
+        return sent
+
+    def test_spooled_send(self):
+        instance = SpooledEmailMultiServerBackend(backends=self.backends, spool=self.get_spool(batch_size=3))
+        mails = [EmailMessage('mail %s' % i) for i in range(10)]
+        self.assertEqual(10, instance.send_messages(mails))
+        self.assertTrue(instance.flush(5))
+        self.assertEqual(
+            sorted('mail %s' % i for i in range(10)),
+            sorted(mail.subject for mail in self.get_sent(instance))
+        )
+        self.assertEqual((10, 0), (instance.spool.sent, instance.spool.failed))
+
+    def test_replay_unacknowledged(self):
+        spool = Spool(self.directory)
+        for i in range(3):
+            spool.append('mailjet', EmailMessage('mail %s' % i))
+        spool.sync()
+        records, position = spool.read('mailjet', 0, 2)
+        spool.ack('mailjet', position)
+        spool.file.close()
+        with open(spool.segments[-1].path, 'ab') as segment_file:
+            segment_file.write(b'\x00\x00\x10')
+
+        instance = EmailMultiServerBackend(backends=self.backends)
+        spool = self.get_spool()
+        spool.start(instance)
+        self.assertTrue(spool.flush(5))
+        self.assertEqual(['mail 2'], [mail.subject for mail in self.get_sent(instance)])
+
+    def test_retry_until_delivered(self):
+        RecoveringBackend.fail = True
+        RecoveringBackend.failures = 0
+        instance = SpooledEmailMultiServerBackend(
+            backends={'mailjet': {'backend': 'django_email_multibackend.tests.RecoveringBackend'}},
+            backend_weights=(('mailjet', 1), ), spool=self.get_spool(batch_size=2)
+        )
+        self.assertEqual(3, instance.send_messages([EmailMessage('mail %s' % i) for i in range(3)]))
+        self.assertFalse(instance.flush(0.2))
+        self.assertTrue(RecoveringBackend.failures > 1)
+
+        RecoveringBackend.fail = False
+        self.assertTrue(instance.flush(5))
+        self.assertEqual(
+            ['mail 0', 'mail 1', 'mail 2'],
+            [mail.subject for mail in sum(instance.servers['mailjet'].calls, [])]
+        )
+        self.assertEqual(3, instance.spool.sent)
+
+    def test_backends_added_by_reconfigure(self):
+        instance = SpooledEmailMultiServerBackend(
+            backends={'mailjet': self.backends['mailjet']}, spool=self.get_spool()
+        )
+        instance.reconfigure(backends=self.backends, weights=(('mailjet', 0), ('mailchimp', 1)))
+        self.assertEqual(3, instance.send_messages([EmailMessage('mail %s' % i) for i in range(3)]))
+        self.assertTrue(instance.flush(5))
+        self.assertEqual(3, len(sum(instance.servers['mailchimp'].calls, [])))
+
+    def test_compaction(self):
+        instance = SpooledEmailMultiServerBackend(backends=self.backends, spool=self.get_spool(segment_size=1))
+        self.assertEqual(5, instance.send_messages([EmailMessage() for i in range(5)]))
+        self.assertTrue(instance.flush(5))
+        segments = [name for name in os.listdir(self.directory) if name.endswith('.log')]
+        self.assertEqual(1, len(segments))
+        self.assertEqual(5, len(self.get_sent(instance)))
+
+
+class TestMetrics(unittest.TestCase):
+    backends = {
+        'mailjet': {
+            'backend': 'django_email_multibackend.tests.FakeSendingBackend',
+        },
+        'mailchimp': {
+            'backend': 'django_email_multibackend.tests.NoConnectionBackend',
+        },
+    }
+
+    def test_stats(self):
+        instance = EmailMultiServerBackend(backends=self.backends, metrics=Metrics(), routing_table=RoutingTable({
+            'mailjet': [('django_email_multibackend.conditions.ExcludeMailByHeader', {'header': ('X-MAIL-TYPE', 'non-transactional')})],
+            'mailchimp': [
+                ('django_email_multibackend.conditions.FilterMailByHeader', {'header': ('X-MAIL-TYPE', 'non-transactional')})
+            ],
+        }))
+        instance.send_messages([transactional_email] * 3 + [campaign_email] * 2)
+        stats = instance.stats()
+        self.assertEqual(5, stats['routed'])
+        self.assertEqual(5, stats['get_backends_for_email']['count'])
+        self.assertEqual(5, stats['weighted_choice']['count'])
+        # the compiled router makes one check per backend, the cache is left out
+        self.assertEqual(10, stats['condition_evaluations'])
+        self.assertEqual({'hits': 0, 'misses': 0, 'size': 0}, stats['routing_cache'])
+        self.assertEqual((3, 0), (stats['backends']['mailjet']['sent'], stats['backends']['mailjet']['failed']))
+        self.assertEqual((0, 2), (stats['backends']['mailchimp']['sent'], stats['backends']['mailchimp']['failed']))
+        self.assertEqual(3, stats['backends']['mailjet']['latency']['count'])
+
+    def test_evaluations_in_compiled_router(self):
+        exclude = ('django_email_multibackend.conditions.ExcludeMailByHeader', {'header': ('X-MAIL-TYPE', 'non-transactional')})
+        table = RoutingTable({'mailjet': [exclude], 'mailchimp': [exclude]})
+        instance = EmailMultiServerBackend(backends=self.backends, metrics=Metrics(), routing_table=table)
+        for i in range(3):
+            self.assertEqual([], instance.get_backends_for_email(campaign_email))
+        # both backends share the result of a single header check
+        self.assertEqual(3, instance.stats()['condition_evaluations'])
+        self.assertEqual(1, len(table.get_compiled().routers))
+
+    def test_disabled(self):
+        stats = EmailMultiServerBackend().stats()
+        self.assertEqual(set(['routing_cache', 'weighted_choices_cache']), set(stats))
+
+    def test_signals(self):
+        received = []
+
+        def on_pre_route(sender, message, **kwargs):
+            received.append(('pre_route', message))
+
+        def on_post_send(sender, backend_key, messages, count, latency, error, **kwargs):
+            received.append(('post_send', backend_key, messages, count, error))
+
+        pre_route.connect(on_pre_route)
+        post_send.connect(on_post_send)
+        try:
+            instance = EmailMultiServerBackend(backends=self.backends, backend_weights=(('mailjet', 1), ('mailchimp', 0)))
+            instance.send_messages([transactional_email])
+        finally:
+            pre_route.disconnect(on_pre_route)
+            post_send.disconnect(on_post_send)
+        self.assertEqual([
+            ('pre_route', transactional_email),
+            ('post_send', 'mailjet', [transactional_email], 1, None),
+        ], received)
+
 
 class TestWeightedChoice(unittest.TestCase):
     def test_low_limit(self):
@@ -173,6 +1360,30 @@ class TestWeightedChoice(unittest.TestCase):
         second = ('B', 5)
         self.assertEquals('B', weighted_choice_by_val([first, second], 0.5))
 
+    def test_zero_weights(self):
+        self.assertEqual('B', weighted_choice_by_val([('A', 0), ('B', 5)], 0.0))
+        self.assertEqual('B', weighted_choice_by_val([('A', 0), ('B', 0)], 0.3))
+        self.assertEqual('A', weighted_choice_by_val([('A', 1), ('B', 0), ('C', 0)], 0.99))
+
+    def test_same_choices_as_linear_scan(self):
+        def linear_weighted_choice_by_val(choices, random_value):
+            values, weights = zip(*choices)
+            rnd = random_value * sum(weights)
+            for i, w in enumerate(weights):
+                rnd -= w
+                if rnd < 0:
+                    return values[i]
+            return values[-1]
+
+        rnd = random.Random(42)
+        for i in range(200):
+            choices = [(name, rnd.randint(0, 4)) for name in 'ABCD'[:rnd.randint(1, 4)]]
+            random_value = rnd.choice([rnd.random(), 0.0, 0.25, 0.5, 0.75, 1.0])
+            self.assertEqual(
+                linear_weighted_choice_by_val(choices, random_value),
+                weighted_choice_by_val(choices, random_value)
+            )
+
 
 class TestConditions(unittest.TestCase):
 
@@ -188,3 +1399,625 @@ class TestConditions(unittest.TestCase):
         instance = EmailMultiServerBackend()
         transactional_backends = instance.get_backends_for_email(campaign_email)
         assert transactional_backends == [('mailchimp', 3)]
+
+
+class TestRecipientDomains(unittest.TestCase):
+    backends = {
+        'mailjet': {'backend': 'django_email_multibackend.tests.RecordingBackend'},
+        'mailchimp': {'backend': 'django_email_multibackend.tests.RecordingBackend'},
+    }
+    weights = (('mailjet', 1), ('mailchimp', 1))
+    domains = ['gmail.com', '*.yahoo.com']
+
+    def get_instance(self, **kwargs):
+        table = RoutingTable({
+            'mailjet': [('django_email_multibackend.conditions.FilterMailByRecipientDomain', {'domains': self.domains})],
+            'mailchimp': [('django_email_multibackend.conditions.ExcludeMailByRecipientDomain', {'domains': self.domains})],
+        })
+        return EmailMultiServerBackend(
+            backends=self.backends, backend_weights=self.weights, routing_table=table, **kwargs
+        )
+
+    def test_routed_by_domain(self):
+        instance = self.get_instance()
+        self.assertEqual([('mailjet', 1)], instance.get_backends_for_email(EmailMessage(to=['a@GMAIL.com'])))
+        self.assertEqual([('mailjet', 1)], instance.get_backends_for_email(EmailMessage(bcc=['a@eu.yahoo.com'])))
+        self.assertEqual([('mailchimp', 1)], instance.get_backends_for_email(EmailMessage(to=['a@yahoo.com'])))
+
+    def test_domains_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'domains.txt')
+            with open(path, 'w') as domains_file:
+                domains_file.write('# consumer ISPs\n')
+                domains_file.write(''.join('isp%s.com\n' % i for i in range(50000)))
+                domains_file.write('*.yahoo.com\n')
+            condition = FilterMailByRecipientDomain(domains_file=path)
+            self.assertEqual(50001, len(condition.domains))
+            self.assertTrue(condition(EmailMessage(to=['a@isp49999.com'])))
+            self.assertTrue(condition(EmailMessage(to=['a@mail.yahoo.com'])))
+            self.assertFalse(condition(EmailMessage(to=['a@isp50000.com'])))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_split_by_domain(self):
+        instance = self.get_instance(split_by_recipient_domain=True)
+        message = EmailMessage(to=['a@gmail.com', 'b@example.com'], bcc=['c@mail.yahoo.com'])
+        self.assertEqual(2, instance.send_messages([message]))
+        self.assertEqual([(['a@gmail.com'], ['c@mail.yahoo.com'])], [
+            (part.to, part.bcc) for part in sum(instance.servers['mailjet'].calls, [])
+        ])
+        self.assertEqual([(['b@example.com'], [])], [
+            (part.to, part.bcc) for part in sum(instance.servers['mailchimp'].calls, [])
+        ])
+        self.assertEqual(['a@gmail.com', 'b@example.com'], message.to)
+
+    def test_not_split_by_default(self):
+        instance = self.get_instance()
+        self.assertEqual(1, instance.send_messages([EmailMessage(to=['a@gmail.com', 'b@example.com'])]))
+        self.assertEqual(['mailjet'], list(instance.servers))
+
+
+class TestRoutingTable(unittest.TestCase):
+
+    def test_conditions_initialised_once(self):
+        CountingCondition.instances = 0
+        table = RoutingTable({
+            'mailjet': [('django_email_multibackend.tests.CountingCondition', {})],
+        })
+        instance = EmailMultiServerBackend(routing_table=table)
+        for i in range(10):
+            instance.get_backends_for_email(transactional_email)
+        self.assertEqual(1, CountingCondition.instances)
+
+    def test_reload(self):
+        backends_conditions = {}
+        table = RoutingTable(backends_conditions)
+        instance = EmailMultiServerBackend(routing_table=table)
+        self.assertEqual(list(instance.weights), instance.get_backends_for_email(campaign_email))
+        backends_conditions['mailchimp'] = [
+            ('django_email_multibackend.conditions.ExcludeMailByHeader', {'header': ('X-MAIL-TYPE', 'non-transactional')})
+        ]
+        self.assertEqual(list(instance.weights), instance.get_backends_for_email(campaign_email))
+        table.reload()
+        self.assertEqual([('mailjet', 5)], instance.get_backends_for_email(campaign_email))
+
+    def test_cache_by_header_values(self):
+        table = RoutingTable({
+            'mailjet': [('django_email_multibackend.tests.MailTypeCondition', {})],
+        })
+        instance = EmailMultiServerBackend(routing_table=table)
+        for i in range(5):
+            self.assertEqual([('mailchimp', 3)], instance.get_backends_for_email(campaign_email))
+            self.assertEqual(list(instance.weights), instance.get_backends_for_email(transactional_email))
+        hits, misses, size = table.cache_info()
+        self.assertEqual((8, 2, 2), (hits, misses, size))
+
+    def test_cache_bypassed_for_undeclared_headers(self):
+        table = RoutingTable({
+            'mailjet': [('django_email_multibackend.tests.SubjectCondition', {})],
+        })
+        instance = EmailMultiServerBackend(routing_table=table)
+        for i in range(3):
+            self.assertEqual([('mailchimp', 3)], instance.get_backends_for_email(campaign_email))
+        self.assertEqual((0, 0, 0), table.cache_info())
+
+    def test_cache_bypassed_for_header_checks(self):
+        table = RoutingTable(settings.EMAIL_BACKENDS_CONDITIONS)
+        instance = EmailMultiServerBackend(routing_table=table)
+        for i in range(3):
+            self.assertEqual([('mailchimp', 3)], instance.get_backends_for_email(campaign_email))
+            self.assertEqual(list(instance.weights), instance.get_backends_for_email(transactional_email))
+        self.assertEqual((0, 0, 0), table.cache_info())
+
+    def test_cache_bypassed_for_nested_header_checks(self):
+        table = RoutingTable({
+            'mailjet': [('django_email_multibackend.conditions.MatchAny', {'conditions': (
+                ('django_email_multibackend.conditions.FilterMailByHeader', {'header': ('X-PRIORITY', 'high')}),
+                ('django_email_multibackend.conditions.MatchAny', {'conditions': (
+                    ('django_email_multibackend.conditions.FilterMailByHeader', {'header': ('X-MAIL-TYPE', 'transactional')}),
+                )}),
+            )})],
+        }, cache_size=1024)
+        instance = EmailMultiServerBackend(routing_table=table)
+        for i in range(3):
+            self.assertEqual([('mailchimp', 3)], instance.get_backends_for_email(campaign_email))
+            self.assertEqual(list(instance.weights), instance.get_backends_for_email(transactional_email))
+        self.assertEqual((0, 0, 0), table.cache_info())
+
+    def test_match_any_headers(self):
+        table = RoutingTable({
+            'mailjet': [('django_email_multibackend.conditions.MatchAny', {'conditions': (
+                ('django_email_multibackend.conditions.FilterMailByHeader', {'header': ('X-MAIL-TYPE', 'transactional')}),
+                ('django_email_multibackend.conditions.FilterMailByHeader', {'header': ('X-PRIORITY', 'high')}),
+            )})],
+        })
+        self.assertEqual(set(['X-MAIL-TYPE', 'X-PRIORITY']), table.get_headers('mailjet'))
+        self.assertEqual(set(), table.get_headers('mailchimp'))
+
+    def test_setting_changed(self):
+        instance = EmailMultiServerBackend()
+        self.assertEqual([('mailchimp', 3)], instance.get_backends_for_email(campaign_email))
+        with override_settings(EMAIL_BACKENDS_CONDITIONS={}):
+            self.assertEqual(list(instance.weights), instance.get_backends_for_email(campaign_email))
+        self.assertEqual([('mailchimp', 3)], instance.get_backends_for_email(campaign_email))
+
+    def test_backend_options_follow_settings(self):
+        with override_settings(EMAIL_BACKENDS_WEIGHTS=(('mailjet', 1), ('mailchimp', 0)),
+                               EMAIL_BACKENDS_BATCH_SIZE=10, EMAIL_BACKENDS_FAILOVER=True):
+            instance = EmailMultiServerBackend()
+            self.assertEqual((('mailjet', 1), ('mailchimp', 0)), instance.weights)
+            self.assertEqual((10, True), (instance.batch_size, instance.failover))
+            self.assertEqual(5, EmailMultiServerBackend(batch_size=5).batch_size)
+        instance = EmailMultiServerBackend()
+        self.assertEqual((('mailjet', 5), ('mailchimp', 3)), instance.weights)
+        self.assertEqual((None, False), (instance.batch_size, instance.failover))
+
+
+class TestConditionCompiler(unittest.TestCase):
+    filter_condition = 'django_email_multibackend.conditions.FilterMailByHeader'
+    exclude_condition = 'django_email_multibackend.conditions.ExcludeMailByHeader'
+    match_any = 'django_email_multibackend.conditions.MatchAny'
+
+    def random_conditions(self, rnd, depth=0):
+        conditions = []
+        for i in range(rnd.randint(0, 3)):
+            kind = rnd.choice(['filter', 'exclude', 'any', 'subject'] if depth < 2 else ['filter', 'exclude'])
+            header = (rnd.choice(['X-MAIL-TYPE', 'X-PRIORITY']), rnd.choice(['a', 'b', 'c']))
+            if kind == 'filter':
+                conditions.append((self.filter_condition, {'header': header}))
+            elif kind == 'exclude':
+                conditions.append((self.exclude_condition, {'header': header}))
+            elif kind == 'any':
+                conditions.append((self.match_any, {'conditions': self.random_conditions(rnd, depth + 1)}))
+            else:
+                conditions.append(('django_email_multibackend.tests.SubjectCondition', {}))
+        return conditions
+
+    def test_same_result_as_conditions(self):
+        rnd = random.Random(42)
+        for backends_count in (3, 10):
+            weights = tuple(('backend%s' % i, i + 1) for i in range(backends_count))
+            for i in range(200):
+                table = RoutingTable(dict(
+                    (backend, self.random_conditions(rnd)) for backend, weight in weights
+                ))
+                mail = EmailMessage(rnd.choice(['buy this', 'hello']))
+                for header in ('X-MAIL-TYPE', 'x-priority'):
+                    if rnd.random() < 0.8:
+                        mail.extra_headers[header] = rnd.choice(['a', 'b', 'c'])
+                expected = [(backend, weight) for backend, weight in weights if table.match(backend, mail)]
+                self.assertEqual(expected, table.get_router(weights)(mail), table.get_router(weights).source)
+
+    def test_header_checks_merged(self):
+        table = RoutingTable({
+            'mailjet': [(self.match_any, {'conditions': (
+                (self.filter_condition, {'header': ('X-MAIL-TYPE', 'a')}),
+                (self.filter_condition, {'header': ('X-MAIL-TYPE', 'b')}),
+            )})],
+            'mailchimp': [
+                (self.exclude_condition, {'header': ('X-MAIL-TYPE', 'a')}),
+                (self.exclude_condition, {'header': ('X-MAIL-TYPE', 'b')}),
+            ],
+        })
+        source = table.get_router((('mailjet', 1), ('mailchimp', 1))).source
+        # one 'in' and one 'not in' lookup
+        self.assertEqual(2, source.count(' in '))
+        self.assertEqual(1, source.count(' not in '))
+
+    def test_shared_conditions_evaluated_once(self):
+        conditions = [(self.exclude_condition, {'header': ('X-MAIL-TYPE', 'non-transactional')})]
+        table = RoutingTable({'mailjet': conditions, 'mailchimp': conditions})
+        router = table.get_router((('mailjet', 1), ('mailchimp', 1)))
+        self.assertEqual(1, router.source.count(' not in '))
+        self.assertEqual([], router(campaign_email))
+        self.assertEqual([('mailjet', 1), ('mailchimp', 1)], router(transactional_email))
+
+    def test_custom_condition_fallback(self):
+        table = RoutingTable({'mailjet': [('django_email_multibackend.tests.SubjectCondition', {})]})
+        router = table.get_router((('mailjet', 1), ('mailchimp', 1)))
+        self.assertEqual([('mailchimp', 1)], router(campaign_email))
+        self.assertEqual([('mailjet', 1), ('mailchimp', 1)], router(transactional_email))
+
+    def test_subclass_overriding_check(self):
+        table = RoutingTable({
+            'mailjet': [('django_email_multibackend.tests.HeaderPrefixCondition', {'header': ('X-MAIL-TYPE', 'trans')})],
+        })
+        router = table.get_router((('mailjet', 1), ('mailchimp', 1)))
+        self.assertEqual([('mailjet', 1), ('mailchimp', 1)], router(transactional_email))
+        self.assertEqual([('mailchimp', 1)], router(campaign_email))
+        # its result depends on the check, not on the headers of the parent
+        self.assertEqual(None, table.get_headers('mailjet'))
+
+    def test_header_index(self):
+        weights = tuple(('backend%s' % i, 1) for i in range(40))
+        table = RoutingTable(dict(
+            (backend, [(self.filter_condition, {'header': ('X-TENANT', backend)})]) for backend, weight in weights
+        ))
+        table.backends_conditions['backend0'].append((self.exclude_condition, {'header': ('X-MAIL-TYPE', 'a')}))
+        router = table.get_router(weights)
+        # the index computes the whole result
+        self.assertFalse('matched' in router.source)
+        mail = EmailMessage()
+        mail.extra_headers['x-tenant'] = 'backend0'
+        self.assertEqual([('backend0', 1)], router(mail))
+        mail.extra_headers['X-Mail-Type'] = 'a'
+        self.assertEqual([], router(mail))
+        mail.extra_headers['x-tenant'] = ['backend0']
+        self.assertEqual(None, router(mail))
+
+    def test_header_index_with_custom_conditions(self):
+        weights = tuple(('backend%s' % i, 1) for i in range(40))
+        table = RoutingTable(dict(
+            (backend, [(self.filter_condition, {'header': ('X-TENANT', backend)})]) for backend, weight in weights
+        ))
+        table.backends_conditions['backend39'] = [('django_email_multibackend.tests.SubjectCondition', {})]
+        router = table.get_router(weights)
+        self.assertTrue('rejected' in router.source)
+        mail = EmailMessage('hello')
+        mail.extra_headers['X-TENANT'] = 'backend1'
+        self.assertEqual([('backend1', 1), ('backend39', 1)], router(mail))
+        mail.subject = 'buy this'
+        self.assertEqual([('backend1', 1)], router(mail))
+
+    def test_header_names_case_insensitive(self):
+        table = RoutingTable({'mailjet': [(self.exclude_condition, {'header': ('X-MAIL-TYPE', 'a')})]})
+        instance = EmailMultiServerBackend(routing_table=table)
+        mail = EmailMessage()
+        mail.extra_headers['x-mail-type'] = 'a'
+        for i in range(2):
+            self.assertEqual([('mailchimp', 3)], instance.get_backends_for_email(mail))
+            self.assertEqual(list(instance.weights), instance.get_backends_for_email(EmailMessage()))
+        self.assertFalse(table.match('mailjet', mail))
+
+    def test_unhashable_header_value(self):
+        table = RoutingTable({'mailjet': [(self.filter_condition, {'header': ('X-MAIL-TYPE', 'a')})]})
+        mail = EmailMessage()
+        mail.extra_headers['X-MAIL-TYPE'] = ['a']
+        self.assertEqual(None, table.get_router((('mailjet', 1), ('mailchimp', 1)))(mail))
+        self.assertEqual([('mailchimp', 1)], table.match_backends((('mailjet', 1), ('mailchimp', 1)), mail))
+
+
+class SlowCondition(BaseCondition):
+    calls = 0
+
+    def check(self, message):
+        SlowCondition.calls += 1
+        time.sleep(0.001)
+        return True
+
+
+class TestConditionOrdering(unittest.TestCase):
+    conditions = {
+        'mailjet': [
+            ('django_email_multibackend.tests.SlowCondition', {}),
+            ('django_email_multibackend.conditions.ExcludeMailByHeader', {'header': ('X-MAIL-TYPE', 'non-transactional')}),
+        ],
+    }
+
+    def test_cheap_selective_condition_moved_first(self):
+        table = RoutingTable(self.conditions, cache_size=0, ordering={'sample_every': 1, 'reorder_every': 10})
+        instance = EmailMultiServerBackend(routing_table=table)
+        for i in range(10):
+            self.assertEqual([('mailchimp', 3)], instance.get_backends_for_email(campaign_email))
+            self.assertEqual(list(instance.weights), instance.get_backends_for_email(transactional_email))
+        self.assertEqual([
+            "ExcludeMailByHeader(header=('X-MAIL-TYPE', 'non-transactional'))", 'SlowCondition()',
+        ], instance.stats()['condition_order']['mailjet'])
+
+        # rejected messages no longer reach the slow condition
+        table.get_compiled().ordering.sample_every = 1000
+        SlowCondition.calls = 0
+        for i in range(10):
+            self.assertEqual([('mailchimp', 3)], instance.get_backends_for_email(campaign_email))
+        self.assertEqual(0, SlowCondition.calls)
+
+    def test_disabled(self):
+        instance = EmailMultiServerBackend(routing_table=RoutingTable(self.conditions))
+        self.assertFalse('condition_order' in instance.stats())
+
+
+def campaign_items():
+    return range(30)
+
+
+def build_campaign_message(item):
+    if item == 13:
+        raise ValueError('bad recipient')
+    return EmailMessage(subject='campaign %d' % item, to=['user%d@example.com' % item])
+
+
+class TestCampaign(unittest.TestCase):
+    backend_kwargs = {
+        'backends': {
+            'mailjet': {'backend': 'django_email_multibackend.tests.FakeSendingBackend'},
+            'mailchimp': {'backend': 'django_email_multibackend.tests.FakeSendingBackend'},
+        },
+        'backend_weights': (('mailjet', 1), ('mailchimp', 1)),
+        'routing_table': RoutingTable({}),
+    }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.directory, 'campaign.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_per_backend_counts(self):
+        stats = send_campaign(
+            [EmailMessage() for i in range(50)], processes=2, shard_size=10, backend_kwargs=self.backend_kwargs
+        )
+        self.assertEqual(50, stats['sent'])
+        self.assertEqual(0, stats['failed'])
+        self.assertEqual(50, sum(counts['sent'] for counts in stats['backends'].values()))
+
+    def test_failures_counted(self):
+        backend_kwargs = dict(self.backend_kwargs, backends={
+            'mailjet': {'backend': 'django_email_multibackend.tests.FakeSendingBackend'},
+            'mailchimp': {'backend': 'django_email_multibackend.tests.FakeCampaignMailBackend'},
+        })
+        stats = send_campaign(
+            [EmailMessage() for i in range(40)], processes=2, shard_size=10, backend_kwargs=backend_kwargs
+        )
+        self.assertEqual(40, stats['sent'] + stats['failed'])
+        self.assertEqual(stats['backends']['mailchimp'], {'sent': 0, 'failed': stats['failed']})
+        self.assertTrue(stats['errors'][0].startswith('mailchimp: SentCampaignException'))
+
+    def test_fail_silently_rejected(self):
+        backend_kwargs = dict(self.backend_kwargs, fail_silently=False)
+        self.assertRaises(TypeError, send_campaign, [EmailMessage()], processes=1, backend_kwargs=backend_kwargs)
+
+    def test_resume_from_checkpoint(self):
+        def interrupted():
+            for i in range(25):
+                yield EmailMessage()
+            raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            send_campaign(
+                interrupted, processes=2, shard_size=10, checkpoint=self.checkpoint,
+                backend_kwargs=self.backend_kwargs
+            )
+        with open(self.checkpoint) as checkpoint_file:
+            # shards not started yet when interrupted are cancelled
+            self.assertTrue(json.load(checkpoint_file)['offset'] in (10, 20))
+
+        stats = send_campaign(
+            [EmailMessage() for i in range(50)], processes=2, shard_size=10, checkpoint=self.checkpoint,
+            backend_kwargs=self.backend_kwargs
+        )
+        # the first 20 messages are not sent again
+        self.assertEqual(50, stats['sent'])
+
+    def test_command(self):
+        out = StringIO()
+        call_command(
+            SendCampaignCommand(), 'django_email_multibackend.tests.campaign_items', '--processes', '2',
+            '--shard-size', '10', '--build-message', 'django_email_multibackend.tests.build_campaign_message',
+            '--json', stdout=out
+        )
+        stats = json.loads(out.getvalue())
+        # the backends of the test settings always raise
+        self.assertEqual((0, 30), (stats['sent'], stats['failed']))
+        self.assertEqual(29, sum(counts['failed'] for counts in stats['backends'].values()))
+        self.assertTrue('None: ValueError: bad recipient' in stats['errors'])
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestRoutingSimulation(unittest.TestCase):
+    profiles = [
+        {'headers': {'X-MAIL-TYPE': 'transactional'}, 'frequency': 800},
+        {'headers': {'X-MAIL-TYPE': 'non-transactional'}, 'frequency': 200},
+    ]
+
+    def get_profiles(self):
+        return [(get_profile_message(profile), profile['frequency']) for profile in self.profiles]
+
+    def test_expected_volumes(self):
+        results = simulate(self.get_profiles(), runs=2000, seed=1)
+        self.assertEqual(1000, results['messages'])
+        mailjet = results['backends']['mailjet']
+        self.assertEqual((500, 187.5, 0.5), (mailjet['expected'], mailjet['variance'], mailjet['share']))
+        self.assertEqual(500, results['backends']['mailchimp']['expected'])
+        self.assertTrue(abs(mailjet['mean'] - 500) < 2)
+        self.assertTrue(abs(mailjet['std'] - 187.5 ** 0.5) < 1)
+        self.assertEqual(0, results['unroutable']['max'])
+
+    def test_relative_frequencies(self):
+        results = simulate(self.get_profiles(), messages=10 ** 7, runs=10, seed=1)
+        self.assertEqual(5 * 10 ** 6, results['backends']['mailjet']['expected'])
+        self.assertTrue(abs(results['backends']['mailjet']['mean'] / 10 ** 7 - 0.5) < 0.001)
+
+    def test_unroutable(self):
+        connection = EmailMultiServerBackend(
+            backends={'mailjet': {'backend': 'django_email_multibackend.tests.FakeSendingBackend'}},
+            backend_weights=(('mailjet', 1), ),
+            routing_table=RoutingTable({'mailjet': settings.EMAIL_BACKENDS_CONDITIONS['mailjet']})
+        )
+        results = simulate(self.get_profiles(), runs=10, connection=connection)
+        self.assertEqual(800, results['backends']['mailjet']['min'])
+        self.assertEqual(200, results['unroutable']['expected'])
+
+    def test_zero_weights(self):
+        connection = EmailMultiServerBackend(
+            backends={
+                'mailjet': {'backend': 'django_email_multibackend.tests.FakeSendingBackend'},
+                'mailchimp': {'backend': 'django_email_multibackend.tests.FakeSendingBackend'},
+            },
+            backend_weights=(('mailjet', 0), ('mailchimp', 0)), routing_table=RoutingTable({})
+        )
+        results = simulate(self.get_profiles(), runs=10, connection=connection)
+        self.assertEqual('mailchimp', connection.get_backend_key(EmailMessage()))
+        self.assertEqual(1000, results['backends']['mailchimp']['expected'])
+        self.assertEqual(0, results['backends']['mailjet']['expected'])
+        self.assertEqual(0, results['unroutable']['expected'])
+
+    def test_command(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'profiles.json')
+            with open(path, 'w') as profiles_file:
+                json.dump(self.profiles, profiles_file)
+            out = StringIO()
+            call_command(SimulateRoutingCommand(), path, '--runs', '10', '--json', stdout=out)
+        finally:
+            shutil.rmtree(directory)
+        results = json.loads(out.getvalue())
+        self.assertEqual(['mailchimp', 'mailjet'], sorted(results['backends']))
+        self.assertEqual(10, results['runs'])
+
+
+class TestReconfigure(unittest.TestCase):
+    backends = {
+        'mailjet': {'backend': 'django_email_multibackend.tests.RecordingBackend'},
+        'mailchimp': {'backend': 'django_email_multibackend.tests.RecordingBackend'},
+    }
+    weights = (('mailjet', 1), ('mailchimp', 0))
+
+    def setUp(self):
+        self.instance = EmailMultiServerBackend(
+            backends=self.backends, backend_weights=self.weights, routing_table=RoutingTable({})
+        )
+
+    def sent_to(self, backend_key):
+        return len(sum(self.instance.servers[backend_key].calls, []))
+
+    def test_weights(self):
+        mailjet = self.instance.servers['mailjet']
+        self.assertEqual(3, self.instance.send_messages([EmailMessage() for i in range(3)]))
+        self.instance.reconfigure(weights=(('mailjet', 0), ('mailchimp', 1)))
+        self.assertEqual(3, self.instance.send_messages([EmailMessage() for i in range(3)]))
+        self.assertEqual((3, 3), (self.sent_to('mailjet'), self.sent_to('mailchimp')))
+        # the backends did not change, their connections are kept
+        self.assertTrue(self.instance.servers['mailjet'] is mailjet)
+
+    def test_conditions(self):
+        self.instance.reconfigure(weights=(('mailjet', 1), ('mailchimp', 1)), conditions={
+            'mailjet': settings.EMAIL_BACKENDS_CONDITIONS['mailjet'],
+            'mailchimp': [
+                ('django_email_multibackend.conditions.FilterMailByHeader', {'header': ('X-MAIL-TYPE', 'non-transactional')})
+            ],
+        })
+        self.assertEqual([('mailchimp', 1)], self.instance.get_backends_for_email(campaign_email))
+        self.assertEqual([('mailjet', 1)], self.instance.get_backends_for_email(transactional_email))
+
+    def test_invalid_configuration_not_applied(self):
+        self.assertRaises(ImproperlyConfigured, self.instance.reconfigure, weights=(('mailjet', 1), ))
+        self.assertRaises(ImproperlyConfigured, self.instance.reconfigure, conditions={'mailjet': [('unknown.Condition', {})]})
+        self.assertEqual(self.weights, self.instance.weights)
+        self.assertEqual([('mailjet', 1), ('mailchimp', 0)], self.instance.get_backends_for_email(campaign_email))
+
+    def test_send_in_flight_keeps_snapshot(self):
+        first_sent = threading.Event()
+        resume = threading.Event()
+
+        def messages():
+            yield EmailMessage()
+            first_sent.set()
+            resume.wait(5)
+            yield EmailMessage()
+
+        thread = threading.Thread(target=self.instance.send_messages, args=(messages(), ))
+        thread.start()
+        first_sent.wait(5)
+        self.instance.reconfigure(weights=(('mailjet', 0), ('mailchimp', 1)))
+        resume.set()
+        thread.join()
+        self.assertEqual(2, self.sent_to('mailjet'))
+        self.instance.send_messages([EmailMessage()])
+        self.assertEqual(1, self.sent_to('mailchimp'))
+
+    def test_changed_backends_closed(self):
+        backends = {
+            'mailjet': {'backend': 'django_email_multibackend.tests.ConnectionTrackingBackend'},
+            'mailchimp': {'backend': 'django_email_multibackend.tests.ConnectionTrackingBackend'},
+        }
+        instance = EmailMultiServerBackend(backends=backends, backend_weights=self.weights)
+        instance.open()
+        mailjet, mailchimp = instance.servers['mailjet'], instance.servers['mailchimp']
+        ConnectionTrackingBackend.opened = ConnectionTrackingBackend.closed = 0
+        instance.reconfigure(backends=dict(backends, mailchimp=dict(backends['mailchimp'], host='smtp.example.com')))
+        self.assertEqual(1, ConnectionTrackingBackend.closed)
+        self.assertTrue(instance.servers['mailjet'] is mailjet)
+        self.assertFalse(instance.servers['mailchimp'] is mailchimp)
+        self.assertEqual(1, ConnectionTrackingBackend.opened)
+
+    def test_changed_backends_closed_after_send_in_flight(self):
+        backends = {
+            'mailjet': {'backend': 'django_email_multibackend.tests.ConnectionTrackingBackend'},
+            'mailchimp': {'backend': 'django_email_multibackend.tests.ConnectionTrackingBackend'},
+        }
+        instance = EmailMultiServerBackend(backends=backends, backend_weights=self.weights)
+        first_sent = threading.Event()
+        resume = threading.Event()
+        sent = []
+
+        def messages():
+            yield EmailMessage()
+            first_sent.set()
+            resume.wait(5)
+            yield EmailMessage()
+
+        thread = threading.Thread(target=lambda: sent.append(instance.send_messages(messages())))
+        thread.start()
+        first_sent.wait(5)
+        ConnectionTrackingBackend.closed = 0
+        instance.reconfigure(backends=dict(backends, mailjet=dict(backends['mailjet'], host='smtp.example.com')))
+        # the send in flight still uses the previous mailjet backend
+        self.assertEqual(0, ConnectionTrackingBackend.closed)
+        resume.set()
+        thread.join()
+        self.assertEqual([2], sent)
+        self.assertEqual(1, ConnectionTrackingBackend.closed)
+        instance.send_messages([EmailMessage()])
+        self.assertEqual(1, ConnectionTrackingBackend.closed)
+
+    def test_queued_send_keeps_snapshot(self):
+        GatedBackend.gate = threading.Event()
+        backends = dict(self.backends, mailjet={'backend': 'django_email_multibackend.tests.GatedBackend'})
+        send_queue = SendQueue(workers=1)
+        instance = QueuedEmailMultiServerBackend(
+            backends=backends, backend_weights=self.weights, routing_table=RoutingTable({}), send_queue=send_queue
+        )
+        mailjet = instance.servers['mailjet']
+        try:
+            self.assertEqual(3, instance.send_messages([EmailMessage() for i in range(3)]))
+            instance.reconfigure(backends=dict(backends, mailjet=dict(backends['mailjet'], host='smtp.example.com')))
+            GatedBackend.gate.set()
+            self.assertTrue(send_queue.flush(5))
+        finally:
+            send_queue.stop()
+        self.assertEqual(3, len(sum(mailjet.calls, [])))
+
+    def test_watch_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'email-backends.json')
+            with open(path, 'w') as config_file:
+                json.dump({'weights': [['mailjet', 0], ['mailchimp', 1]]}, config_file)
+            watcher = ConfigWatcher(self.instance, path)
+            self.assertTrue(watcher.check())
+            self.assertFalse(watcher.check())
+            self.assertEqual((('mailjet', 0), ('mailchimp', 1)), self.instance.weights)
+
+            with open(path, 'w') as config_file:
+                config_file.write('{"weights": [["unknown", 1]], "extra": 1}')
+            os.utime(path, (0, 0))
+            self.assertFalse(watcher.check())
+            self.assertEqual((('mailjet', 0), ('mailchimp', 1)), self.instance.weights)
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipIf(yaml is None, 'PyYAML is not installed')
+    def test_watch_yaml_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'email-backends.yaml')
+            with open(path, 'w') as config_file:
+                config_file.write('weights:\n  - [mailjet, 2]\n  - [mailchimp, 1]\n')
+            watcher = self.instance.watch(path, interval=0.01)
+            watcher.stop()
+            self.assertEqual((('mailjet', 2), ('mailchimp', 1)), self.instance.weights)
+        finally:
+            shutil.rmtree(directory)
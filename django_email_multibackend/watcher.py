@@ -0,0 +1,97 @@
+"""
+Reconfigures an EmailMultiServerBackend from a local JSON or YAML file whenever the file changes
+"""
+import json
+import logging
+import os
+import threading
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+logger = logging.getLogger(__name__)
+
+# the arguments of EmailMultiServerBackend.reconfigure
+CONFIG_KEYS = ('weights', 'conditions', 'backends')
+
+
+def load_config(path):
+    """
+    Returns the reconfigure arguments in :path, a JSON object or (for .yaml and .yml files, with PyYAML installed)
+    a YAML mapping with weights, conditions and / or backends given like the settings
+
+    eg. {"weights": [["mailjet", 7], ["mandrill", 3]]}
+    """
+    with open(path) as config_file:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImproperlyConfigured('PyYAML is required to read %s' % path)
+            config = yaml.safe_load(config_file)
+        else:
+            config = json.load(config_file)
+    if not isinstance(config, dict):
+        raise ImproperlyConfigured('%s does not define a mapping' % path)
+    unknown = set(config) - set(CONFIG_KEYS)
+    if unknown:
+        raise ImproperlyConfigured('Unknown keys in %s: %s' % (path, ', '.join(sorted(unknown))))
+    return config
+
+
+class ConfigWatcher(object):
+    """
+    Checks every :interval seconds whether :path changed and applies it to :connection
+
+    A file that can not be loaded or applied is logged and the current configuration kept.
+    """
+
+    def __init__(self, connection, path, interval=1.0):
+        self.connection = connection
+        self.path = path
+        self.interval = interval
+        self.signature = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def get_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def check(self):
+        """
+        Applies the file if it changed since the last check, returns whether the configuration was replaced
+        """
+        signature = self.get_signature()
+        if signature is None or signature == self.signature:
+            return False
+        self.signature = signature
+        try:
+            self.connection.reconfigure(**load_config(self.path))
+        except Exception:
+            logger.exception('Error applying the email backends configuration in %s', self.path)
+            return False
+        return True
+
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def start(self):
+        """
+        Applies the file now and starts checking it in a background thread
+        """
+        self.check()
+        self.thread = threading.Thread(target=self.watch, name='email-backends-config-watcher')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
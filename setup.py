@@ -104,11 +104,16 @@ CLASSIFIERS = [
     'Natural Language :: English',
     'Operating System :: OS Independent',
     'Programming Language :: Python',
-    'Programming Language :: Python :: 2.6',
-    'Programming Language :: Python :: 2.7',
-    'Programming Language :: Python :: 3.4',
+    'Programming Language :: Python :: 3',
+    'Programming Language :: Python :: 3 :: Only',
+    'Programming Language :: Python :: 3.7',
+    'Programming Language :: Python :: 3.8',
+    'Programming Language :: Python :: 3.9',
+    'Programming Language :: Python :: 3.10',
     'Topic :: Software Development :: Libraries :: Python Modules',
     'Framework :: Django',
+    'Framework :: Django :: 2.2',
+    'Framework :: Django :: 3.2',
     'Environment :: Web Environment',
 ]
 
@@ -127,8 +132,16 @@ setup(
     package_data=package_data,
     description=DESCRIPTION,
     classifiers=CLASSIFIERS,
+    python_requires='>=3.7',
+    install_requires=[
+        'django>=2.2',
+    ],
+    extras_require={
+        'simulation': ['numpy'],
+        'yaml': ['PyYAML'],
+    },
     tests_require=[
-        'django==1.5',
+        'django>=2.2',
         'pytest',
     ],
     test_suite='runtests.runtests',